@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark offline del Bot Noleggio SUP.
+
+Genera uno storico sintetico di noleggi (1k, 100k, 1M...), avvia il bot su
+quei dati in una cartella temporanea e misura gli handler veri con Update e
+Context finti: nessuna connessione a Telegram, le risposte della Bot API
+sono simulate da harness.OfflineRequest.
+
+Per ogni operazione riporta i percentili di latenza, il picco di memoria
+(tracemalloc) e la dimensione dei file dati; i risultati vengono aggiunti a
+un file JSONL così che due esecuzioni si possano confrontare.
+
+Uso:
+    python benchmark.py                                   # 1k e 100k, backend json
+    python benchmark.py --dimensioni 1000,100000,1000000 --backend json,sqlite,mensile
+    python benchmark.py --confronta                       # confronta con l'esecuzione precedente
+
+Ogni combinazione dimensione/backend gira in un processo separato: main.py
+tiene lo stato a livello di modulo e il picco di memoria dell'avvio deve
+riferirsi solo a quei dati.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+import harness
+
+RISULTATI_FILE = 'benchmark_risultati.jsonl'
+DIMENSIONI_PREDEFINITE = '1000,100000'
+
+COGNOMI = ['Rossi', 'Russo', 'Ferrari', 'Esposito', 'Bianchi', 'Romano', 'Colombo', 'Ricci', 'Marino',
+           'Greco', 'Bruno', 'Gallo', 'Conti', 'De Luca', 'Mancini', 'Costa', 'Giordano', 'Rizzo',
+           'Lombardi', 'Moretti', 'Barbieri', 'Fontana', 'Santoro', 'Mariani', 'Rinaldi', 'Caruso']
+NOMI = ['Marco', 'Giulia', 'Luca', 'Sara', 'Andrea', 'Chiara', 'Matteo', 'Francesca', 'Paolo',
+        'Elena', 'Davide', 'Anna', 'Simone', 'Laura', 'Stefano', 'Marta', 'Fabio', 'Silvia']
+TEMPI = ['1h', '1,5h', '2h', '2,5h', '3h', '3,5h', '4h', '4,5h', '5h', '6h', '8h']
+MODELLI_SUP = ['All-around', 'Touring', 'Race', 'Surf', 'Yoga']
+
+def genera_noleggio(rnd, giorno, clienti):
+    """Un noleggio realistico: clienti che tornano, più noleggi per persona, foto e note ogni tanto"""
+    cognome, nome, documento, numero_documento, telefono, associato = rnd.choice(clienti)
+    tipo = rnd.choices(['SUP', 'KAYAK', 'LETTINO', 'PHONEBAG', 'DRYBAG'], weights=[45, 15, 25, 10, 5])[0]
+    dettagli, numero = '', ''
+    if tipo == 'SUP':
+        dettagli = rnd.choice(MODELLI_SUP)
+    elif tipo == 'KAYAK':
+        dettagli = 'Standard'
+    elif tipo == 'LETTINO':
+        dettagli = rnd.choice(['Pineta', 'Squero'])
+        numero = rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') if associato == 'SÌ' else str(rnd.randint(0, 99))
+    else:
+        numero = str(rnd.randint(0, 99))
+
+    ora = giorno.replace(hour=rnd.randint(8, 18), minute=rnd.randint(0, 59), second=rnd.randint(0, 59))
+    con_foto = rnd.random() < 0.3
+    return {
+        'data': giorno.strftime('%d/%m/%Y'),
+        'cognome': cognome,
+        'nome': nome,
+        'documento': documento,
+        'numero_documento': numero_documento,
+        'telefono': telefono,
+        'associato': associato,
+        'tipo_noleggio': tipo,
+        'dettagli': dettagli,
+        'numero': numero,
+        'tempo': rnd.choice(TEMPI),
+        'pagamento': rnd.choice(['CARD', 'BONIFICO']),
+        'importo': f"{rnd.choice([10, 15, 20, 25, 30, 40, 50])}.00 EUR",
+        'foto_ricevuta': f"{ora:%Y%m%d_%H%M%S}_{cognome}_{nome}_ricevuta.jpg" if con_foto else None,
+        'note': rnd.choice([None, None, None, 'pagaia extra', 'giubbotto bambino', 'rientro anticipato']),
+        'timestamp': ora.isoformat(),
+    }
+
+def genera_storico(percorso, quanti, giorni=150, seed=42):
+    """Scrive noleggi.json in streaming (1M di dizionari non devono stare in memoria insieme)"""
+    rnd = random.Random(seed)
+    clienti = [
+        (rnd.choice(COGNOMI) + ('' if i < 200 else f" {i}"), rnd.choice(NOMI), rnd.choice(['CI', 'PAT', 'PASS']),
+         f"{rnd.choice('ABCDEFGH')}{rnd.choice('ABCDEFGH')}{rnd.randint(0, 9999999):07d}",
+         f"3{rnd.randint(0, 999999999):09d}", rnd.choice(['SÌ', 'NO']))
+        for i in range(max(50, quanti // 4))
+    ]
+    oggi = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    with open(percorso, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        for i in range(quanti):
+            # In ordine di data, come nel file vero; l'ultimo giorno è oggi
+            giorno = oggi - timedelta(days=giorni - 1 - (i * giorni) // quanti)
+            if i:
+                f.write(',\n')
+            f.write(json.dumps(genera_noleggio(rnd, giorno, clienti), ensure_ascii=False))
+        f.write('\n]\n')
+
+def percentili(tempi_ms):
+    ordinati = sorted(tempi_ms)
+    def p(q):
+        return round(ordinati[min(len(ordinati) - 1, int(q * len(ordinati)))], 3)
+    return {'p50_ms': p(0.50), 'p90_ms': p(0.90), 'p99_ms': p(0.99),
+            'max_ms': round(ordinati[-1], 3), 'media_ms': round(statistics.fmean(ordinati), 3)}
+
+def dimensione_file_kb():
+    totale = 0
+    for nome in os.listdir('.'):
+        if nome.startswith('noleggi') and os.path.isfile(nome) and not nome.endswith('.migrato'):
+            totale += os.path.getsize(nome)
+        elif nome.startswith('noleggi') and os.path.isdir(nome):
+            # Partizioni mensili
+            totale += sum(os.path.getsize(os.path.join(nome, f)) for f in os.listdir(nome))
+    return round(totale / 1024, 1)
+
+async def misura(nome, ripetizioni, operazione):
+    """Latenze su 'ripetizioni' chiamate, poi una chiamata in più sotto tracemalloc per il picco"""
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        await operazione()
+        tempi.append((time.perf_counter() - inizio) * 1000)
+
+    tracemalloc.start()
+    await operazione()
+    _, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    risultato = {'operazione': nome, 'ripetizioni': ripetizioni, **percentili(tempi),
+                 'picco_mem_kb': round(picco / 1024, 1), 'file_kb': dimensione_file_kb()}
+    print(f"  {nome:<20} p50 {risultato['p50_ms']:>9.2f} ms  p99 {risultato['p99_ms']:>9.2f} ms  "
+          f"mem {risultato['picco_mem_kb']:>10.1f} KB", file=sys.stderr)
+    return risultato
+
+async def esegui_benchmark(ripetizioni, ripetizioni_pesanti):
+    """Avvia main sui dati della cartella corrente e misura le operazioni principali"""
+    inizio = time.perf_counter()
+    import main
+    from telegram import Update
+    from telegram.ext import CallbackContext
+    risultati = [{'operazione': 'avvio', 'ripetizioni': 1, 'p50_ms': round((time.perf_counter() - inizio) * 1000, 3),
+                  'picco_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'file_kb': dimensione_file_kb()}]
+
+    trasporto = harness.OfflineRequest()
+    application = main.crea_application(harness.TOKEN_OFFLINE, request=trasporto, webhook=True)
+    await application.initialize()
+    progressivo = iter(range(1, 10 ** 9))
+
+    def contesto(payload, args=None):
+        update = Update.de_json(payload, application.bot)
+        context = CallbackContext.from_update(update, application)
+        context.args = args or []
+        return update, context
+
+    def comando(testo):
+        return contesto(harness.messaggio(next(progressivo), testo), testo.split()[1:])
+
+    def pulsante(dati):
+        return contesto(harness.callback(next(progressivo), dati))
+
+    # Indici su tutto lo storico (registro clienti, /cerca): costo una tantum, misurato a parte
+    inizio = time.perf_counter()
+    await main.bot_instance.indici_pronti()
+    risultati.append({'operazione': 'carica_indici', 'ripetizioni': 1,
+                      'p50_ms': round((time.perf_counter() - inizio) * 1000, 3), 'file_kb': dimensione_file_kb()})
+
+    oggi = main.bot_instance.get_noleggi_oggi()
+    # Un noleggio di oggi come riferimento per scheda cliente e riepilogo
+    riferimento = oggi[len(oggi) // 2] if oggi else None
+
+    async def salva_snapshot():
+        await asyncio.to_thread(main.bot_instance.storage.save_data)
+
+    async def aggiungi_noleggio():
+        await main.bot_instance.aggiungi_noleggio(main.Noleggio.da_dict({
+            **genera_noleggio(random.Random(), datetime.now(), [riferimento_cliente]),
+            'id': main.id_noleggio(main.data_oggi()),
+        }))
+
+    async def noleggi_oggi():
+        main.bot_instance.get_noleggi_oggi()
+
+    async def mostra_noleggi():
+        await main.mostra_noleggi(*comando('/mostra_noleggi'))
+
+    async def scheda_cliente():
+        await main.handle_callback(*pulsante(f"cliente_{riferimento.id}"))
+
+    async def finito():
+        update, context = pulsante("finito")
+        context.user_data.update(cognome=riferimento.cognome, nome=riferimento.nome, telefono=riferimento.telefono)
+        await main.handle_callback(update, context)
+
+    async def export_oggi():
+        await main.export_csv(*comando(f"/export {main.data_oggi()}"))
+
+    async def export_tutto():
+        await main.export_csv(*comando('/export'))
+
+    async def cerca():
+        await main.cerca(*comando(f"/cerca {riferimento.cognome[:4]}"))
+
+    operazioni = [
+        ('get_noleggi_oggi', ripetizioni, noleggi_oggi),
+        ('mostra_noleggi', ripetizioni, mostra_noleggi),
+        ('export_oggi', ripetizioni, export_oggi),
+        ('export_tutto', ripetizioni_pesanti, export_tutto),
+        ('aggiungi_noleggio', ripetizioni, aggiungi_noleggio),
+    ]
+    if riferimento is not None:
+        riferimento_cliente = (riferimento.cognome, riferimento.nome, str(riferimento.documento),
+                               riferimento.numero_documento, riferimento.telefono, str(riferimento.associato))
+        operazioni[2:2] = [
+            ('cliente_', ripetizioni, scheda_cliente),
+            ('finito', ripetizioni, finito),
+            ('cerca', ripetizioni, cerca),
+        ]
+    else:
+        operazioni.pop()  # senza noleggi di oggi non c'è un cliente da cui generarne altri
+    if hasattr(main.bot_instance.storage, 'save_data'):
+        operazioni.append(('save_data', ripetizioni_pesanti, salva_snapshot))
+
+    try:
+        for nome, volte, operazione in operazioni:
+            risultati.append(await misura(nome, volte, operazione))
+    finally:
+        await application.shutdown()
+        await main.post_shutdown(application)
+    return risultati
+
+def esegui_singolo(args):
+    """Processo figlio: genera i dati, misura e stampa i risultati in JSON su stdout"""
+    os.chdir(args.dir)
+    inizio = time.perf_counter()
+    genera_storico('noleggi.json', args.singolo)
+    if os.environ.get('STORAGE_BACKEND') == 'mensile':
+        # La divisione in mesi avviene al primo avvio: fuori dalla misura dell'avvio
+        subprocess.run([sys.executable, '-c', 'import main; main.bot_instance.chiudi()'], check=True,
+                       env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+    print(f"  dati generati in {time.perf_counter() - inizio:.1f}s ({dimensione_file_kb()} KB)", file=sys.stderr)
+    risultati = asyncio.run(esegui_benchmark(args.ripetizioni, args.ripetizioni_pesanti))
+    json.dump(risultati, sys.stdout)
+
+def commit_corrente():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def leggi_risultati(percorso):
+    try:
+        with open(percorso, 'r', encoding='utf-8') as f:
+            return [json.loads(riga) for riga in f if riga.strip()]
+    except FileNotFoundError:
+        return []
+
+def confronta(precedenti, nuovi, soglia):
+    """Stampa le differenze di p50/p99/memoria rispetto all'ultima misura con la stessa chiave"""
+    ultimi = {}
+    for r in precedenti:
+        ultimi[(r['backend'], r['dimensione'], r['operazione'])] = r
+    regressioni = 0
+    print(f"\n{'backend':<7} {'dim':>8} {'operazione':<20} {'p50 ms':>10} {'Δ':>8} {'p99 ms':>10} {'Δ':>8} {'mem KB':>10} {'Δ':>8}")
+    for r in nuovi:
+        prima = ultimi.get((r['backend'], r['dimensione'], r['operazione']))
+        celle = []
+        for campo in ('p50_ms', 'p99_ms', 'picco_mem_kb'):
+            valore = r.get(campo)
+            if valore is None:
+                celle.append(f"{'-':>10} {'':>8}")
+                continue
+            delta = ''
+            if prima and prima.get(campo):
+                variazione = (valore - prima[campo]) / prima[campo] * 100
+                delta = f"{variazione:+.0f}%"
+                # La memoria varia di più tra un'esecuzione e l'altra: soglia doppia
+                if variazione > (soglia * 2 if campo == 'picco_mem_kb' else soglia):
+                    delta += '⚠️'
+                    regressioni += 1
+            celle.append(f"{valore:>10.2f} {delta:>8}")
+        print(f"{r['backend']:<7} {r['dimensione']:>8} {r['operazione']:<20} " + " ".join(celle))
+    if regressioni:
+        print(f"\n⚠️ {regressioni} misure peggiorate oltre la soglia ({soglia}%)")
+    return regressioni
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dimensioni', default=DIMENSIONI_PREDEFINITE, help="numeri di noleggi separati da virgola")
+    parser.add_argument('--backend', default='json', help="json, sqlite, mensile o più di uno separati da virgola")
+    parser.add_argument('--ripetizioni', type=int, default=50, help="chiamate per le operazioni leggere")
+    parser.add_argument('--ripetizioni-pesanti', type=int, default=5, help="chiamate per export completo e snapshot")
+    parser.add_argument('--risultati', default=RISULTATI_FILE, help="file JSONL a cui aggiungere i risultati")
+    parser.add_argument('--confronta', action='store_true', help="confronta con l'ultima esecuzione nel file risultati")
+    parser.add_argument('--soglia', type=float, default=20, help="variazione %% oltre cui segnalare una regressione")
+    parser.add_argument('--singolo', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.singolo is not None:
+        esegui_singolo(args)
+        return
+
+    precedenti = leggi_risultati(args.risultati)
+    esecuzione = {'quando': datetime.now().isoformat(timespec='seconds'), 'commit': commit_corrente(),
+                  'python': sys.version.split()[0]}
+    nuovi = []
+    for backend in args.backend.split(','):
+        for dimensione in (int(d) for d in args.dimensioni.split(',')):
+            print(f"▶ {backend} – {dimensione} noleggi", file=sys.stderr)
+            with tempfile.TemporaryDirectory(prefix='noleggiosup-bench-') as cartella:
+                figlio = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--singolo', str(dimensione), '--dir', cartella,
+                     '--ripetizioni', str(args.ripetizioni), '--ripetizioni-pesanti', str(args.ripetizioni_pesanti)],
+                    env={**os.environ, 'STORAGE_BACKEND': backend}, stdout=subprocess.PIPE, text=True,
+                )
+            if figlio.returncode != 0:
+                print(f"❌ {backend} – {dimensione}: processo terminato con codice {figlio.returncode}", file=sys.stderr)
+                continue
+            for r in json.loads(figlio.stdout):
+                nuovi.append({**esecuzione, 'backend': backend, 'dimensione': dimensione, **r})
+
+    with open(args.risultati, 'a', encoding='utf-8') as f:
+        for r in nuovi:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+    print(f"\n📄 {len(nuovi)} misure aggiunte a {args.risultati}", file=sys.stderr)
+
+    if args.confronta:
+        sys.exit(1 if confronta(precedenti, nuovi, args.soglia) else 0)
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main_benchmark()
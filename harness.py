@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Harness offline per la modalità webhook del Bot Noleggio SUP.
+
+Invia via HTTP (POST su localhost) degli Update registrati al listener
+webhook e stampa le chiamate alla Bot API che il bot avrebbe fatto.
+Nessuna connessione a Telegram: le risposte della Bot API sono simulate
+da OfflineRequest.
+
+Uso:
+    python harness.py [updates.jsonl] [--dati DIR]
+    python harness.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret XYZ
+
+Senza --url avvia in-process l'Application con il listener su una porta
+libera; con --url invia soltanto i payload a un bot già in esecuzione in
+modalità webhook (RUN_MODE=webhook).
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import urllib.request
+from telegram.request import BaseRequest
+
+TOKEN_OFFLINE = '123456:OFFLINE'
+
+class OfflineRequest(BaseRequest):
+    """Trasporto finto per la Bot API: registra le chiamate e risponde in locale"""
+
+    def __init__(self):
+        self.chiamate = []
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if '/file/bot' in url:
+            # Download di un file (es. foto ricevuta)
+            self.chiamate.append(('download', {'url': url}))
+            return 200, b'\xff\xd8\xff\xe0OFFLINE-JPEG'
+
+        metodo = url.rsplit('/', 1)[-1]
+        parametri = request_data.parameters if request_data else {}
+        self.chiamate.append((metodo, parametri))
+        return 200, json.dumps({'ok': True, 'result': self._risultato(metodo, parametri)}).encode()
+
+    def _risultato(self, metodo, parametri):
+        if metodo == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'NoleggioSup',
+                    'username': 'noleggiosup_bot', 'can_join_groups': True,
+                    'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if metodo == 'getFile':
+            return {'file_id': parametri.get('file_id'), 'file_unique_id': 'u' + str(parametri.get('file_id')),
+                    'file_size': 16, 'file_path': f"photos/{parametri.get('file_id')}.jpg"}
+        if metodo.startswith(('send', 'edit')):
+            self._message_id += 1
+            messaggio = {'message_id': self._message_id, 'date': int(time.time()),
+                         'chat': {'id': parametri.get('chat_id', 1), 'type': 'private'}}
+            if 'text' in parametri:
+                messaggio['text'] = parametri['text']
+            return messaggio
+        return True
+
+def messaggio(update_id, testo, utente=1):
+    """Payload di un Update con un messaggio di testo (comandi inclusi)"""
+    payload = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': utente, 'type': 'private'},
+            'from': {'id': utente, 'is_bot': False, 'first_name': 'Operatore'},
+            'text': testo,
+        },
+    }
+    if testo.startswith('/'):
+        payload['message']['entities'] = [
+            {'type': 'bot_command', 'offset': 0, 'length': len(testo.split()[0])}
+        ]
+    return payload
+
+def callback(update_id, dati, utente=1):
+    """Payload di un Update con la pressione di un pulsante inline"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(utente),
+            'from': {'id': utente, 'is_bot': False, 'first_name': 'Operatore'},
+            'message': {'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': utente, 'type': 'private'}, 'text': '...'},
+            'data': dati,
+        },
+    }
+
+def updates_di_esempio():
+    """Una registrazione completa più le viste giornaliere"""
+    oggi = time.strftime('%d/%m/%Y')
+    passi = [
+        ('m', '/nuovo'), ('m', oggi), ('m', 'Rossi'), ('m', 'Mario'), ('c', 'doc_CI'),
+        ('m', 'AB12345'), ('m', '3331234567'), ('c', 'assoc_NO'), ('c', 'tipo_SUP'),
+        ('c', 'sup_Touring'), ('c', 'tempo_2h'), ('c', 'pag_CARD'), ('m', '25'),
+        ('c', 'foto_NO'), ('c', 'finito'), ('m', '/mostra_noleggi'), ('m', '/export'),
+    ]
+    return [messaggio(i, v) if t == 'm' else callback(i, v) for i, (t, v) in enumerate(passi, 1)]
+
+def leggi_updates(percorso):
+    with open(percorso, 'r', encoding='utf-8') as f:
+        return [json.loads(riga) for riga in f if riga.strip()]
+
+def posta(url, payload, secret):
+    richiesta = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), method='POST',
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret},
+    )
+    with urllib.request.urlopen(richiesta, timeout=10) as risposta:
+        return risposta.status
+
+async def replay_in_process(updates):
+    """Avvia Application + ServerWebhook offline e invia gli update via HTTP"""
+    import main
+
+    trasporto = OfflineRequest()
+    application = main.crea_application(TOKEN_OFFLINE, request=trasporto, webhook=True)
+    await application.initialize()
+    await application.start()
+    server = main.ServerWebhook(application, listen='127.0.0.1', port=0, secret=main.WEBHOOK_SECRET)
+    await server.avvia()
+    url = f"http://127.0.0.1:{server.port}{server.path}"
+
+    try:
+        for payload in updates:
+            stato = await asyncio.to_thread(posta, url, payload, server.secret)
+            # Attende la gestione prima del prossimo update, come farebbe Telegram
+            await application.update_queue.join()
+            print(f"→ update {payload.get('update_id')}: HTTP {stato}")
+            for metodo, parametri in trasporto.chiamate:
+                testo = str(parametri.get('text') or parametri.get('caption') or '').strip().splitlines()
+                print(f"    {metodo} {testo[0] if testo else ''}")
+            trasporto.chiamate.clear()
+    finally:
+        await server.ferma()
+        await application.stop()
+        await application.shutdown()
+        await main.post_shutdown(application)
+
+def main_harness():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('updates', nargs='?', help="file JSONL di Update registrati (default: flusso di esempio)")
+    parser.add_argument('--url', help="listener già in esecuzione a cui inviare gli update")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''), help="secret token del webhook")
+    parser.add_argument('--dati', help="cartella dati del bot (default: cartella temporanea)")
+    args = parser.parse_args()
+
+    updates = leggi_updates(args.updates) if args.updates else updates_di_esempio()
+
+    if args.url:
+        for payload in updates:
+            print(f"→ update {payload.get('update_id')}: HTTP {posta(args.url, payload, args.secret)}")
+        return
+
+    # Il bot usa percorsi relativi: lavora in una cartella a parte per non
+    # toccare i dati reali
+    os.chdir(args.dati or tempfile.mkdtemp(prefix='noleggiosup-'))
+    print(f"📁 Dati in {os.getcwd()}")
+    asyncio.run(replay_in_process(updates))
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main_harness()
@@ -7,14 +7,42 @@ Data creazione: 26 Luglio 2025
 Versione: 2.5 - SYNTAX FIXED + Noleggi multipli
 """
 
+import io
 import os
+import re
+import sys
 import csv
+import gzip
 import json
+import pstats
+import cProfile
+import tracemalloc
+import bisect
+import heapq
+import shutil
+import hashlib
+import functools
+import contextlib
+import itertools
+import time
+import queue
+import signal
+import secrets
+import asyncio
 import logging
-from datetime import datetime
-from collections import defaultdict
+import sqlite3
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi
+    fcntl = None
+from datetime import datetime, timedelta
+from enum import StrEnum
+from collections import defaultdict, OrderedDict
 from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler, BaseUpdateProcessor, BasePersistence, PersistenceInput
 
 # Configura logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -22,36 +50,2196 @@ logger = logging.getLogger(__name__)
 
 # Stati conversazione  
 (DATA, COGNOME, NOME, DOCUMENTO, NUMERO_DOCUMENTO, TELEFONO, ASSOCIATO, TIPO_NOLEGGIO, 
- DETTAGLI_SUP, DETTAGLI_LETTINO, LETTINO_NUMERO, TEMPO, PAGAMENTO, IMPORTO, FOTO_RICEVUTA, NOTE) = range(16)
+ DETTAGLI_SUP, DETTAGLI_LETTINO, LETTINO_NUMERO, TEMPO, PAGAMENTO, IMPORTO, FOTO_RICEVUTA, NOTE,
+ RICERCA_CLIENTE) = range(17)
+NOMI_STATI = dict(enumerate((
+    'DATA', 'COGNOME', 'NOME', 'DOCUMENTO', 'NUMERO_DOCUMENTO', 'TELEFONO', 'ASSOCIATO', 'TIPO_NOLEGGIO',
+    'DETTAGLI_SUP', 'DETTAGLI_LETTINO', 'LETTINO_NUMERO', 'TEMPO', 'PAGAMENTO', 'IMPORTO', 'FOTO_RICEVUTA', 'NOTE',
+    'RICERCA_CLIENTE')))
 
 # File e directory
 DATA_FILE = 'noleggi.json'
+JOURNAL_FILE = 'noleggi.journal.jsonl'
+DB_FILE = os.getenv('DB_FILE', 'noleggi.db')
 PHOTOS_DIR = 'ricevute_photos'
 os.makedirs(PHOTOS_DIR, exist_ok=True)
 
-class SupRentalBot:
-    def __init__(self):
+# Backend di archiviazione: 'mensile' (snapshot + journal per mese, caricati a
+# richiesta), 'json' (un unico snapshot + journal, tutto in memoria) oppure 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mensile').lower()
+
+# Punto noleggio di questo processo (es. 'Pineta', 'Squero'): salvato in ogni
+# noleggio registrato qui. Più processi (uno per sede) possono condividere lo
+# stesso archivio solo con STORAGE_BACKEND=sqlite: 'json' e 'mensile' tengono
+# tutto in memoria e si bloccano in esclusiva al primo processo che li apre.
+SEDE = os.getenv('SEDE', '').strip() or None
+
+# Ogni quanti secondi un processo applica ai propri indici i noleggi scritti dagli altri (solo sqlite)
+SINCRONIZZA_SECONDI = float(os.getenv('SINCRONIZZA_SECONDI', '2'))
+# FULL: un commit è su disco quando aggiungi_lotto ritorna (come il fsync del
+# journal negli altri backend). NORMAL è più veloce ma in WAL un commit può
+# perdersi per un'interruzione di corrente: la registrazione confermata non
+# sarebbe più garantita.
+SQLITE_SYNCHRONOUS = 'NORMAL' if os.getenv('SQLITE_SYNCHRONOUS', 'FULL').upper() == 'NORMAL' else 'FULL'
+# Attesa massima (s) del lock di scrittura SQLite quando un altro processo sta scrivendo
+SQLITE_ATTESA_LOCK_S = float(os.getenv('SQLITE_ATTESA_LOCK_S', '30'))
+
+def blocca_file(percorso, attendi=False):
+    """Lock esclusivo (flock) su un file di lock; restituisce il file aperto da tenere vivo.
+    
+    Con attendi=False solleva RuntimeError se un altro processo lo tiene già.
+    Il lock si libera chiudendo il file (o alla morte del processo).
+    """
+    f = open(percorso, 'a')
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if attendi else fcntl.LOCK_NB))
+    except BlockingIOError:
+        f.close()
+        raise RuntimeError(
+            f"{percorso} è già in uso da un altro processo: per più processi sullo "
+            f"stesso archivio usa STORAGE_BACKEND=sqlite"
+        ) from None
+    return f
+
+# Compatta il journal nello snapshot ogni N registrazioni
+JOURNAL_COMPACT_EVERY = int(os.getenv('JOURNAL_COMPACT_EVERY', '500'))
+
+# Group commit: attesa massima (ms) per raccogliere altre scritture nello stesso flush
+FLUSH_MAX_DELAY_MS = int(os.getenv('FLUSH_MAX_DELAY_MS', '20'))
+
+@functools.lru_cache(maxsize=8192)
+def giorno_iso(data):
+    """'26/07/2025' -> '2025-07-26' (ordinabile, usato per indici e intervalli).
+    
+    In cache: le date distinte sono poche e strptime è lento (import, indici).
+    """
+    try:
+        return datetime.strptime(data, '%d/%m/%Y').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return data or ''
+
+# Tutti i campi di un noleggio, nell'ordine delle colonne di export
+CAMPI_EXPORT = [
+    'data', 'cognome', 'nome', 'documento', 'numero_documento', 'telefono', 'associato',
+    'tipo_noleggio', 'dettagli', 'numero', 'tempo', 'pagamento', 'importo',
+    'foto_ricevuta', 'note', 'timestamp', 'foto_file_id', 'foto_file_unique_id', 'id', 'sede'
+]
+# Intestazioni CSV nello stile storico: Data, Cognome, ..., Tipo_Noleggio
+INTESTAZIONI_CSV = ['_'.join(p.capitalize() for p in campo.split('_')) for campo in CAMPI_EXPORT]
+
+class TipoNoleggio(StrEnum):
+    SUP = 'SUP'
+    KAYAK = 'KAYAK'
+    LETTINO = 'LETTINO'
+    PHONEBAG = 'PHONEBAG'
+    DRYBAG = 'DRYBAG'
+
+TIPO_ICONE = {"SUP": "🏄‍♂️", "KAYAK": "🚣‍♂️", "LETTINO": "🏖️", "PHONEBAG": "📱", "DRYBAG": "🎒"}
+
+class Pagamento(StrEnum):
+    CARD = 'CARD'
+    BONIFICO = 'BONIFICO'
+
+class Documento(StrEnum):
+    CI = 'CI'
+    PAT = 'PAT'
+    PASS = 'PASS'
+    ALTRO = 'ALTRO'
+
+class Associato(StrEnum):
+    SI = 'SÌ'
+    NO = 'NO'
+
+def _enum_o_testo(tipo, valore):
+    """Membro dell'enum se il valore è noto, altrimenti la stringa (internata) così com'è"""
+    try:
+        return tipo(valore)
+    except ValueError:
+        return sys.intern(valore) if isinstance(valore, str) else valore
+
+# ID noleggio: AAMMGG della data + 8 cifre esadecimali, es. '2507261f3a9c0b'.
+# Sta nei 64 byte del callback_data e dice già in quale giorno cercare.
+_RE_ID_NOLEGGIO = re.compile(r'^\d{6}[0-9a-f]{8}$')
+
+def id_noleggio(data, suffisso=None):
+    try:
+        prefisso = datetime.strptime(data, '%d/%m/%Y').strftime('%y%m%d')
+    except (TypeError, ValueError):
+        prefisso = '000000'
+    return prefisso + (suffisso or secrets.token_hex(4))
+
+def data_da_id(id_):
+    """Data DD/MM/YYYY codificata nell'ID (None per gli ID senza data)"""
+    try:
+        return datetime.strptime(id_[:6], '%y%m%d').strftime('%d/%m/%Y')
+    except ValueError:
+        return None
+
+def formatta_euro(cent):
+    return f"{cent // 100}.{cent % 100:02d} EUR"
+
+_RE_IMPORTO = re.compile(r'^(\d+)\.(\d\d) EUR$')
+_RE_TEMPO = re.compile(r'^(\d+)(,5)?h$')
+
+class Noleggio:
+    """Un noleggio in forma compatta: importo in centesimi, durata in minuti, enum internati.
+    
+    da_dict/a_dict convertono senza perdite dal/al formato JSON di noleggi.json;
+    i valori che non rispettano il formato standard (o campi sconosciuti)
+    vengono conservati tali e quali in _grezzi.
+    """
+    __slots__ = (
+        'data', 'cognome', 'nome', 'documento', 'numero_documento', 'telefono', 'associato',
+        'tipo_noleggio', 'dettagli', 'numero', 'minuti', 'pagamento', 'importo_cent',
+        'foto_ricevuta', 'note', 'timestamp', 'foto_file_id', 'foto_file_unique_id', 'id', 'sede', '_grezzi'
+    )
+    
+    CAMPI_TESTO = ('cognome', 'nome', 'numero_documento', 'telefono')
+    
+    @classmethod
+    def da_dict(cls, d):
+        n = cls.__new__(cls)
+        grezzi = {k: v for k, v in d.items() if k not in CAMPI_EXPORT}
+        
+        n.data = sys.intern(d.get('data', ''))
+        for campo in cls.CAMPI_TESTO:
+            setattr(n, campo, d.get(campo, ''))
+        n.documento = _enum_o_testo(Documento, d.get('documento', ''))
+        n.associato = _enum_o_testo(Associato, d.get('associato', ''))
+        n.tipo_noleggio = _enum_o_testo(TipoNoleggio, d.get('tipo_noleggio', ''))
+        n.pagamento = _enum_o_testo(Pagamento, d.get('pagamento', ''))
+        n.dettagli = sys.intern(d.get('dettagli') or '')
+        n.numero = sys.intern(d.get('numero') or '')
+        n.foto_ricevuta = d.get('foto_ricevuta')
+        n.foto_file_id = d.get('foto_file_id')
+        n.foto_file_unique_id = d.get('foto_file_unique_id')
+        n.note = d.get('note')
+        n.sede = sys.intern(d['sede']) if d.get('sede') else None
+        
+        importo = d.get('importo', '')
+        m = _RE_IMPORTO.match(importo or '')
+        n.importo_cent = int(m.group(1)) * 100 + int(m.group(2)) if m else None
+        if not m and importo != '':
+            grezzi['importo'] = importo
+        
+        tempo = d.get('tempo', '')
+        m = _RE_TEMPO.match(tempo or '')
+        n.minuti = int(m.group(1)) * 60 + (30 if m.group(2) else 0) if m else None
+        if not m:
+            grezzi['tempo'] = tempo
+        
+        timestamp = d.get('timestamp')
+        try:
+            n.timestamp = datetime.fromisoformat(timestamp)
+            if n.timestamp.isoformat() != timestamp:
+                grezzi['timestamp'] = timestamp
+        except (TypeError, ValueError):
+            n.timestamp = None
+            grezzi['timestamp'] = timestamp
+        
+        n._grezzi = grezzi or None
+        # I noleggi salvati prima degli ID ne ricevono uno stabile derivato dal contenuto
+        n.id = d.get('id') or id_noleggio(n.data, hashlib.sha1(
+            json.dumps(d, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:8])
+        return n
+    
+    @property
+    def importo(self):
+        """Importo nel formato storico, es. '25.00 EUR'"""
+        if self._grezzi and 'importo' in self._grezzi:
+            return self._grezzi['importo']
+        if self.importo_cent is None:
+            return ''
+        return formatta_euro(self.importo_cent)
+    
+    @property
+    def tempo(self):
+        """Durata nel formato storico, es. '1,5h'"""
+        if self._grezzi and 'tempo' in self._grezzi:
+            return self._grezzi['tempo']
+        ore, resto = divmod(self.minuti, 60)
+        return f"{ore},5h" if resto else f"{ore}h"
+    
+    @property
+    def timestamp_iso(self):
+        if self._grezzi and 'timestamp' in self._grezzi:
+            return self._grezzi['timestamp']
+        return self.timestamp.isoformat()
+    
+    def a_dict(self):
+        d = {
+            'data': self.data,
+            'cognome': self.cognome,
+            'nome': self.nome,
+            'documento': str(self.documento),
+            'numero_documento': self.numero_documento,
+            'telefono': self.telefono,
+            'associato': str(self.associato),
+            'tipo_noleggio': str(self.tipo_noleggio),
+            'dettagli': self.dettagli,
+            'numero': self.numero,
+            'tempo': self.tempo,
+            'pagamento': str(self.pagamento),
+            'importo': self.importo,
+            'foto_ricevuta': self.foto_ricevuta,
+            'note': self.note,
+            'timestamp': self.timestamp_iso,
+        }
+        d['id'] = self.id
+        # Campi aggiunti dopo la v2.5: presenti solo se valorizzati
+        if self.foto_file_id:
+            d['foto_file_id'] = self.foto_file_id
+            d['foto_file_unique_id'] = self.foto_file_unique_id
+        if self.sede:
+            d['sede'] = self.sede
+        if self._grezzi:
+            d.update((k, v) for k, v in self._grezzi.items() if k not in d)
+        return d
+
+def noleggi_univoci(dicts):
+    """Noleggi da dict in ordine di registrazione, con ID univoci tra quelli letti.
+    
+    Due noleggi storici identici (stesso giorno, cliente e campi, es. due SUP
+    uguali per lo stesso cliente) ricevono lo stesso ID derivato dal contenuto:
+    dal secondo in poi l'hash include anche la posizione nel giorno, stabile
+    perché l'ordine di registrazione non cambia. Gli ID non in conflitto
+    restano quelli di sempre.
+    """
+    visti = set()
+    posizioni = defaultdict(int)
+    for d in dicts:
+        n = Noleggio.da_dict(d)
+        posizione = posizioni[n.data]
+        posizioni[n.data] += 1
+        if n.id in visti:
+            n.id = id_noleggio(n.data, hashlib.sha1(
+                (json.dumps(d, sort_keys=True, ensure_ascii=False) + f"#{posizione}").encode()).hexdigest()[:8])
+        visti.add(n.id)
+        yield n
+
+class RentalStorage:
+    """Interfaccia comune dei backend di archiviazione noleggi"""
+    
+    # True se altri processi possono scrivere nello stesso archivio
+    condiviso = False
+    
+    def aggiungi(self, registrazione):
+        self.aggiungi_lotto([registrazione])
+    
+    def aggiungi_lotto(self, registrazioni):
+        """Scrive più noleggi con un solo flush su disco"""
+        raise NotImplementedError
+    
+    @contextlib.contextmanager
+    def in_blocco(self):
+        """Scritture in blocco (import): la manutenzione del backend può aspettare la fine"""
+        yield
+    
+    def per_data(self, data):
+        """Noleggi di una data (DD/MM/YYYY) in ordine di registrazione"""
+        raise NotImplementedError
+    
+    def iter_noleggi(self, dal=None, al=None):
+        """Itera i noleggi con giorno_iso compreso tra dal e al (inclusi)"""
+        raise NotImplementedError
+    
+    def conta(self):
+        raise NotImplementedError
+    
+    def modifiche(self):
+        """Noleggi scritti da altri processi dopo l'ultima chiamata (mai i propri)"""
+        return []
+    
+    def chiudi(self):
+        pass
+
+def salva_snapshot(percorso, noleggi):
+    """Scrive uno snapshot JSON in modo atomico (file temporaneo + rename)"""
+    tmp = percorso + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump([n.a_dict() for n in noleggi], f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, percorso)
+
+def voci_journal(percorso):
+    """Voci di un journal JSONL, fino all'eventuale ultima riga troncata"""
+    try:
+        with open(percorso, 'r', encoding='utf-8') as f:
+            for riga in f:
+                try:
+                    yield json.loads(riga)
+                except json.JSONDecodeError:
+                    # Ultima riga troncata da un crash durante la scrittura
+                    logger.warning("Journal: riga incompleta ignorata")
+                    return
+    except FileNotFoundError:
+        return
+
+def leggi_partizione(data_file, journal_file):
+    """Snapshot + coda del journal in sola lettura: nessun recupero né riscrittura su disco.
+    
+    ValueError se lo snapshot è illeggibile (lo gestisce JournalStorage al caricamento).
+    """
+    try:
+        with open(data_file, 'r', encoding='utf-8') as f:
+            noleggi = list(noleggi_univoci(json.load(f)))
+    except FileNotFoundError:
+        noleggi = []
+    for voce in voci_journal(journal_file):
+        if voce['seq'] >= len(noleggi):
+            noleggi.append(Noleggio.da_dict(voce['noleggio']))
+    return noleggi
+
+class JournalStorage(RentalStorage):
+    """Snapshot JSON + journal JSONL append-only, tutto in memoria.
+    
+    Un solo processo alla volta: la numerazione del journal e le compattazioni
+    partono dalla copia in memoria, quindi un secondo scrittore perderebbe
+    noleggi. Per questo il costruttore prende un lock esclusivo su
+    <data_file>.lock (esclusivo=False per le partizioni, già protette dal lock
+    della cartella).
+    """
+    
+    def __init__(self, data_file=DATA_FILE, journal_file=JOURNAL_FILE, esclusivo=True):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self._file_lock = blocca_file(data_file + '.lock') if esclusivo else None
+        self._lock = threading.Lock()
+        self._compattazione = None
+        self._in_journal = 0
+        self._sospesa = False
         self.noleggi = self.load_data()
+        self._per_data = defaultdict(list)
+        for n in self.noleggi:
+            self._per_data[n.data].append(n)
+        self._journal = open(self.journal_file, 'a', encoding='utf-8')
     
     def load_data(self):
+        """Carica lo snapshot e riapplica la coda del journal"""
+        noleggi = self._leggi_snapshot()
+        recuperati = 0
+        
+        for voce in voci_journal(self.journal_file):
+            if voce['seq'] < len(noleggi):
+                continue  # Già incluso nello snapshot
+            if voce['seq'] > len(noleggi):
+                logger.warning(f"Journal: buco di sequenza ({len(noleggi)} -> {voce['seq']})")
+            noleggi.append(Noleggio.da_dict(voce['noleggio']))
+            recuperati += 1
+        
+        if recuperati:
+            logger.info(f"Journal: recuperati {recuperati} noleggi")
+            self.save_data(noleggi)
+            self._riscrivi_journal([], len(noleggi))
+        
+        return noleggi
+    
+    def _leggi_snapshot(self):
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                return list(noleggi_univoci(json.load(f)))
+        except FileNotFoundError:
             logger.info("Creo nuovo database")
             return []
+        except json.JSONDecodeError as e:
+            # Non sovrascrivere mai uno snapshot illeggibile: lo mette da parte
+            corrotto = f"{self.data_file}.corrotto-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            os.replace(self.data_file, corrotto)
+            logger.error(f"Snapshot illeggibile ({e}), spostato in {corrotto}")
+            return []
+    
+    def save_data(self, noleggi=None):
+        """Scrive lo snapshot completo in modo atomico (file temporaneo + rename)"""
+        salva_snapshot(self.data_file, self.noleggi if noleggi is None else noleggi)
+    
+    def _riscrivi_journal(self, noleggi, seq_iniziale):
+        """Sostituisce il journal con le sole voci non ancora nello snapshot"""
+        tmp = self.journal_file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for seq, noleggio in enumerate(noleggi, seq_iniziale):
+                f.write(json.dumps({'seq': seq, 'noleggio': noleggio.a_dict()}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_file)
+    
+    def aggiungi_lotto(self, registrazioni):
+        """Aggiunge noleggi in coda al journal (O(1) ciascuno, un solo fsync)"""
+        with self._lock:
+            righe = [
+                json.dumps({'seq': seq, 'noleggio': r.a_dict()}, ensure_ascii=False) + '\n'
+                for seq, r in enumerate(registrazioni, len(self.noleggi))
+            ]
+            self._journal.write(''.join(righe))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            for registrazione in registrazioni:
+                self.noleggi.append(registrazione)
+                self._per_data[registrazione.data].append(registrazione)
+            
+            self._in_journal += len(registrazioni)
+            self._forse_compatta()
     
-    def save_data(self):
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.noleggi, f, ensure_ascii=False, indent=2)
+    def _forse_compatta(self):
+        """Avvia la compattazione se il journal è abbastanza lungo (con self._lock)"""
+        if self._sospesa or self._in_journal < JOURNAL_COMPACT_EVERY:
+            return
+        if self._compattazione and self._compattazione.is_alive():
+            return
+        self._in_journal = 0
+        self._compattazione = threading.Thread(
+            target=self._compatta, args=(len(self.noleggi),), daemon=True
+        )
+        self._compattazione.start()
+    
+    def sospendi_compattazione(self):
+        with self._lock:
+            self._sospesa = True
+    
+    def riprendi_compattazione(self):
+        with self._lock:
+            self._sospesa = False
+            self._forse_compatta()
+    
+    @contextlib.contextmanager
+    def in_blocco(self):
+        # Un import a lotti farebbe uno snapshot completo per lotto: uno solo alla fine
+        self.sospendi_compattazione()
+        try:
+            yield
+        finally:
+            self.riprendi_compattazione()
+    
+    def _compatta(self, n):
+        """Thread: snapshot dei primi n noleggi, poi accorcia il journal"""
+        try:
+            self.save_data(self.noleggi[:n])
+            with self._lock:
+                self._journal.close()
+                self._riscrivi_journal(self.noleggi[n:], n)
+                self._journal = open(self.journal_file, 'a', encoding='utf-8')
+            logger.info(f"Journal compattato ({n} noleggi nello snapshot)")
+        except Exception as e:
+            logger.error(f"Errore compattazione journal: {e}")
+    
+    def per_data(self, data):
+        with self._lock:
+            return list(self._per_data.get(data, ()))
+    
+    def iter_noleggi(self, dal=None, al=None):
+        # Copia della lista: le scritture concorrenti non alterano l'iterazione
+        with self._lock:
+            noleggi = list(self.noleggi)
+        for n in noleggi:
+            giorno = giorno_iso(n.data)
+            if (dal is None or giorno >= dal) and (al is None or giorno <= al):
+                yield n
+    
+    def conta(self):
+        return len(self.noleggi)
+    
+    def chiudi(self):
+        if self._compattazione is not None:
+            self._compattazione.join()
+        with self._lock:
+            self._journal.close()
+        if self._file_lock is not None:
+            self._file_lock.close()
+
+class SQLiteStorage(RentalStorage):
+    """SQLite in modalità WAL con indici su data, cliente, telefono e documento.
+    
+    Il record completo resta in JSON nella colonna 'dati' (stesso formato di
+    noleggi.json); le colonne a parte servono solo per gli indici.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS noleggi (
+            rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+            giorno TEXT NOT NULL,
+            cognome TEXT NOT NULL DEFAULT '',
+            nome TEXT NOT NULL DEFAULT '',
+            telefono TEXT NOT NULL DEFAULT '',
+            numero_documento TEXT NOT NULL DEFAULT '',
+            dati TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_noleggi_giorno ON noleggi(giorno);
+        CREATE INDEX IF NOT EXISTS idx_noleggi_cliente ON noleggi(cognome, nome);
+        CREATE INDEX IF NOT EXISTS idx_noleggi_telefono ON noleggi(telefono);
+        CREATE INDEX IF NOT EXISTS idx_noleggi_documento ON noleggi(numero_documento);
+    """
+    
+    condiviso = True
+    
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        # Con più processi le scritture si serializzano sul lock di SQLite: si attende invece di fallire
+        self.conn = sqlite3.connect(db_file, timeout=SQLITE_ATTESA_LOCK_S, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        self._propri = []  # intervalli di rowid scritti da questo processo dopo l'ultima modifiche()
+        
+        # Schema e migrazione dei dati vecchi: un processo alla volta, gli altri
+        # attendono e trovano il database già pieno
+        with contextlib.closing(blocca_file(db_file + '.lock', attendi=True)):
+            self.conn.executescript(self.SCHEMA)
+            if self.conta() == 0:
+                if os.path.exists(DATA_FILE) or os.path.exists(JOURNAL_FILE):
+                    self.migra_da_json()
+                elif os.path.isdir(PARTIZIONI_DIR) and os.listdir(PARTIZIONI_DIR):
+                    self.migra_da_partizioni()
+        
+        # Punto di partenza di modifiche(): quello che c'è ora è già visibile a chi legge
+        self._versione = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self._ultimo_rowid = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM noleggi").fetchone()[0]
+    
+    @staticmethod
+    def _riga(registrazione):
+        return (
+            giorno_iso(registrazione.data),
+            registrazione.cognome,
+            registrazione.nome,
+            registrazione.telefono,
+            registrazione.numero_documento,
+            json.dumps(registrazione.a_dict(), ensure_ascii=False),
+        )
+    
+    def _inserisci(self, registrazioni):
+        """INSERT nella transazione corrente (con self._lock), senza commit"""
+        self.conn.executemany(
+            "INSERT INTO noleggi (giorno, cognome, nome, telefono, numero_documento, dati) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self._riga(r) for r in registrazioni)
+        )
+    
+    def aggiungi_lotto(self, registrazioni):
+        if not registrazioni:
+            return
+        with self._lock, self.conn:
+            self._inserisci(registrazioni)
+            # Nella stessa transazione (lock di scrittura tenuto) i rowid sono consecutivi
+            ultimo = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self._propri.append((ultimo - len(registrazioni) + 1, ultimo))
+    
+    def migra_da_json(self):
+        """Importa noleggi.json (+ journal) in un database vuoto"""
+        sorgente = JournalStorage()
+        with self._lock, self.conn:
+            self._inserisci(sorgente.noleggi)
+        sorgente.chiudi()
+        logger.info(f"Migrati {len(sorgente.noleggi)} noleggi da {DATA_FILE} a SQLite")
+    
+    def migra_da_partizioni(self, lotto=5000):
+        """Importa le partizioni mensili un mese alla volta (memoria limitata dall'LRU).
+        
+        Un'unica transazione: se si interrompe il database resta vuoto e la
+        migrazione riparte da capo al prossimo avvio.
+        """
+        sorgente = PartitionedStorage()
+        totale = 0
+        with self._lock, self.conn:
+            noleggi = sorgente.iter_noleggi()
+            while blocco := list(itertools.islice(noleggi, lotto)):
+                self._inserisci(blocco)
+                totale += len(blocco)
+        sorgente.chiudi()
+        logger.info(f"Migrati {totale} noleggi da {PARTIZIONI_DIR}/ a SQLite")
+    
+    def _query(self, sql, parametri=()):
+        with self._lock:
+            righe = self.conn.execute(sql, parametri).fetchall()
+        return list(noleggi_univoci(json.loads(riga[0]) for riga in righe))
+    
+    def per_data(self, data):
+        return self._query("SELECT dati FROM noleggi WHERE giorno = ? ORDER BY rowid", (giorno_iso(data),))
+    
+    def iter_noleggi(self, dal=None, al=None):
+        # Connessione di sola lettura dedicata (WAL): le righe arrivano in
+        # streaming senza bloccare le scritture
+        lettura = sqlite3.connect(self.db_file, timeout=SQLITE_ATTESA_LOCK_S, check_same_thread=False)
+        try:
+            cursore = lettura.execute(
+                "SELECT dati FROM noleggi WHERE giorno >= ? AND giorno <= ? ORDER BY rowid",
+                (dal or '', al or '\uffff')
+            )
+            yield from noleggi_univoci(json.loads(dati) for (dati,) in cursore)
+        finally:
+            lettura.close()
+    
+    def conta(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM noleggi").fetchone()[0]
+    
+    def modifiche(self):
+        """Noleggi scritti da altri processi dopo l'ultima chiamata, in ordine di scrittura.
+        
+        PRAGMA data_version cambia solo per i commit di altre connessioni: se
+        è fermo nessun altro ha scritto e non si legge la tabella. I rowid
+        crescono nell'ordine dei commit (SQLite ha un solo scrittore alla
+        volta), quindi basta leggere dopo l'ultimo visto saltando i propri.
+        """
+        with self._lock:
+            versione = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            propri, self._propri = self._propri, []
+            if versione == self._versione:
+                if propri:
+                    self._ultimo_rowid = max(self._ultimo_rowid, propri[-1][1])
+                return []
+            self._versione = versione
+            righe = self.conn.execute(
+                "SELECT rowid, dati FROM noleggi WHERE rowid > ? ORDER BY rowid", (self._ultimo_rowid,)
+            ).fetchall()
+            if righe:
+                self._ultimo_rowid = righe[-1][0]
+        return [Noleggio.da_dict(json.loads(dati)) for rowid, dati in righe
+                if not any(primo <= rowid <= ultimo for primo, ultimo in propri)]
+    
+    def chiudi(self):
+        with self._lock:
+            self.conn.close()
+
+# Storico a partizioni mensili: in memoria solo i mesi usati di recente
+PARTIZIONI_DIR = os.getenv('PARTIZIONI_DIR', 'noleggi_mensili')
+PARTIZIONI_MEMORIA_MB = int(os.getenv('PARTIZIONI_MEMORIA_MB', '64'))
+# Occupazione stimata di un noleggio in memoria (oggetto + indice per data), misurata con tracemalloc
+BYTE_PER_NOLEGGIO = 700
+MESE_SENZA_DATA = 'altro'
+_RE_PARTIZIONE = re.compile(r'^(\d{4}-\d{2}|' + MESE_SENZA_DATA + r')\.(json|journal\.jsonl)$')
+
+def mese_di(data):
+    """'26/07/2025' -> '2025-07'; date non valide finiscono in una partizione a parte"""
+    giorno = giorno_iso(data)
+    return giorno[:7] if re.match(r'^\d{4}-\d{2}-\d{2}$', giorno) else MESE_SENZA_DATA
+
+class PartitionedStorage(RentalStorage):
+    """Una partizione JournalStorage (snapshot + journal) per mese, caricata a richiesta.
+    
+    All'avvio si legge solo il mese corrente; gli altri si caricano al primo
+    accesso (giorno passato, export, indicizzazione) e restano in un LRU
+    finché la stima della memoria non supera PARTIZIONI_MEMORIA_MB. Il mese
+    di oggi e quello di ieri non vengono mai scaricati, né le partizioni con
+    una scrittura in corso. I conteggi per mese stanno in conteggi.json
+    (riscritto ad ogni flush), così conta() non deve caricare niente. Come JournalStorage, un solo processo
+    alla volta (lock esclusivo su <cartella>.lock).
+    """
+    
+    def __init__(self, cartella=PARTIZIONI_DIR, memoria_mb=PARTIZIONI_MEMORIA_MB):
+        self.cartella = cartella
+        self.budget = memoria_mb * 1048576
+        self._lock = threading.Lock()
+        self._lock_caricamento = threading.Lock()
+        self._cache = OrderedDict()  # mese -> JournalStorage, dal meno recente
+        self._in_scrittura = defaultdict(int)
+        self._in_blocco = False
+        self._lock_conteggi = threading.Lock()
+        # Fuori dalla cartella: la migrazione la crea con un rename
+        self._file_lock = blocca_file(os.path.normpath(cartella) + '.lock')
+        
+        if not self._leggi_mesi() and (os.path.exists(DATA_FILE) or os.path.exists(JOURNAL_FILE)):
+            self.migra_da_json()
+        os.makedirs(cartella, exist_ok=True)
+        self._conteggi = self._leggi_conteggi()
+        self._mesi = self._leggi_mesi()
+        self._ricostruisci_conteggi()
+        self._partizione(mese_di(data_oggi()))
+    
+    def _leggi_mesi(self):
+        try:
+            return {m.group(1) for m in map(_RE_PARTIZIONE.match, os.listdir(self.cartella)) if m}
+        except FileNotFoundError:
+            return set()
+    
+    def _file(self, mese):
+        return (os.path.join(self.cartella, f"{mese}.json"),
+                os.path.join(self.cartella, f"{mese}.journal.jsonl"))
+    
+    def _leggi_conteggi(self):
+        try:
+            with open(os.path.join(self.cartella, 'conteggi.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            # Solo un'ottimizzazione: _ricostruisci_conteggi rilegge i mesi mancanti
+            logger.warning(f"Conteggi delle partizioni non leggibili ({e})")
+            return {}
+    
+    def _ricostruisci_conteggi(self):
+        """Conta i mesi assenti da conteggi.json leggendone i file (senza passare dall'LRU).
+        
+        Un conteggio rimasto indietro per un crash tra il journal e conteggi.json
+        si corregge invece al primo caricamento della partizione.
+        """
+        mancanti = [mese for mese in self._mesi if mese not in self._conteggi]
+        for mese in mancanti:
+            try:
+                self._conteggi[mese] = len(leggi_partizione(*self._file(mese)))
+            except ValueError:
+                self._conteggi[mese] = self._partizione(mese).conta()
+        if mancanti:
+            logger.info(f"Conteggi ricostruiti per {len(mancanti)} partizioni")
+            self._salva_conteggi()
+    
+    def _salva_conteggi(self):
+        with self._lock_conteggi:
+            with self._lock:
+                conteggi = dict(self._conteggi)
+            percorso = os.path.join(self.cartella, 'conteggi.json')
+            with open(percorso + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(conteggi, f, sort_keys=True)
+            os.replace(percorso + '.tmp', percorso)
+    
+    def migra_da_json(self):
+        """Divide noleggi.json (+ journal) per mese; i file originali restano come *.migrato.
+        
+        Le partizioni si scrivono in una cartella temporanea che prende il posto
+        di quella definitiva con un solo rename: se la migrazione si interrompe
+        non resta un elenco di mesi parziale e al prossimo avvio si ricomincia.
+        """
+        sorgente = JournalStorage()
+        per_mese = defaultdict(list)
+        for noleggio in sorgente.noleggi:
+            per_mese[mese_di(noleggio.data)].append(noleggio)
+        sorgente.chiudi()
+        
+        tmp = os.path.normpath(self.cartella) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        conteggi = {}
+        for mese, noleggi in per_mese.items():
+            salva_snapshot(os.path.join(tmp, f"{mese}.json"), noleggi)
+            conteggi[mese] = len(noleggi)
+        with open(os.path.join(tmp, 'conteggi.json'), 'w', encoding='utf-8') as f:
+            json.dump(conteggi, f, sort_keys=True)
+        # Senza mesi (altrimenti non si migrerebbe): al più conteggi.json o file temporanei
+        shutil.rmtree(self.cartella, ignore_errors=True)
+        os.replace(tmp, self.cartella)
+        for percorso in (DATA_FILE, JOURNAL_FILE):
+            if os.path.exists(percorso):
+                os.replace(percorso, percorso + '.migrato')
+        logger.info(f"Migrati {len(sorgente.noleggi)} noleggi da {DATA_FILE} in {len(per_mese)} partizioni mensili")
+    
+    def _protetti(self):
+        adesso = datetime.now()
+        return {adesso.strftime('%Y-%m'), (adesso - timedelta(days=1)).strftime('%Y-%m')}
+    
+    def _partizione(self, mese):
+        """Partizione del mese, caricata dal disco se non è in memoria"""
+        with self._lock:
+            partizione = self._cache.get(mese)
+            if partizione is not None:
+                self._cache.move_to_end(mese)
+                return partizione
+        # Un caricamento alla volta, senza bloccare chi usa le partizioni già in memoria
+        with self._lock_caricamento:
+            with self._lock:
+                partizione = self._cache.get(mese)
+                if partizione is not None:
+                    self._cache.move_to_end(mese)
+                    return partizione
+            inizio = time.perf_counter()
+            partizione = JournalStorage(*self._file(mese), esclusivo=False)
+            metriche.osserva('partizione_caricata_ms', (time.perf_counter() - inizio) * 1000)
+            if self._in_blocco:
+                partizione.sospendi_compattazione()
+            with self._lock:
+                self._cache[mese] = partizione
+                self._mesi.add(mese)
+                self._conteggi[mese] = partizione.conta()
+                scaricate = self._libera()
+            # Chiuse prima di altri caricamenti: mai due copie dello stesso mese che scrivono
+            for vecchia in scaricate:
+                vecchia.chiudi()
+        return partizione
+    
+    def _libera(self):
+        """Toglie dall'LRU i mesi meno usati finché la stima sta nel budget (con self._lock)"""
+        protetti = self._protetti()
+        stima = sum(len(p.noleggi) for p in self._cache.values()) * BYTE_PER_NOLEGGIO
+        scaricate = []
+        for mese in list(self._cache)[:-1]:  # l'ultima è quella appena usata
+            if stima <= self.budget:
+                break
+            if mese in protetti or self._in_scrittura[mese]:
+                continue
+            partizione = self._cache.pop(mese)
+            stima -= len(partizione.noleggi) * BYTE_PER_NOLEGGIO
+            scaricate.append(partizione)
+        if scaricate:
+            metriche.conta('partizioni_scaricate', len(scaricate))
+        return scaricate
+    
+    def aggiungi_lotto(self, registrazioni):
+        per_mese = defaultdict(list)
+        for registrazione in registrazioni:
+            per_mese[mese_di(registrazione.data)].append(registrazione)
+        for mese, lotto in per_mese.items():
+            with self._lock:
+                self._in_scrittura[mese] += 1
+            try:
+                self._partizione(mese).aggiungi_lotto(lotto)
+                with self._lock:
+                    self._conteggi[mese] = self._conteggi.get(mese, 0) + len(lotto)
+            finally:
+                with self._lock:
+                    self._in_scrittura[mese] -= 1
+        self._salva_conteggi()
+    
+    @contextlib.contextmanager
+    def in_blocco(self):
+        self._in_blocco = True
+        for partizione in self._in_cache():
+            partizione.sospendi_compattazione()
+        try:
+            yield
+        finally:
+            # Le partizioni scaricate nel frattempo si compattano al prossimo caricamento
+            self._in_blocco = False
+            for partizione in self._in_cache():
+                partizione.riprendi_compattazione()
+    
+    def _in_cache(self):
+        with self._lock:
+            return list(self._cache.values())
+    
+    def per_data(self, data):
+        return self._partizione(mese_di(data)).per_data(data)
+    
+    def iter_noleggi(self, dal=None, al=None):
+        # Solo i mesi che possono contenere l'intervallo, uno alla volta attraverso l'LRU
+        with self._lock:
+            mesi = sorted(self._mesi)
+        for mese in mesi:
+            if mese != MESE_SENZA_DATA and ((dal and mese < dal[:7]) or (al and mese > al[:7])):
+                continue
+            noleggi = self._leggi_fuori_cache(mese)
+            if noleggi is None:
+                yield from self._partizione(mese).iter_noleggi(dal, al)
+                continue
+            for n in noleggi:
+                giorno = giorno_iso(n.data)
+                if (dal is None or giorno >= dal) and (al is None or giorno <= al):
+                    yield n
+    
+    def _leggi_fuori_cache(self, mese):
+        """Noleggi di un mese non in memoria letti dai file, senza caricarlo nell'LRU.
+        
+        Se tutto lo storico sta nel budget si passa dall'LRU (le scansioni
+        successive lo trovano in memoria); altrimenti le scansioni (export
+        completo, indicizzazione all'avvio) leggono i file direttamente e non
+        scaricano i mesi usati dagli handler. None = usare la partizione.
+        """
+        # Sotto _lock_caricamento nessuno carica il mese (né lo compatta) durante la lettura
+        with self._lock_caricamento:
+            with self._lock:
+                if mese in self._cache or sum(self._conteggi.values()) * BYTE_PER_NOLEGGIO <= self.budget:
+                    return None
+            try:
+                return leggi_partizione(*self._file(mese))
+            except ValueError:
+                return None
+    
+    def in_memoria(self):
+        """Mesi attualmente caricati, dal meno recente"""
+        with self._lock:
+            return list(self._cache)
+    
+    def conta(self):
+        with self._lock:
+            return sum(self._conteggi.values())
+    
+    def chiudi(self):
+        for partizione in self._in_cache():
+            partizione.chiudi()
+        self._salva_conteggi()
+        self._file_lock.close()
+
+# Limiti superiori (ms) dei bucket degli istogrammi di latenza
+BUCKET_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Istogramma:
+    __slots__ = ('conteggi', 'somma', 'numero', 'massimo')
+    
+    def __init__(self):
+        self.conteggi = [0] * (len(BUCKET_MS) + 1)  # l'ultimo è +Inf
+        self.somma = 0.0
+        self.numero = 0
+        self.massimo = 0.0
+    
+    def osserva(self, ms):
+        self.conteggi[bisect.bisect_left(BUCKET_MS, ms)] += 1
+        self.somma += ms
+        self.numero += 1
+        self.massimo = max(self.massimo, ms)
+    
+    @property
+    def media(self):
+        return self.somma / self.numero if self.numero else 0.0
+    
+    def quantile(self, q):
+        """Limite superiore del bucket che contiene il quantile q"""
+        soglia = q * self.numero
+        cumulato = 0
+        for limite, conteggio in zip(BUCKET_MS + (float('inf'),), self.conteggi):
+            cumulato += conteggio
+            if cumulato >= soglia:
+                return min(limite, self.massimo)
+        return self.massimo
+
+class Metriche:
+    """Istogrammi di latenza e contatori con etichette, aggiornabili da qualsiasi thread"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.avvio = time.time()
+        self.istogrammi = {}  # (nome, etichette) -> Istogramma
+        self.contatori = defaultdict(int)  # (nome, etichette) -> valore
+    
+    def osserva(self, nome, ms, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            istogramma = self.istogrammi.get(chiave)
+            if istogramma is None:
+                istogramma = self.istogrammi[chiave] = Istogramma()
+            istogramma.osserva(ms)
+    
+    def conta(self, nome, quanto=1, **etichette):
+        with self._lock:
+            self.contatori[(nome, tuple(sorted(etichette.items())))] += quanto
+    
+    def istogrammi_di(self, nome):
+        with self._lock:
+            return [(dict(etichette), h) for (n, etichette), h in self.istogrammi.items() if n == nome]
+    
+    def contatori_di(self, nome):
+        with self._lock:
+            return [(dict(etichette), v) for (n, etichette), v in self.contatori.items() if n == nome]
+    
+    def prometheus(self, indicatori):
+        """Formato testo di Prometheus (istogrammi in ms, più gli indicatori istantanei passati)"""
+        def valore_etichetta(v):
+            # Escape richiesti dal formato testo: backslash, virgolette e a capo
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        
+        def etichette_testo(etichette, extra=()):
+            coppie = list(etichette) + list(extra)
+            if not coppie:
+                return ''
+            return '{' + ','.join(f'{k}="{valore_etichetta(v)}"' for k, v in coppie) + '}'
+        
+        righe = []
+        with self._lock:
+            for nome in sorted({n for n, _ in self.istogrammi}):
+                righe.append(f"# TYPE noleggiosup_{nome} histogram")
+                for (n, etichette), h in self.istogrammi.items():
+                    if n != nome:
+                        continue
+                    cumulato = 0
+                    for limite, conteggio in zip(BUCKET_MS + ('+Inf',), h.conteggi):
+                        cumulato += conteggio
+                        righe.append(f"noleggiosup_{nome}_bucket{etichette_testo(etichette, [('le', limite)])} {cumulato}")
+                    righe.append(f"noleggiosup_{nome}_sum{etichette_testo(etichette)} {h.somma:.3f}")
+                    righe.append(f"noleggiosup_{nome}_count{etichette_testo(etichette)} {h.numero}")
+            for nome in sorted({n for n, _ in self.contatori}):
+                righe.append(f"# TYPE noleggiosup_{nome}_total counter")
+                for (n, etichette), valore in self.contatori.items():
+                    if n == nome:
+                        righe.append(f"noleggiosup_{nome}_total{etichette_testo(etichette)} {valore}")
+        for nome, valore in indicatori.items():
+            righe.append(f"# TYPE noleggiosup_{nome} gauge")
+            righe.append(f"noleggiosup_{nome} {valore}")
+        return '\n'.join(righe) + '\n'
+
+metriche = Metriche()
+
+# Profilazione a richiesta (/profilo o variabili d'ambiente), senza riavviare il bot
+PROFILO_DIR = os.getenv('PROFILO_DIR', 'profili')
+PROFILO_HANDLER = os.getenv('PROFILO_HANDLER', 'handle_callback,salva_registrazione_callback,export_csv')
+PROFILO_SECONDI = int(os.getenv('PROFILO_SECONDI', '300'))
+PROFILO_ALL_AVVIO = os.getenv('PROFILO_ALL_AVVIO', '0') == '1'
+PROFILO_MEMORIA = os.getenv('PROFILO_MEMORIA', '1') == '1'  # tracemalloc rallenta tutto il processo
+PROFILO_FRAME = 10
+PROFILO_RIGHE = 40
+
+class Profilatore:
+    """Finestra di profilazione: cProfile sugli handler scelti, tracemalloc su tutto il processo.
+    
+    cProfile è attivo solo mentre gira almeno un handler selezionato (contatore
+    di annidamento: handle_callback che chiama salva_registrazione_callback non
+    lo riavvia). Mentre un handler è in await il loop può eseguire altri
+    update, che finiscono nello stesso profilo: è un campionamento, non una
+    misura esatta per handler. Le funzioni eseguite nei thread (to_thread)
+    hanno un profilo a parte, unito a quello principale alla chiusura.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.noti = set()  # nomi selezionabili
+        self.handler = frozenset()
+        self.inizio = self.scadenza = None
+        self.destinatari = ()
+        self._profilo = None
+        self._profili_thread = []
+        self._annidati = 0
+        self._thread_loop = None
+        self._chiamate = defaultdict(int)
+        self._snapshot = None
+        self._tracemalloc_nostro = False
+        self._job = None
+    
+    @property
+    def attivo(self):
+        return self._profilo is not None
+    
+    def avvia(self, application, handler, secondi, destinatari):
+        """Apre la finestra; alla scadenza un job della JobQueue scrive e invia il rapporto"""
+        if self.attivo:
+            return False
+        self.handler = frozenset(handler)
+        self.destinatari = tuple(destinatari)
+        self.inizio = time.time()
+        self.scadenza = self.inizio + secondi
+        self._chiamate.clear()
+        self._profili_thread = []
+        self._annidati = 0
+        self._profilo = cProfile.Profile()
+        if PROFILO_MEMORIA:
+            self._tracemalloc_nostro = not tracemalloc.is_tracing()
+            if self._tracemalloc_nostro:
+                tracemalloc.start(PROFILO_FRAME)
+            self._snapshot = tracemalloc.take_snapshot()
+        if application.job_queue is not None:
+            self._job = application.job_queue.run_once(self._scaduto, secondi, name='profilo')
+        logger.info(f"Profilazione avviata per {secondi}s su: {', '.join(sorted(self.handler))}")
+        return True
+    
+    def entra(self, nome):
+        """Da chiamare nel thread del loop all'ingresso di un handler; restituisce il profilo da passare a esci()"""
+        if self._profilo is None or nome not in self.handler:
+            return None
+        if time.time() > self.scadenza:
+            # JobQueue assente o in ritardo: non allunga la finestra
+            return None
+        self._chiamate[nome] += 1
+        if self._annidati == 0:
+            self._thread_loop = threading.get_ident()
+            self._profilo.enable()
+        self._annidati += 1
+        return self._profilo
+    
+    def esci(self, profilo):
+        if profilo is None or profilo is not self._profilo:
+            return  # finestra chiusa mentre l'handler girava
+        self._annidati -= 1
+        if self._annidati == 0:
+            profilo.disable()
+    
+    def profila_sincrona(self, nome, funzione, *args, **kwargs):
+        """Profilo separato per funzioni sincrone (anche nei thread di to_thread)"""
+        if self._profilo is None or nome not in self.handler or time.time() > self.scadenza \
+                or (self._annidati and threading.get_ident() == self._thread_loop):
+            # Fuori finestra, oppure già coperta dal profilo dell'handler che la chiama
+            return funzione(*args, **kwargs)
+        profilo = cProfile.Profile()
+        profilo.enable()
+        try:
+            return funzione(*args, **kwargs)
+        finally:
+            profilo.disable()
+            with self._lock:
+                self._profili_thread.append(profilo)
+    
+    async def _scaduto(self, context):
+        self._job = None
+        await self.concludi(context.bot)
+    
+    async def concludi(self, bot):
+        """Chiude la finestra, scrive .pstats e .txt in PROFILO_DIR e invia il rapporto ai destinatari"""
+        if not self.attivo:
+            return None
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        profilo, self._profilo = self._profilo, None
+        if self._annidati:
+            profilo.disable()
+            self._annidati = 0
+        fine = time.time()
+        snapshot = memoria = None
+        if self._snapshot is not None:
+            snapshot = tracemalloc.take_snapshot()
+            memoria = tracemalloc.get_traced_memory()
+            if self._tracemalloc_nostro:
+                tracemalloc.stop()
+        iniziale, self._snapshot = self._snapshot, None
+        with self._lock:
+            profili = [profilo] + self._profili_thread
+            self._profili_thread = []
+        
+        testo, percorso = await asyncio.to_thread(
+            self._rapporto, profili, dict(self._chiamate), fine, iniziale, snapshot, memoria)
+        logger.info(f"Profilazione conclusa: rapporto in {percorso}")
+        
+        chiamate = sum(self._chiamate.values())
+        for chat_id in self.destinatari:
+            try:
+                await bot.send_document(
+                    chat_id, document=testo.encode('utf-8'), filename=os.path.basename(percorso),
+                    caption=f"🔬 Profilo di {fine - self.inizio:.0f}s: {chiamate} chiamate profilate"
+                )
+            except Exception as e:
+                logger.error(f"Invio rapporto di profilazione a {chat_id} fallito: {e}")
+        return percorso
+    
+    def _rapporto(self, profili, chiamate, fine, iniziale, snapshot, memoria):
+        os.makedirs(PROFILO_DIR, exist_ok=True)
+        base = os.path.join(PROFILO_DIR, f"profilo_{datetime.fromtimestamp(self.inizio):%Y%m%d_%H%M%S}")
+        righe = [
+            f"Profilo {datetime.fromtimestamp(self.inizio):%d/%m/%Y %H:%M:%S} → "
+            f"{datetime.fromtimestamp(fine):%H:%M:%S} ({fine - self.inizio:.0f}s)",
+            f"Handler: {', '.join(sorted(self.handler))}",
+            "Chiamate: " + (', '.join(f"{n} {c}" for n, c in sorted(chiamate.items(), key=lambda x: -x[1])) or "nessuna"),
+        ]
+        if memoria is not None:
+            righe.append(f"Memoria tracciata: attuale {memoria[0] / 1048576:.1f} MB, picco {memoria[1] / 1048576:.1f} MB")
+        
+        # pstats rifiuta i profili vuoti
+        stats = None
+        for profilo in profili:
+            profilo.create_stats()
+            if not profilo.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profilo, stream=io.StringIO())
+            else:
+                stats.add(profilo)
+        if stats is not None:
+            stats.dump_stats(base + '.pstats')
+            for ordine, quante in (('cumulative', PROFILO_RIGHE), ('tottime', PROFILO_RIGHE // 2)):
+                stats.stream = io.StringIO()
+                stats.sort_stats(ordine).print_stats(quante)
+                righe += ["", f"=== cProfile per {ordine} (prime {quante}) ===", stats.stream.getvalue().strip()]
+        else:
+            righe += ["", "=== cProfile: nessuna chiamata profilata nella finestra ==="]
+        
+        if snapshot is not None:
+            escludi = (tracemalloc.Filter(False, tracemalloc.__file__),
+                       tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                       tracemalloc.Filter(False, "<unknown>"))
+            snapshot = snapshot.filter_traces(escludi)
+            iniziale = iniziale.filter_traces(escludi)
+            righe += ["", f"=== tracemalloc: siti con più memoria allocata nella finestra (prime {PROFILO_RIGHE // 2}) ==="]
+            righe += [str(diff) for diff in snapshot.compare_to(iniziale, 'lineno')[:PROFILO_RIGHE // 2]]
+            righe += ["", "=== tracemalloc: stack delle allocazioni maggiori ==="]
+            for diff in snapshot.compare_to(iniziale, 'traceback')[:3]:
+                righe.append(f"{diff.size_diff / 1024:+.1f} KiB in {diff.count_diff:+d} blocchi:")
+                righe += diff.traceback.format(limit=PROFILO_FRAME, most_recent_first=True)
+        
+        testo = "\n".join(righe) + "\n"
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(testo)
+        return testo, base + '.txt'
+
+profilatore = Profilatore()
+
+def profilato(nome=None):
+    """Rende una funzione selezionabile da /profilo con il nome indicato (default il suo)"""
+    def decora(funzione):
+        chiave = nome or funzione.__name__
+        profilatore.noti.add(chiave)
+        if asyncio.iscoroutinefunction(funzione):
+            @functools.wraps(funzione)
+            async def avvolta(*args, **kwargs):
+                profilo = profilatore.entra(chiave)
+                try:
+                    return await funzione(*args, **kwargs)
+                finally:
+                    profilatore.esci(profilo)
+        else:
+            @functools.wraps(funzione)
+            def avvolta(*args, **kwargs):
+                return profilatore.profila_sincrona(chiave, funzione, *args, **kwargs)
+        return avvolta
+    return decora
+
+class ScrittorePersistenza:
+    """Thread dedicato alle scritture su disco con group commit.
+    
+    Gli handler attendono un future che si risolve solo quando il loro
+    noleggio è stato scritto (fsync/commit); le richieste che arrivano entro
+    FLUSH_MAX_DELAY_MS dalla prima finiscono nello stesso flush.
+    """
+    
+    def __init__(self, storage, max_delay_ms=FLUSH_MAX_DELAY_MS):
+        self.storage = storage
+        self.max_delay = max_delay_ms / 1000
+        self._coda = queue.Queue()
+        self._thread = None
+    
+    def avvia(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._ciclo, name='scrittore', daemon=True)
+            self._thread.start()
+    
+    async def scrivi(self, registrazione):
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self.avvia()
+        self._coda.put((registrazione, futuro, loop))
+        await futuro
+    
+    def ferma(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._coda.put(None)
+            self._thread.join()
+    
+    def _ciclo(self):
+        while True:
+            primo = self._coda.get()
+            if primo is None:
+                return
+            
+            lotto = [primo]
+            fine = False
+            scadenza = time.monotonic() + self.max_delay
+            while True:
+                attesa = scadenza - time.monotonic()
+                try:
+                    voce = self._coda.get(timeout=attesa) if attesa > 0 else self._coda.get_nowait()
+                except queue.Empty:
+                    break
+                if voce is None:
+                    fine = True
+                    break
+                lotto.append(voce)
+            
+            errore = None
+            inizio = time.perf_counter()
+            try:
+                self.storage.aggiungi_lotto([registrazione for registrazione, _, _ in lotto])
+            except Exception as e:
+                logger.error(f"Errore flush ({len(lotto)} noleggi): {e}")
+                metriche.conta('flush_errori', tipo='noleggi')
+                errore = e
+            metriche.osserva('flush_ms', (time.perf_counter() - inizio) * 1000, tipo='noleggi')
+            metriche.conta('flush_noleggi', len(lotto))
+            
+            for _, futuro, loop in lotto:
+                loop.call_soon_threadsafe(self._risolvi, futuro, errore)
+            
+            if fine:
+                return
+    
+    @staticmethod
+    def _risolvi(futuro, errore):
+        if futuro.done():
+            return
+        if errore is None:
+            futuro.set_result(None)
+        else:
+            futuro.set_exception(errore)
+
+def crea_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteStorage()
+    if STORAGE_BACKEND == 'json':
+        # Dopo un avvio con 'mensile' noleggi.json è diventato *.migrato: non
+        # ripartire da un archivio vuoto
+        if not os.path.exists(DATA_FILE) and os.path.exists(DATA_FILE + '.migrato'):
+            raise RuntimeError(
+                f"{DATA_FILE} è già stato migrato nelle partizioni di {PARTIZIONI_DIR}/: "
+                f"usa STORAGE_BACKEND=mensile (o sqlite, che le importa)"
+            )
+        return JournalStorage()
+    return PartitionedStorage()
+
+def data_oggi():
+    return datetime.now().strftime('%d/%m/%Y')
+
+def chiave_cliente(noleggio):
+    return f"{noleggio.cognome} {noleggio.nome}"
+
+class CassaGiorno:
+    """Totali di cassa di un giorno, aggiornati ad ogni noleggio (lettura O(1))"""
+    __slots__ = ('conteggio', 'totale_cent', 'senza_importo', 'per_pagamento', 'per_tipo', 'per_associato')
+    
+    def __init__(self):
+        self.conteggio = 0
+        self.totale_cent = 0
+        self.senza_importo = 0
+        # valore -> [numero noleggi, centesimi]
+        self.per_pagamento = {}
+        self.per_tipo = {}
+        self.per_associato = {}
+    
+    def aggiungi(self, noleggio):
+        cent = noleggio.importo_cent or 0
+        self.conteggio += 1
+        self.totale_cent += cent
+        if noleggio.importo_cent is None:
+            self.senza_importo += 1
+        for totali, chiave in ((self.per_pagamento, noleggio.pagamento),
+                               (self.per_tipo, noleggio.tipo_noleggio),
+                               (self.per_associato, noleggio.associato)):
+            voce = totali.setdefault(chiave, [0, 0])
+            voce[0] += 1
+            voce[1] += cent
+
+class IndiceGiorno:
+    """Noleggi di un giorno: lista in ordine di registrazione + raggruppamento per cliente"""
+    __slots__ = ('noleggi', 'clienti', 'cassa', 'versione', 'versioni_clienti', '_ordinati', '_render')
+    
+    def __init__(self, noleggi=()):
+        self.noleggi = []
+        self.clienti = {}  # "cognome nome" -> [noleggi], in ordine di primo noleggio
+        self.cassa = CassaGiorno()
+        self.versione = 0
+        self.versioni_clienti = {}  # "cognome nome" -> versione, cresce ad ogni suo noleggio
+        self._ordinati = None
+        self._render = {}  # chiave -> (versione, messaggio già costruito)
+        for noleggio in noleggi:
+            self.aggiungi(noleggio)
+    
+    def aggiungi(self, noleggio):
+        self.noleggi.append(noleggio)
+        self.clienti.setdefault(chiave_cliente(noleggio), []).append(noleggio)
+        self.cassa.aggiungi(noleggio)
+        self.versione += 1
+        nome = chiave_cliente(noleggio)
+        self.versioni_clienti[nome] = self.versioni_clienti.get(nome, 0) + 1
+    
+    def clienti_ordinati(self):
+        """(clienti in ordine alfabetico, chiavi per bisect, iniziali presenti).
+        
+        Ricalcolato solo quando il giorno ha ricevuto nuovi noleggi.
+        """
+        if self._ordinati is None or self._ordinati[0] != self.versione:
+            ordinati = sorted(self.clienti.items(), key=lambda c: c[0].casefold())
+            chiavi = [nome.casefold() for nome, _ in ordinati]
+            iniziali = sorted({chiave[:1].upper() for chiave in chiavi if chiave[:1].isalpha()})
+            self._ordinati = (self.versione, ordinati, chiavi, iniziali)
+        return self._ordinati[1:]
+    
+    def renderizzato(self, chiave, versione, costruisci):
+        """Messaggio in cache per 'chiave'; ricostruito solo se la versione è cambiata"""
+        voce = self._render.get(chiave)
+        if voce is None or voce[0] != versione:
+            voce = self._render[chiave] = (versione, costruisci())
+        return voce[1]
+
+# Ricerca clienti abituali: caratteri minimi del prefisso e pulsanti mostrati
+RICERCA_MIN_CARATTERI = 3
+RICERCA_MAX_RISULTATI = 8
+
+def solo_cifre(testo):
+    return re.sub(r'\D', '', testo or '')
+
+def documento_normalizzato(testo):
+    """'ab 123.45' -> 'AB12345' (confronto indipendente da spazi e punteggiatura)"""
+    return re.sub(r'[^0-9A-Z]', '', (testo or '').upper())
+
+class RegistroClienti:
+    """Clienti già visti, cercabili per prefisso di telefono o numero documento.
+    
+    Per ogni cliente (nome + documento) tiene il noleggio più recente, da cui
+    si ricopiano i dati anagrafici. Telefoni e documenti stanno in due liste
+    ordinate di (chiave, cliente): la ricerca per prefisso è un bisect.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profili = {}  # (cognome nome, documento) -> noleggio più recente
+        self._telefoni = []
+        self._documenti = []
+        self._chiavi = set()
+    
+    def __len__(self):
+        return len(self._profili)
+    
+    def aggiungi(self, noleggio):
+        cliente = (chiave_cliente(noleggio).casefold(), documento_normalizzato(noleggio.numero_documento))
+        recente = (giorno_iso(noleggio.data), noleggio.timestamp_iso or '')
+        with self._lock:
+            attuale = self._profili.get(cliente)
+            if attuale is None or recente >= (giorno_iso(attuale.data), attuale.timestamp_iso or ''):
+                self._profili[cliente] = noleggio
+            for chiavi, chiave in ((self._telefoni, solo_cifre(noleggio.telefono)), (self._documenti, cliente[1])):
+                if chiave and (chiave, cliente) not in self._chiavi:
+                    self._chiavi.add((chiave, cliente))
+                    bisect.insort(chiavi, (chiave, cliente))
+    
+    def cerca(self, testo, limite=RICERCA_MAX_RISULTATI):
+        """Noleggi più recenti dei clienti il cui telefono o documento inizia con 'testo'"""
+        trovati = {}
+        with self._lock:
+            for chiavi, prefisso in ((self._telefoni, solo_cifre(testo)), (self._documenti, documento_normalizzato(testo))):
+                if len(prefisso) < RICERCA_MIN_CARATTERI:
+                    continue
+                i = bisect.bisect_left(chiavi, (prefisso,))
+                while i < len(chiavi) and chiavi[i][0].startswith(prefisso) and len(trovati) < limite:
+                    trovati.setdefault(chiavi[i][1], self._profili[chiavi[i][1]])
+                    i += 1
+        return list(trovati.values())
+
+# /cerca: termini più corti di così cercano solo token identici (es. numero tavola '7')
+RICERCA_MIN_PREFISSO = 2
+CERCA_PER_PAGINA = int(os.getenv('CERCA_PER_PAGINA', '10'))
+
+_RE_TOKEN = re.compile(r'\w+')
+
+def token_ricerca(testo):
+    return _RE_TOKEN.findall(str(testo or '').casefold())
+
+class IndiceRicerca:
+    """Indice invertito token -> noleggi su tutto lo storico.
+    
+    Ogni noleggio riceve un numero progressivo; le posting list sono liste di
+    numeri crescenti. I token stanno anche in una lista ordinata, così un
+    termine della ricerca vale come prefisso (bisect) e più termini vanno in AND.
+    """
+    
+    # Sotto questa soglia i termini successivi filtrano i candidati con i loro
+    # token invece di unire le posting list di tutti i token col prefisso
+    FILTRO_CANDIDATI_MAX = 2000
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []  # numero progressivo -> id noleggio
+        self._token_di = []  # numero progressivo -> token del noleggio
+        self._visti = set()
+        self._postings = {}  # token -> [numeri progressivi]
+        self._token = []  # token in ordine, per la ricerca per prefisso
+        self._token_nuovi = []  # ordinati insieme agli altri alla prossima ricerca
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    @staticmethod
+    def token_noleggio(noleggio):
+        token = set()
+        for campo in (noleggio.cognome, noleggio.nome, noleggio.telefono, noleggio.numero_documento,
+                      noleggio.numero, noleggio.note, noleggio.tipo_noleggio, noleggio.dettagli):
+            token.update(token_ricerca(campo))
+        # Telefono e documento anche tutti attaccati: '333 1234567' si trova con '3331234'
+        token.add(solo_cifre(noleggio.telefono))
+        token.add(documento_normalizzato(noleggio.numero_documento).casefold())
+        token.discard('')
+        return token
+    
+    def aggiungi(self, noleggio):
+        token = self.token_noleggio(noleggio)
+        with self._lock:
+            if noleggio.id in self._visti:
+                return
+            self._visti.add(noleggio.id)
+            numero = len(self._ids)
+            self._ids.append(noleggio.id)
+            self._token_di.append(tuple(token))
+            for t in token:
+                posting = self._postings.get(t)
+                if posting is None:
+                    posting = self._postings[t] = []
+                    self._token_nuovi.append(t)
+                posting.append(numero)
+    
+    def _numeri_per_termine(self, termine):
+        if len(termine) < RICERCA_MIN_PREFISSO:
+            return set(self._postings.get(termine, ()))
+        if self._token_nuovi:
+            # Un solo sort (quasi tutto già in ordine) invece di un insort per token
+            self._token.extend(self._token_nuovi)
+            self._token.sort()
+            self._token_nuovi = []
+        trovati = set()
+        i = bisect.bisect_left(self._token, termine)
+        while i < len(self._token) and self._token[i].startswith(termine):
+            trovati.update(self._postings[self._token[i]])
+            i += 1
+        return trovati
+    
+    def cerca(self, testo):
+        """ID dei noleggi che contengono tutti i termini, dal più recente"""
+        # I termini più lunghi sono i più selettivi: si parte da quelli
+        termini = sorted(set(token_ricerca(testo)), key=len, reverse=True)
+        if not termini:
+            return []
+        with self._lock:
+            risultato = None
+            for termine in termini:
+                if risultato is not None and len(risultato) <= self.FILTRO_CANDIDATI_MAX:
+                    esatto = len(termine) < RICERCA_MIN_PREFISSO
+                    risultato = {numero for numero in risultato
+                                 if any(t == termine if esatto else t.startswith(termine)
+                                        for t in self._token_di[numero])}
+                else:
+                    trovati = self._numeri_per_termine(termine)
+                    risultato = trovati if risultato is None else risultato & trovati
+                if not risultato:
+                    return []
+            return [self._ids[numero] for numero in sorted(risultato, reverse=True)]
+
+# Inventario: tipo -> modello -> numero di unità oppure elenco dei numeri.
+# Si personalizza con un file JSON nello stesso formato (INVENTARIO_FILE).
+INVENTARIO_FILE = os.getenv('INVENTARIO_FILE', 'inventario.json')
+INVENTARIO_PREDEFINITO = {
+    "SUP": {"All-around": 4, "Touring": 4, "Race": 2, "Surf": 2, "Yoga": 2},
+    "KAYAK": {"Standard": 4},
+    "LETTINO": {"Pineta": 20, "Squero": 20},
+    "PHONEBAG": {"": 20},
+    "DRYBAG": {"": 20},
+}
+
+def carica_inventario(percorso=INVENTARIO_FILE):
+    try:
+        with open(percorso, 'r', encoding='utf-8') as f:
+            inventario = json.load(f)
+        logger.info(f"Inventario caricato da {percorso}")
+        return inventario
+    except FileNotFoundError:
+        return INVENTARIO_PREDEFINITO
+    except (OSError, ValueError) as e:
+        logger.error(f"Inventario {percorso} non leggibile ({e}), uso quello predefinito")
+        return INVENTARIO_PREDEFINITO
+
+INVENTARIO = carica_inventario()
+
+def numero_unita(numero):
+    """'07' e '7' sono la stessa unità; le lettere dei lettini restano come sono"""
+    numero = str(numero or '').strip().upper()
+    return numero.lstrip('0') or '0' if numero.isdigit() else numero
+
+def unita_modello(tipo, modello):
+    """Unità in inventario per tipo/modello (None se non configurato)"""
+    unita = INVENTARIO.get(str(tipo), {}).get(modello or '')
+    if isinstance(unita, list):
+        return len(unita)
+    return unita if isinstance(unita, int) else None
+
+def fine_noleggio(noleggio):
+    """Rientro previsto: registrazione + durata (None se mancano i dati)"""
+    if noleggio.timestamp is None or noleggio.minuti is None:
+        return None
+    return noleggio.timestamp + timedelta(minutes=noleggio.minuti)
+
+class IndiceAttivi:
+    """Noleggi in corso adesso, per tipo/modello e per singola unità.
+    
+    Un heap ordinato per rientro previsto fa scadere i noleggi finiti: ogni
+    noleggio entra ed esce una volta sola (O(log n)), e le domande "cosa è
+    fuori?" / "questa unità è libera?" leggono solo i dizionari dei noleggi
+    attivi, senza scorrere la lista del giorno.
+    """
+    
+    def __init__(self):
+        self.data = None  # giorno a cui si riferisce l'indice
+        self._heap = []  # (rientro previsto, id)
+        self._attivi = {}  # id -> (noleggio, rientro previsto)
+        self._per_modello = {}  # (tipo, modello) -> {id: noleggio}
+        self._per_unita = {}  # (tipo, modello, numero) -> {id: noleggio}
+        self.rientrati = set()  # rientrati prima del previsto: non tornano attivi
+    
+    def ricostruisci(self, data, noleggi, adesso):
+        rientrati = self.rientrati
+        self.__init__()
+        self.rientrati = rientrati
+        self.data = data
+        for noleggio in noleggi:
+            self.aggiungi(noleggio, adesso)
+    
+    def aggiungi(self, noleggio, adesso):
+        fine = fine_noleggio(noleggio)
+        if fine is None or fine <= adesso or noleggio.data != self.data or noleggio.id in self._attivi \
+                or noleggio.id in self.rientrati:
+            return
+        modello = (str(noleggio.tipo_noleggio), noleggio.dettagli)
+        self._attivi[noleggio.id] = (noleggio, fine)
+        heapq.heappush(self._heap, (fine, noleggio.id))
+        self._per_modello.setdefault(modello, {})[noleggio.id] = noleggio
+        if noleggio.numero:
+            self._per_unita.setdefault(modello + (numero_unita(noleggio.numero),), {})[noleggio.id] = noleggio
+    
+    def rientrato(self, id_):
+        self.rientrati.add(id_)
+        self.rimuovi(id_)
+    
+    def rimuovi(self, id_):
+        voce = self._attivi.pop(id_, None)
+        if voce is None:
+            return
+        noleggio = voce[0]
+        modello = (str(noleggio.tipo_noleggio), noleggio.dettagli)
+        for indice, chiave in ((self._per_modello, modello),
+                               (self._per_unita, modello + (numero_unita(noleggio.numero),))):
+            gruppo = indice.get(chiave)
+            if gruppo is not None:
+                gruppo.pop(id_, None)
+                if not gruppo:
+                    del indice[chiave]
+    
+    def scadi(self, adesso):
+        """Toglie i noleggi con rientro previsto già passato"""
+        while self._heap and self._heap[0][0] <= adesso:
+            _, id_ = heapq.heappop(self._heap)
+            self.rimuovi(id_)
+    
+    def rientro(self, id_):
+        return self._attivi[id_][1]
+    
+    def occupata(self, tipo, modello, numero):
+        """Noleggi in corso sulla stessa unità"""
+        return list(self._per_unita.get((str(tipo), modello or '', numero_unita(numero)), {}).values())
+    
+    def per_modello(self):
+        return self._per_modello
+
+# Giorni con indice in memoria (viste, cassa, ricerca per ID)
+GIORNI_IN_MEMORIA = int(os.getenv('GIORNI_IN_MEMORIA', '62'))
+
+class SupRentalBot:
+    def __init__(self, storage=None):
+        self.storage = storage or crea_storage()
+        self.scrittore = ScrittorePersistenza(self.storage)
+        # Serializza le modifiche agli indici condivisi: gli handler ora girano
+        # in parallelo e alcune letture avvengono in thread (export)
+        self._lock = threading.RLock()
+        # data -> IndiceGiorno, caricato dallo storage al primo accesso e poi
+        # aggiornato ad ogni nuovo noleggio (mai più una scansione dello storico).
+        # LRU: oltre GIORNI_IN_MEMORIA si scartano i giorni usati meno di recente
+        self._giorni = OrderedDict()
+        # id -> Noleggio per i giorni già in memoria
+        self._per_id = {}
+        # Cresce ad ogni noleggio indicizzato: un giorno letto dallo storage
+        # mentre cambiava va riletto (la lettura avviene fuori dal lock)
+        self._generazione = 0
+        # Indici sull'intero storico, costruiti con una sola scansione
+        self.clienti = RegistroClienti()
+        self.ricerca = IndiceRicerca()
+        self._indici_caricati = False
+        self._lock_indici = threading.Lock()
+        # Noleggi con foto su Telegram ma senza file in PHOTOS_DIR (download
+        # interrotto da un riavvio), trovati durante la scansione degli indici
+        self.foto_mancanti = []
+        self.attivi = IndiceAttivi()
+    
+    async def aggiungi_noleggio(self, registrazione):
+        """Scrive il noleggio fuori dall'event loop e aggiorna gli indici quando è su disco"""
+        await self.scrittore.scrivi(registrazione)
+        with self._lock:
+            giorno = self._giorni.get(registrazione.data)
+            # Il giorno può essere stato caricato dallo storage dopo la scrittura
+            self._generazione += 1
+            if giorno is not None and registrazione.id not in self._per_id:
+                giorno.aggiungi(registrazione)
+                self._per_id[registrazione.id] = registrazione
+        self.clienti.aggiungi(registrazione)
+        self.ricerca.aggiungi(registrazione)
+        with self._lock:
+            if self.attivi.data == registrazione.data:
+                self.attivi.aggiungi(registrazione, datetime.now())
+    
+    def aggiungi_storico(self, noleggi):
+        """Import in blocco: un solo flush per lotto, indici aggiornati, nessun promemoria di rientro"""
+        self.storage.aggiungi_lotto(noleggi)
+        self._indicizza(noleggi)
+    
+    def _indicizza(self, noleggi):
+        """Aggiorna gli indici in memoria con noleggi già su disco (import o altri processi)"""
+        adesso = datetime.now()
+        with self._lock:
+            self._generazione += 1
+            for noleggio in noleggi:
+                giorno = self._giorni.get(noleggio.data)
+                # Il giorno può essere stato caricato dallo storage dopo la scrittura
+                if giorno is not None and noleggio.id not in self._per_id:
+                    giorno.aggiungi(noleggio)
+                    self._per_id[noleggio.id] = noleggio
+                if self.attivi.data == noleggio.data:
+                    self.attivi.aggiungi(noleggio, adesso)
+        # Anche se l'indicizzazione iniziale è in corso: entrambi gli indici ignorano i doppioni
+        for noleggio in noleggi:
+            self.clienti.aggiungi(noleggio)
+            self.ricerca.aggiungi(noleggio)
+    
+    async def sincronizza(self):
+        """Applica agli indici i noleggi registrati da altri processi sullo stesso archivio"""
+        nuovi = await asyncio.to_thread(self.storage.modifiche)
+        if nuovi:
+            self._indicizza(nuovi)
+            metriche.conta('noleggi_sincronizzati', len(nuovi))
+            logger.info(f"Sincronizzati {len(nuovi)} noleggi da altri processi")
+        return nuovi
+    
+    def giorno(self, data):
+        """Indice del giorno; se non è in memoria lo legge dallo storage (I/O fuori dal lock)"""
+        while True:
+            with self._lock:
+                giorno = self._giorni.get(data)
+                if giorno is not None:
+                    self._giorni.move_to_end(data)
+                    return giorno
+                generazione = self._generazione
+            noleggi = self.storage.per_data(data)
+            with self._lock:
+                giorno = self._giorni.get(data)
+                if giorno is not None:
+                    return giorno
+                if generazione == self._generazione:
+                    giorno = self._giorni[data] = IndiceGiorno(noleggi)
+                    self._per_id.update((n.id, n) for n in giorno.noleggi)
+                    self._libera_giorni()
+                    return giorno
+    
+    async def carica_giorno(self, data):
+        """giorno() per gli handler: un giorno non in memoria si legge in un thread"""
+        with self._lock:
+            in_memoria = data in self._giorni
+        return self.giorno(data) if in_memoria else await asyncio.to_thread(self.giorno, data)
+    
+    def _libera_giorni(self):
+        if len(self._giorni) <= GIORNI_IN_MEMORIA:
+            return
+        adesso = datetime.now()
+        protetti = {adesso.strftime('%d/%m/%Y'), (adesso - timedelta(days=1)).strftime('%d/%m/%Y')}
+        for data in list(self._giorni)[:-1]:
+            if len(self._giorni) <= GIORNI_IN_MEMORIA:
+                break
+            if data not in protetti:
+                for noleggio in self._giorni.pop(data).noleggi:
+                    self._per_id.pop(noleggio.id, None)
+    
+    def trova(self, id_):
+        """Noleggio per ID in O(1); se il giorno non è in memoria lo carica (la data è nell'ID)"""
+        with self._lock:
+            noleggio = self._per_id.get(id_)
+        if noleggio is None and (data := data_da_id(id_)):
+            self.giorno(data)
+            with self._lock:
+                noleggio = self._per_id.get(id_)
+        return noleggio
+    
+    async def trova_caricando(self, id_):
+        """trova() per gli handler: il giorno da caricare si legge in un thread"""
+        with self._lock:
+            noleggio = self._per_id.get(id_)
+        return noleggio if noleggio is not None else await asyncio.to_thread(self.trova, id_)
+    
+    def _carica_indici(self):
+        with self._lock_indici:
+            if self._indici_caricati:
+                return
+            inizio = time.perf_counter()
+            su_disco = set(os.listdir(PHOTOS_DIR))
+            for noleggio in self.storage.iter_noleggi():
+                self.clienti.aggiungi(noleggio)
+                self.ricerca.aggiungi(noleggio)
+                if noleggio.foto_file_id and noleggio.foto_ricevuta and noleggio.foto_ricevuta not in su_disco:
+                    self.foto_mancanti.append(noleggio)
+            self._indici_caricati = True
+            logger.info(f"Indici caricati: {len(self.ricerca)} noleggi, {len(self.clienti)} clienti "
+                        f"in {time.perf_counter() - inizio:.1f}s")
+    
+    async def indici_pronti(self):
+        """Indicizza lo storico in un thread (all'avvio o alla prima ricerca)"""
+        if not self._indici_caricati:
+            await asyncio.to_thread(self._carica_indici)
+    
+    async def cerca_clienti(self, testo):
+        """Clienti abituali per prefisso di telefono/documento"""
+        await self.indici_pronti()
+        return self.clienti.cerca(testo)
+    
+    async def cerca(self, testo):
+        """ID dei noleggi di tutto lo storico che contengono tutti i termini"""
+        await self.indici_pronti()
+        return self.ricerca.cerca(testo)
+    
+    def noleggi_attivi(self):
+        """Indice dei noleggi in corso adesso (ricostruito solo al cambio di giorno)"""
+        with self._lock:
+            adesso = datetime.now()
+            oggi = data_oggi()
+            if self.attivi.data != oggi:
+                self.attivi.ricostruisci(oggi, self.giorno(oggi).noleggi, adesso)
+            self.attivi.scadi(adesso)
+            return self.attivi
+    
+    def rientrato(self, id_):
+        """Unità rientrata prima del previsto: di nuovo libera"""
+        with self._lock:
+            self.attivi.rientrato(id_)
+    
+    def noleggi_cliente(self, data, nome_completo):
+        return self.giorno(data).clienti.get(nome_completo, [])
     
     def get_noleggi_oggi(self):
         """Restituisce solo i noleggi di oggi"""
-        oggi = datetime.now().strftime('%d/%m/%Y')
-        return [n for n in self.noleggi if n['data'] == oggi]
+        return self.giorno(data_oggi()).noleggi
+    
+    def chiudi(self):
+        self.scrittore.ferma()
+        self.storage.chiudi()
 
 bot_instance = SupRentalBot()
 
+# Download foto ricevute in background
+FOTO_WORKERS = int(os.getenv('FOTO_WORKERS', '2'))
+FOTO_CODA_MAX = int(os.getenv('FOTO_CODA_MAX', '100'))
+FOTO_TENTATIVI = int(os.getenv('FOTO_TENTATIVI', '5'))
+# Foto mancanti dopo un riavvio: riscaricate da sole solo se del noleggio di
+# oggi o degli ultimi N giorni, le altre restano tra i falliti di /foto_stato
+FOTO_RECUPERO_GIORNI = int(os.getenv('FOTO_RECUPERO_GIORNI', '1'))
+
+class CodaDownload:
+    """Pool limitato di worker che scaricano le foto ricevute con retry e backoff.
+    
+    handle_photo accoda e risponde subito all'operatore; i download falliti
+    dopo FOTO_TENTATIVI restano elencati in /foto_stato (la foto resta comunque
+    visibile tramite file_id). La coda vive in memoria: all'avvio recupera()
+    riprende le foto dei noleggi rimasti senza file.
+    """
+    
+    def __init__(self, workers=FOTO_WORKERS, maxsize=FOTO_CODA_MAX, tentativi=FOTO_TENTATIVI):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.tentativi = tentativi
+        self._coda = None
+        self._tasks = []
+        self.in_corso = {}  # filename -> file_id
+        self.falliti = {}   # filename -> (file_id, errore)
+    
+    def _avvia(self):
+        if self._coda is None:
+            self._coda = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker(), name='download-foto'))
+    
+    async def accoda(self, bot, file_id, filename):
+        self._avvia()
+        self.in_corso[filename] = file_id
+        self.falliti.pop(filename, None)
+        # Coda piena: attende un posto libero (backpressure) invece di perdere la foto
+        await self._coda.put((bot, file_id, filename))
+    
+    async def _worker(self):
+        while True:
+            bot, file_id, filename = await self._coda.get()
+            try:
+                await self._scarica(bot, file_id, filename)
+            finally:
+                self._coda.task_done()
+    
+    async def _scarica(self, bot, file_id, filename):
+        filepath = os.path.join(PHOTOS_DIR, filename)
+        for tentativo in range(1, self.tentativi + 1):
+            try:
+                file = await bot.get_file(file_id)
+                await file.download_to_drive(filepath)
+                self.in_corso.pop(filename, None)
+                return
+            except Exception as e:
+                errore = e
+                logger.warning(f"Download foto {filename} fallito ({tentativo}/{self.tentativi}): {e}")
+                if tentativo < self.tentativi:
+                    metriche.conta('download_tentativi_ripetuti')
+                    await asyncio.sleep(min(2 ** (tentativo - 1), 30))
+        
+        self.in_corso.pop(filename, None)
+        self.falliti[filename] = (file_id, str(errore))
+        metriche.conta('download_falliti')
+        logger.error(f"Download foto {filename} abbandonato: {errore}")
+    
+    async def recupera(self, bot, noleggi):
+        """Foto dei noleggi rimaste senza file (download in corso a un riavvio)"""
+        da_giorno = (datetime.now() - timedelta(days=FOTO_RECUPERO_GIORNI)).strftime('%Y-%m-%d')
+        rimessi = 0
+        for noleggio in noleggi:
+            filename = noleggio.foto_ricevuta
+            if filename in self.in_corso or filename in self.falliti:
+                continue
+            if giorno_iso(noleggio.data) >= da_giorno:
+                await self.accoda(bot, noleggio.foto_file_id, filename)
+                rimessi += 1
+            else:
+                self.falliti[filename] = (noleggio.foto_file_id, "file assente dopo un riavvio")
+        if noleggi:
+            logger.info(f"Foto senza file: {rimessi} rimesse in coda, {len(noleggi) - rimessi} tra i falliti")
+    
+    async def riprova_falliti(self, bot):
+        falliti, self.falliti = self.falliti, {}
+        for filename, (file_id, _) in falliti.items():
+            await self.accoda(bot, file_id, filename)
+        return len(falliti)
+    
+    async def ferma(self, attesa=10):
+        """Lascia finire i download in coda (al massimo 'attesa' secondi), poi chiude i worker"""
+        if self._coda is not None:
+            try:
+                await asyncio.wait_for(self._coda.join(), attesa)
+            except asyncio.TimeoutError:
+                logger.warning(f"Chiusura con {len(self.in_corso)} download foto ancora in corso")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+coda_download = CodaDownload()
+
+# Promemoria di rientro per lo staff
+STAFF_CHAT_ID = os.getenv('STAFF_CHAT_ID')
+PROMEMORIA_ANTICIPO_MIN = int(os.getenv('PROMEMORIA_ANTICIPO_MIN', '10'))
+RITARDO_ALLARME_MIN = int(os.getenv('RITARDO_ALLARME_MIN', '15'))
+RIENTRI_FILE = 'rientri.jsonl'
+# Noleggi per messaggio quando molti scadono insieme (un pulsante "Rientrato" ciascuno)
+NOLEGGI_PER_AVVISO = 20
+
+class PromemoriaRientri:
+    """Promemoria di rientro e allarmi di ritardo con un solo job sulla JobQueue.
+    
+    Gli eventi (promemoria, ritardo) stanno in un min-heap per orario: il job
+    è pianificato sull'evento più vicino, al risveglio invia tutti quelli
+    scaduti (raggruppati in pochi messaggi) e si ripianifica sul successivo.
+    Nessun job per noleggio e nessuna scansione periodica.
+    """
+    
+    def __init__(self):
+        self._heap = []  # (quando, progressivo, evento, noleggio)
+        self._progressivo = 0
+        self._application = None
+        self._job = None
+        self._prossimo = None
+        self.rientrati = set()
+        self._letti = 0  # byte di RIENTRI_FILE già letti (rientri segnati da altri processi)
+    
+    @property
+    def attivo(self):
+        return bool(STAFF_CHAT_ID)
+    
+    def avvia(self, application):
+        """Ricostruisce l'heap dai noleggi di ieri e oggi ancora da rientrare"""
+        # Anche senza promemoria: un'unità rientrata resta libera dopo un riavvio
+        self.rientrati = self._leggi_rientri()
+        for id_ in self.rientrati:
+            bot_instance.rientrato(id_)
+        if not self.attivo:
+            logger.info("STAFF_CHAT_ID non impostato: promemoria di rientro disattivati")
+            return
+        if application.job_queue is None:
+            logger.warning("JobQueue non disponibile (installa python-telegram-bot[job-queue]): promemoria disattivati")
+            return
+        self._application = application
+        ieri = (datetime.now() - timedelta(days=1)).strftime('%d/%m/%Y')
+        for data in (ieri, data_oggi()):
+            for noleggio in bot_instance.giorno(data).noleggi:
+                self.aggiungi(noleggio, pianifica=False)
+        logger.info(f"Promemoria rientri: {len(self._heap)} eventi in attesa")
+        self._pianifica()
+    
+    def aggiungi(self, noleggio, pianifica=True):
+        fine = fine_noleggio(noleggio)
+        # Solo noleggi che partono al momento della registrazione, e della propria
+        # sede: gli altri processi avvisano per i loro
+        if not self.attivo or fine is None or noleggio.id in self.rientrati \
+                or noleggio.data != noleggio.timestamp.strftime('%d/%m/%Y') \
+                or (SEDE and noleggio.sede != SEDE):
+            return
+        adesso = datetime.now()
+        for evento, quando in (('promemoria', fine - timedelta(minutes=PROMEMORIA_ANTICIPO_MIN)),
+                               ('ritardo', fine + timedelta(minutes=RITARDO_ALLARME_MIN))):
+            if quando > adesso:
+                self._progressivo += 1
+                heapq.heappush(self._heap, (quando, self._progressivo, evento, noleggio))
+        if pianifica:
+            self._pianifica()
+    
+    def _pianifica(self):
+        """Sposta l'unico job sull'evento più vicino, se è cambiato"""
+        if self._application is None or not self._heap:
+            return
+        quando = self._heap[0][0]
+        if self._job is not None and self._prossimo is not None and self._prossimo <= quando:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        # Ritardo in secondi: i timestamp sono in ora locale, la JobQueue ragiona in UTC
+        attesa = max((quando - datetime.now()).total_seconds(), 0)
+        self._job = self._application.job_queue.run_once(self._esegui, attesa, name='promemoria_rientri')
+        self._prossimo = quando
+    
+    async def _esegui(self, context):
+        self._job = self._prossimo = None
+        adesso = datetime.now()
+        scaduti = {'promemoria': [], 'ritardo': []}
+        while self._heap and self._heap[0][0] <= adesso:
+            _, _, evento, noleggio = heapq.heappop(self._heap)
+            if noleggio.id not in self.rientrati:
+                scaduti[evento].append(noleggio)
+        try:
+            for evento, noleggi in scaduti.items():
+                for i in range(0, len(noleggi), NOLEGGI_PER_AVVISO):
+                    await self._invia(context.bot, evento, noleggi[i:i + NOLEGGI_PER_AVVISO])
+        except Exception as e:
+            logger.error(f"Invio promemoria rientri fallito: {e}")
+        finally:
+            self._pianifica()
+    
+    async def _invia(self, bot, evento, noleggi):
+        if evento == 'promemoria':
+            righe = [f"⏰ **RIENTRI TRA {PROMEMORIA_ANTICIPO_MIN} MIN**"]
+        else:
+            righe = ["🚨 **NOLEGGI IN RITARDO**"]
+        keyboard = []
+        for n in noleggi:
+            numero = f" N.{n.numero}" if n.numero else ""
+            righe.append(f"• {TIPO_ICONE.get(n.tipo_noleggio, '📦')} {n.tipo_noleggio} {n.dettagli}{numero} — "
+                         f"{n.cognome} {n.nome} 📞 {n.telefono} (rientro {fine_noleggio(n):%H:%M})")
+            keyboard.append([InlineKeyboardButton(f"✅ Rientrato: {n.cognome} {n.nome} {n.tipo_noleggio}{numero}",
+                                                  callback_data=f"rientrato_{n.id}")])
+        await bot.send_message(STAFF_CHAT_ID, "\n".join(righe), reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def segna_rientrato(self, id_):
+        """Annulla l'allarme di ritardo e libera l'unità; salvato per sopravvivere ai riavvii"""
+        if id_ in self.rientrati:
+            return False
+        self.rientrati.add(id_)
+        bot_instance.rientrato(id_)
+        await asyncio.to_thread(self._scrivi_rientro, id_)
+        return True
+    
+    def _leggi_rientri(self):
+        self._letti = 0
+        return self._nuovi_rientri()
+    
+    def _nuovi_rientri(self):
+        """ID dei rientri aggiunti a RIENTRI_FILE dopo l'ultima lettura (solo righe complete)"""
+        try:
+            with open(RIENTRI_FILE, 'rb') as f:
+                f.seek(self._letti)
+                dati = f.read()
+        except FileNotFoundError:
+            return set()
+        except OSError as e:
+            logger.error(f"Rientri non leggibili ({e})")
+            return set()
+        completi = dati[:dati.rfind(b'\n') + 1]
+        self._letti += len(completi)
+        try:
+            return {json.loads(riga)['id'] for riga in completi.splitlines() if riga.strip()}
+        except (ValueError, KeyError) as e:
+            logger.error(f"Rientri non leggibili ({e})")
+            return set()
+    
+    async def sincronizza(self):
+        """Rientri segnati da altri processi: niente allarmi di ritardo e unità di nuovo libere"""
+        nuovi = await asyncio.to_thread(self._nuovi_rientri)
+        for id_ in nuovi - self.rientrati:
+            self.rientrati.add(id_)
+            bot_instance.rientrato(id_)
+    
+    @staticmethod
+    def _scrivi_rientro(id_):
+        # Una riga corta in append è atomica anche con più processi sullo stesso file
+        with open(RIENTRI_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'id': id_, 'timestamp': datetime.now().isoformat()}) + '\n')
+
+promemoria_rientri = PromemoriaRientri()
+
+# Tastiere fisse della registrazione: costruite una volta sola all'avvio
+# (InlineKeyboardMarkup è immutabile, si può riusare tra i messaggi)
+def _tastiera(pulsanti):
+    """Un pulsante per riga da coppie (testo, callback_data)"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(testo, callback_data=dati)] for testo, dati in pulsanti])
+
+TASTIERA_DOCUMENTO = _tastiera([("C.I.", "doc_CI"), ("PAT", "doc_PAT"), ("PASS", "doc_PASS"), ("ALTRO", "doc_ALTRO")])
+TASTIERA_ASSOCIATO = _tastiera([("✅ SÌ", "assoc_SI"), ("❌ NO", "assoc_NO")])
+TASTIERA_TIPI = _tastiera([(f"{TIPO_ICONE[t]} {t}", f"tipo_{t}") for t in TipoNoleggio])
+TASTIERA_SUP = _tastiera([(m, f"sup_{m}") for m in ("All-around", "Touring", "Race", "Surf", "Yoga")])
+TASTIERA_LETTINO = _tastiera([("🌲 Pineta", "lettino_Pineta"), ("🚤 Squero", "lettino_Squero")])
+TASTIERA_TEMPI = _tastiera([(f"⏱️ {t}", f"tempo_{t}") for t in
+                            ("1h", "1,5h", "2h", "2,5h", "3h", "3,5h", "4h", "4,5h", "5h", "6h", "8h")])
+TASTIERA_PAGAMENTO = _tastiera([("💳 CARTA", "pag_CARD"), ("🏦 BONIFICO", "pag_BONIFICO")])
+TASTIERA_FOTO = _tastiera([("📸 SÌ - Allego foto", "foto_SI"), ("❌ NO - Nessuna foto", "foto_NO")])
+TASTIERA_ABITUALE = _tastiera([("🔁 Cliente abituale (cerca per telefono/documento)", "abituale")])
+TASTIERA_NUOVO_CLIENTE = _tastiera([("➕ Nuovo cliente", "abituale_nuovo")])
+TASTIERA_ALTRO_FINITO = _tastiera([("➕ Aggiungi altro noleggio", "altro_noleggio"), ("✅ Finito", "finito")])
+
+# Regole di validazione dei campi digitati, condivise da conversazione e /importa.
+# Sollevano ValueError con il messaggio da mostrare all'operatore.
+@functools.lru_cache(maxsize=8192)
+def _leggi_data(testo):
+    return datetime.strptime(testo, '%d/%m/%Y')
+
+def valida_data(testo):
+    try:
+        data_obj = _leggi_data(testo)
+    except (TypeError, ValueError):
+        raise ValueError("Formato errato. Usa DD/MM/YYYY")
+    # Verifica range valido
+    if data_obj.year < 2025 or data_obj > datetime.now().replace(year=datetime.now().year + 1):
+        raise ValueError("Data non valida. Usa formato DD/MM/YYYY (dal 2025)")
+    return testo
+
+def valida_numero_documento(testo):
+    numero_doc = testo.strip()
+    if len(numero_doc) < 3:
+        raise ValueError("Numero documento troppo corto (min 3 caratteri)")
+    return numero_doc
+
+def valida_numero(tipo, associato, testo):
+    """Lettera A-Z per i lettini degli associati, 0-99 per gli altri lettini; libero per il resto"""
+    numero_text = testo.upper()
+    if tipo == 'LETTINO':
+        if associato == 'SÌ':
+            if not (len(numero_text) == 1 and 'A' <= numero_text <= 'Z'):
+                raise ValueError("Inserisci lettera A-Z")
+        else:
+            try:
+                num = int(numero_text)
+                if not (0 <= num <= 99):
+                    raise ValueError
+            except ValueError:
+                raise ValueError("Inserisci numero 0-99")
+    return numero_text
+
+def valida_importo(testo):
+    """'30,5' -> '30.50 EUR'"""
+    try:
+        importo = float(testo.replace(',', '.').strip())
+        if importo <= 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError("Importo non valido (es: 25, 30.50)")
+    # Usa icona EUR invece del simbolo €
+    return f"{importo:.2f} EUR"
+
+def crea_registrazione(user_data):
+    """Noleggio dai dati raccolti durante la conversazione"""
+    return Noleggio.da_dict({
+        'id': id_noleggio(user_data['data']),
+        'data': user_data['data'],
+        'cognome': user_data['cognome'],
+        'nome': user_data['nome'],
+        'documento': user_data['documento'],
+        'numero_documento': user_data['numero_documento'],
+        'telefono': user_data['telefono'],
+        'associato': user_data['associato'],
+        'tipo_noleggio': user_data['tipo_noleggio'],
+        'dettagli': user_data.get('dettagli', ''),
+        'numero': user_data.get('numero', ''),
+        'tempo': user_data['tempo'],
+        'pagamento': user_data['pagamento'],
+        'importo': user_data.get('importo', ''),
+        'foto_ricevuta': user_data.get('foto_ricevuta'),
+        'foto_file_id': user_data.get('foto_file_id'),
+        'foto_file_unique_id': user_data.get('foto_file_unique_id'),
+        'note': user_data.get('note'),
+        'timestamp': datetime.now().isoformat(),
+        'sede': SEDE,
+    })
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Avvia registrazione"""
     await update.message.reply_text(
@@ -63,20 +2251,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def get_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Valida data e continua"""
     try:
-        data_text = update.message.text
-        data_obj = datetime.strptime(data_text, '%d/%m/%Y')
-        
-        # Verifica range valido
-        if data_obj.year < 2025 or data_obj > datetime.now().replace(year=datetime.now().year + 1):
-            await update.message.reply_text("❌ Data non valida. Usa formato DD/MM/YYYY (dal 2025):")
-            return DATA
-            
-        context.user_data['data'] = data_text
-        await update.message.reply_text("Inserisci il COGNOME:")
+        context.user_data['data'] = valida_data(update.message.text)
+        await update.message.reply_text("Inserisci il COGNOME:", reply_markup=TASTIERA_ABITUALE)
         return COGNOME
         
-    except ValueError:
-        await update.message.reply_text("❌ Formato errato. Usa DD/MM/YYYY:")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}:")
         return DATA
 
 async def get_cognome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -84,136 +2264,116 @@ async def get_cognome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await update.message.reply_text("Inserisci il NOME:")
     return NOME
 
-async def get_nome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data['nome'] = update.message.text
+async def cerca_cliente_abituale(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Prefisso di telefono o documento -> pulsanti dei clienti già registrati"""
+    testo = update.message.text.strip()
+    if max(len(solo_cifre(testo)), len(documento_normalizzato(testo))) < RICERCA_MIN_CARATTERI:
+        await update.message.reply_text(f"❌ Scrivi almeno {RICERCA_MIN_CARATTERI} caratteri di telefono o documento:")
+        return RICERCA_CLIENTE
+    
+    trovati = await bot_instance.cerca_clienti(testo)
+    if not trovati:
+        await update.message.reply_text("❌ Nessun cliente trovato. Riprova oppure:", reply_markup=TASTIERA_NUOVO_CLIENTE)
+        return RICERCA_CLIENTE
     
     keyboard = [
-        [InlineKeyboardButton("C.I.", callback_data="doc_CI")],
-        [InlineKeyboardButton("PAT", callback_data="doc_PAT")],
-        [InlineKeyboardButton("PASS", callback_data="doc_PASS")],
-        [InlineKeyboardButton("ALTRO", callback_data="doc_ALTRO")]
+        [InlineKeyboardButton(f"👤 {n.cognome} {n.nome} · 📞 {n.telefono} · 📄 {n.numero_documento}", callback_data=f"abituale_{n.id}")]
+        for n in trovati
     ]
+    keyboard.append([InlineKeyboardButton("➕ Nuovo cliente", callback_data="abituale_nuovo")])
+    await update.message.reply_text("🔁 Seleziona il cliente:", reply_markup=InlineKeyboardMarkup(keyboard))
+    return RICERCA_CLIENTE
+
+async def get_nome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['nome'] = update.message.text
     
     await update.message.reply_text(
         "Seleziona tipo DOCUMENTO:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=TASTIERA_DOCUMENTO
     )
     return DOCUMENTO
 
 async def get_numero_documento(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    numero_doc = update.message.text.strip()
-    if len(numero_doc) < 3:
-        await update.message.reply_text("❌ Numero documento troppo corto (min 3 caratteri):")
+    try:
+        context.user_data['numero_documento'] = valida_numero_documento(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}:")
         return NUMERO_DOCUMENTO
     
-    context.user_data['numero_documento'] = numero_doc
     await update.message.reply_text("Inserisci TELEFONO:")
     return TELEFONO
 
 async def get_telefono(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['telefono'] = update.message.text
     
-    keyboard = [
-        [InlineKeyboardButton("✅ SÌ", callback_data="assoc_SI")],
-        [InlineKeyboardButton("❌ NO", callback_data="assoc_NO")]
-    ]
-    
     await update.message.reply_text(
         "È ASSOCIATO?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=TASTIERA_ASSOCIATO
     )
     return ASSOCIATO
 
 async def get_importo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Riceve importo con icona EUR"""
-    importo_text = update.message.text.replace(',', '.').strip()
-    
     try:
-        importo = float(importo_text)
-        if importo <= 0:
-            raise ValueError
-        
-        # Usa icona EUR invece del simbolo €
-        context.user_data['importo'] = f"{importo:.2f} EUR"
-        
-        keyboard = [
-            [InlineKeyboardButton("📸 SÌ - Allego foto", callback_data="foto_SI")],
-            [InlineKeyboardButton("❌ NO - Nessuna foto", callback_data="foto_NO")]
-        ]
+        context.user_data['importo'] = valida_importo(update.message.text)
         
         await update.message.reply_text(
             f"✅ Importo: {context.user_data['importo']}\n\n📷 Allegare foto ricevuta?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TASTIERA_FOTO
         )
         return FOTO_RICEVUTA
         
-    except ValueError:
-        await update.message.reply_text("❌ Importo non valido (es: 25, 30.50):")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}:")
         return IMPORTO
 
-async def salva_registrazione_callback(query, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Salva registrazione quando viene da callback (senza note)"""
-    try:
-        registrazione = {
-            'data': context.user_data['data'],
-            'cognome': context.user_data['cognome'],
-            'nome': context.user_data['nome'],
-            'documento': context.user_data['documento'],
-            'numero_documento': context.user_data['numero_documento'],
-            'telefono': context.user_data['telefono'],
-            'associato': context.user_data['associato'],
-            'tipo_noleggio': context.user_data['tipo_noleggio'],
-            'dettagli': context.user_data.get('dettagli', ''),
-            'numero': context.user_data.get('numero', ''),
-            'tempo': context.user_data['tempo'],
-            'pagamento': context.user_data['pagamento'],
-            'importo': context.user_data.get('importo', ''),
-            'foto_ricevuta': context.user_data.get('foto_ricevuta'),
-            'note': context.user_data.get('note'),
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        bot_instance.noleggi.append(registrazione)
-        bot_instance.save_data()
-        
-        # Salva i dati cliente per eventuali noleggi aggiuntivi
-        if 'cliente_base' not in context.user_data:
-            context.user_data['cliente_base'] = {
-                'data': context.user_data['data'],
-                'cognome': context.user_data['cognome'],
-                'nome': context.user_data['nome'],
-                'documento': context.user_data['documento'],
-                'numero_documento': context.user_data['numero_documento'],
-                'telefono': context.user_data['telefono'],
-                'associato': context.user_data['associato']
-            }
-        
-        messaggio = f"""
-✅ **NOLEGGIO REGISTRATO!**
+def riepilogo_noleggi(data, nome_cliente):
+    """Righe dei noleggi del cliente per il riassunto di fine registrazione"""
+    giorno = bot_instance.giorno(data)
+    
+    def costruisci():
+        return "".join(
+            f"\n{i}. {TIPO_ICONE.get(n.tipo_noleggio, '📦')} {n.tipo_noleggio} {n.dettagli} N.{n.numero} ({n.tempo}) - {n.importo}"
+            for i, n in enumerate(giorno.clienti.get(nome_cliente, []), 1)
+        )
+    
+    return giorno.renderizzato(('riepilogo', nome_cliente), giorno.versioni_clienti.get(nome_cliente, 0), costruisci)
 
-👤 {registrazione['cognome']} {registrazione['nome']}
-🏄‍♂️ {registrazione['tipo_noleggio']} {registrazione['dettagli']}
-🔢 N. {registrazione['numero']}
-⏱️ {registrazione['tempo']}
-💰 {registrazione['importo']}
-        """
-        
-        # Pulsanti per aggiungere altro o finire
-        keyboard = [
-            [InlineKeyboardButton("➕ Aggiungi altro noleggio", callback_data="altro_noleggio")],
-            [InlineKeyboardButton("✅ Finito", callback_data="finito")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(messaggio + "\n\n🤔 Vuole noleggiare altro?", reply_markup=reply_markup)
+def scheda_cliente(data, nome_cliente):
+    """Testo e tastiera del dettaglio cliente, riusati finché il cliente non ha nuovi noleggi"""
+    giorno = bot_instance.giorno(data)
+    
+    def costruisci():
+        noleggi_cliente = giorno.clienti[nome_cliente]
+        primo_noleggio = noleggi_cliente[0]  # Per dati base
+        parti = [f"""
+👤 **{nome_cliente}**
+
+📞 {primo_noleggio.telefono}
+📄 {primo_noleggio.documento} - {primo_noleggio.numero_documento}
+🏅 Associato: {primo_noleggio.associato}
+
+🏄‍♂️ **NOLEGGI ({len(noleggi_cliente)}):**
+        """]
         
-        return FOTO_RICEVUTA  # Stato che gestisce callback generici
+        # Lista tutti i noleggi
+        keyboard = []
+        for i, noleggio in enumerate(noleggi_cliente, 1):
+            parti.append(f"\n{i}. {TIPO_ICONE.get(noleggio.tipo_noleggio, '📦')} {noleggio.tipo_noleggio} {noleggio.dettagli}"
+                         f"\n   🔢 N.{noleggio.numero} | ⏱️ {noleggio.tempo} | 💰 {noleggio.importo}"
+                         f"\n   💳 {noleggio.pagamento}" + (f" | 📍 {noleggio.sede}" if noleggio.sede else ""))
+            if noleggio.note:
+                parti.append(f"\n   📝 {noleggio.note}")
+            
+            # Pulsante per foto se presente
+            if noleggio.foto_ricevuta or noleggio.foto_file_id:
+                keyboard.append([InlineKeyboardButton(f"📸 Foto {noleggio.tipo_noleggio} N.{noleggio.numero}", callback_data=f"foto_{noleggio.id}")])
+            
+            parti.append("\n")
         
-    except Exception as e:
-        logger.error(f"Errore salvataggio: {e}")
-        await query.edit_message_text("❌ Errore salvataggio")
-        context.user_data.clear()
-        return ConversationHandler.END
+        return "".join(parti), (InlineKeyboardMarkup(keyboard) if keyboard else None)
+    
+    return giorno.renderizzato(('cliente', nome_cliente), giorno.versioni_clienti.get(nome_cliente, 0), costruisci)
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handler unificato per tutti i callback"""
@@ -228,33 +2388,24 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             context.user_data.update(context.user_data['cliente_base'])
         
         # Pulisce i dati del noleggio precedente
-        for key in ['tipo_noleggio', 'dettagli', 'numero', 'tempo', 'pagamento', 'importo', 'foto_ricevuta', 'note']:
+        for key in ['tipo_noleggio', 'dettagli', 'numero', 'tempo', 'pagamento', 'importo',
+                    'foto_ricevuta', 'foto_file_id', 'foto_file_unique_id', 'note']:
             context.user_data.pop(key, None)
         
-        keyboard = [
-            [InlineKeyboardButton("🏄‍♂️ SUP", callback_data="tipo_SUP")],
-            [InlineKeyboardButton("🚣‍♂️ KAYAK", callback_data="tipo_KAYAK")],
-            [InlineKeyboardButton("🏖️ LETTINO", callback_data="tipo_LETTINO")],
-            [InlineKeyboardButton("📱 PHONEBAG", callback_data="tipo_PHONEBAG")],
-            [InlineKeyboardButton("🎒 DRYBAG", callback_data="tipo_DRYBAG")]
-        ]
-        
         await query.edit_message_text(
             f"➕ **ALTRO NOLEGGIO PER:**\n"
             f"👤 {context.user_data.get('cognome', '')} {context.user_data.get('nome', '')}\n\n"
             f"Cosa noleggia ancora?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TASTIERA_TIPI
         )
         return TIPO_NOLEGGIO
     
     elif data == "finito":
         # Calcola totale noleggi per questo cliente
         nome_completo = f"{context.user_data.get('cognome', '')} {context.user_data.get('nome', '')}"
-        oggi = datetime.now().strftime('%d/%m/%Y')
+        oggi = data_oggi()
         
-        noleggi_cliente_oggi = [n for n in bot_instance.noleggi 
-                               if n['data'] == oggi and 
-                               f"{n.get('cognome', '')} {n.get('nome', '')}" == nome_completo]
+        noleggi_cliente_oggi = bot_instance.noleggi_cliente(oggi, nome_completo)
         
         # Riassunto finale
         messaggio_finale = f"""
@@ -267,16 +2418,40 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 🏄‍♂️ **NOLEGGI TOTALI:** {len(noleggi_cliente_oggi)}
         """
         
-        # Lista tutti i noleggi
-        for i, noleggio in enumerate(noleggi_cliente_oggi, 1):
-            tipo_icon = {"SUP": "🏄‍♂️", "KAYAK": "🚣‍♂️", "LETTINO": "🏖️", "PHONEBAG": "📱", "DRYBAG": "🎒"}.get(noleggio['tipo_noleggio'], "📦")
-            messaggio_finale += f"\n{i}. {tipo_icon} {noleggio['tipo_noleggio']} {noleggio['dettagli']} N.{noleggio['numero']} ({noleggio['tempo']}) - {noleggio.get('importo', 'N/A')}"
+        # Lista tutti i noleggi (già pronta se il cliente non ne ha di nuovi)
+        messaggio_finale += riepilogo_noleggi(oggi, nome_completo)
+        messaggio_finale += f"\n\n💡 Usa `/mostra_noleggi` per vedere tutti i clienti di oggi"
+        
+        await query.edit_message_text(messaggio_finale)
+        context.user_data.clear()
+        return ConversationHandler.END
+    
+    # ====== CLIENTE ABITUALE ======
+    elif data == "abituale":
+        await query.edit_message_text("🔎 Scrivi le prime cifre del TELEFONO o del NUMERO DOCUMENTO:")
+        return RICERCA_CLIENTE
+    
+    elif data == "abituale_nuovo":
+        await query.edit_message_text("Inserisci il COGNOME:")
+        return COGNOME
+    
+    elif data.startswith("abituale_"):
+        precedente = await bot_instance.trova_caricando(data.replace("abituale_", ""))
+        if precedente is None:
+            await query.edit_message_text("❌ Cliente non trovato. Inserisci il COGNOME:")
+            return COGNOME
         
-        messaggio_finale += f"\n\n💡 Usa `/mostra_noleggi` per vedere tutti i clienti di oggi"
+        # Dati anagrafici dall'ultimo noleggio: si salta direttamente al tipo
+        for campo in ('cognome', 'nome', 'documento', 'numero_documento', 'telefono', 'associato'):
+            context.user_data[campo] = str(getattr(precedente, campo))
         
-        await query.edit_message_text(messaggio_finale)
-        context.user_data.clear()
-        return ConversationHandler.END
+        await query.edit_message_text(
+            f"✅ Cliente: {precedente.cognome} {precedente.nome}\n"
+            f"📞 {precedente.telefono} | 📄 {precedente.documento} - {precedente.numero_documento}\n"
+            f"🏅 Associato: {precedente.associato}\n\nTipo noleggio?",
+            reply_markup=TASTIERA_TIPI
+        )
+        return TIPO_NOLEGGIO
     
     # ====== GESTIONE REGISTRAZIONE NUOVO NOLEGGIO ======
     # Documento
@@ -291,17 +2466,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         associato = "SÌ" if data == "assoc_SI" else "NO"
         context.user_data['associato'] = associato
         
-        keyboard = [
-            [InlineKeyboardButton("🏄‍♂️ SUP", callback_data="tipo_SUP")],
-            [InlineKeyboardButton("🚣‍♂️ KAYAK", callback_data="tipo_KAYAK")],
-            [InlineKeyboardButton("🏖️ LETTINO", callback_data="tipo_LETTINO")],
-            [InlineKeyboardButton("📱 PHONEBAG", callback_data="tipo_PHONEBAG")],
-            [InlineKeyboardButton("🎒 DRYBAG", callback_data="tipo_DRYBAG")]
-        ]
-        
         await query.edit_message_text(
             f"✅ Associato: {associato}\n\nTipo noleggio?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TASTIERA_TIPI
         )
         return TIPO_NOLEGGIO
     
@@ -311,27 +2478,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['tipo_noleggio'] = tipo
         
         if tipo == 'SUP':
-            keyboard = [
-                [InlineKeyboardButton("All-around", callback_data="sup_All-around")],
-                [InlineKeyboardButton("Touring", callback_data="sup_Touring")],
-                [InlineKeyboardButton("Race", callback_data="sup_Race")],
-                [InlineKeyboardButton("Surf", callback_data="sup_Surf")],
-                [InlineKeyboardButton("Yoga", callback_data="sup_Yoga")]
-            ]
             await query.edit_message_text(
                 f"✅ {tipo}\n\nTipo SUP:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=TASTIERA_SUP
             )
             return DETTAGLI_SUP
             
         elif tipo == 'LETTINO':
-            keyboard = [
-                [InlineKeyboardButton("🌲 Pineta", callback_data="lettino_Pineta")],
-                [InlineKeyboardButton("🚤 Squero", callback_data="lettino_Squero")]
-            ]
             await query.edit_message_text(
                 f"✅ {tipo}\n\nTipo lettino:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=TASTIERA_LETTINO
             )
             return DETTAGLI_LETTINO
             
@@ -364,14 +2520,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         tempo = data.replace("tempo_", "")
         context.user_data['tempo'] = tempo
         
-        keyboard = [
-            [InlineKeyboardButton("💳 CARTA", callback_data="pag_CARD")],
-            [InlineKeyboardButton("🏦 BONIFICO", callback_data="pag_BONIFICO")]
-        ]
-        
         await query.edit_message_text(
             f"✅ Tempo: {tempo}\n\nTipo PAGAMENTO:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TASTIERA_PAGAMENTO
         )
         return PAGAMENTO
     
@@ -399,409 +2550,964 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # ====== GESTIONE VISUALIZZAZIONE CLIENTI ======
     # Gestione callback per mostra_noleggi (raggruppati per cliente)
     elif data.startswith("cliente_"):
-        cliente_idx = int(data.replace("cliente_", ""))
-        noleggi_oggi = bot_instance.get_noleggi_oggi()
-        
-        # Raggruppa per cliente
-        clienti_noleggi = defaultdict(list)
-        for noleggio in noleggi_oggi:
-            nome_completo = f"{noleggio.get('cognome', '')} {noleggio.get('nome', '')}"
-            clienti_noleggi[nome_completo].append(noleggio)
-        
-        # Ottieni il cliente specifico
-        clienti_lista = list(clienti_noleggi.items())
-        if cliente_idx < len(clienti_lista):
-            nome_cliente, noleggi_cliente = clienti_lista[cliente_idx]
-            
-            # Crea messaggio con tutti i noleggi del cliente
-            primo_noleggio = noleggi_cliente[0]  # Per dati base
-            
-            messaggio = f"""
-👤 **{nome_cliente}**
-
-📞 {primo_noleggio['telefono']}
-📄 {primo_noleggio['documento']} - {primo_noleggio.get('numero_documento', '')}
-🏅 Associato: {primo_noleggio['associato']}
-
-🏄‍♂️ **NOLEGGI ({len(noleggi_cliente)}):**
-            """
-            
-            # Lista tutti i noleggi
-            keyboard = []
-            for i, noleggio in enumerate(noleggi_cliente):
-                tipo_icon = {"SUP": "🏄‍♂️", "KAYAK": "🚣‍♂️", "LETTINO": "🏖️", "PHONEBAG": "📱", "DRYBAG": "🎒"}.get(noleggio['tipo_noleggio'], "📦")
-                
-                messaggio += f"\n{i+1}. {tipo_icon} {noleggio['tipo_noleggio']} {noleggio['dettagli']}"
-                messaggio += f"\n   🔢 N.{noleggio['numero']} | ⏱️ {noleggio['tempo']} | 💰 {noleggio.get('importo', 'N/A')}"
-                messaggio += f"\n   💳 {noleggio['pagamento']}"
-                
-                if noleggio.get('note'):
-                    messaggio += f"\n   📝 {noleggio['note']}"
-                
-                # Pulsante per foto se presente
-                if noleggio.get('foto_ricevuta'):
-                    # Trova l'indice globale del noleggio
-                    for j, n in enumerate(noleggi_oggi):
-                        if n == noleggio:
-                            keyboard.append([InlineKeyboardButton(f"📸 Foto {noleggio['tipo_noleggio']} N.{noleggio['numero']}", callback_data=f"foto_{j}")])
-                            break
-                
-                messaggio += "\n"
-            
-            reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-            await query.edit_message_text(messaggio, reply_markup=reply_markup)
+        # L'ID è quello di un noleggio del cliente: resta valido anche se nel
+        # frattempo la lista del giorno è cresciuta
+        riferimento = await bot_instance.trova_caricando(data.replace("cliente_", ""))
+        if riferimento is None:
+            await query.edit_message_text("❌ Noleggio non trovato")
+            return ConversationHandler.END
+        
+        messaggio, reply_markup = scheda_cliente(riferimento.data, chiave_cliente(riferimento))
+        await query.edit_message_text(messaggio, reply_markup=reply_markup)
         
         return ConversationHandler.END
     
-    # Gestione visualizzazione foto esistenti (solo numeri)
-    elif data.startswith("foto_") and data.replace("foto_", "").isdigit():
-        cliente_idx = int(data.replace("foto_", ""))
-        noleggi_oggi = bot_instance.get_noleggi_oggi()
+    # Gestione visualizzazione foto esistenti (per ID noleggio)
+    elif data.startswith("foto_") and _RE_ID_NOLEGGIO.match(data.replace("foto_", "")):
+        registro = await bot_instance.trova_caricando(data.replace("foto_", ""))
         
-        if cliente_idx < len(noleggi_oggi):
-            registro = noleggi_oggi[cliente_idx]
-            foto_filename = registro.get('foto_ricevuta')
-            
-            if foto_filename:
-                foto_path = os.path.join(PHOTOS_DIR, foto_filename)
-                if os.path.exists(foto_path):
-                    with open(foto_path, 'rb') as foto:
-                        await query.message.reply_photo(
-                            photo=foto,
-                            caption=f"📸 Ricevuta di {registro.get('cognome', '')} {registro.get('nome', '')}\n"
-                                   f"💰 {registro.get('importo', 'N/A')} - {registro['pagamento']}"
-                        )
-                else:
-                    await query.message.reply_text("❌ File foto non trovato")
-            else:
-                await query.message.reply_text("❌ Nessuna foto disponibile")
+        if registro is None:
+            await query.message.reply_text("❌ Noleggio non trovato")
+        elif registro.foto_ricevuta or registro.foto_file_id:
+            await invia_ricevuta(query.message, registro)
+        else:
+            await query.message.reply_text("❌ Nessuna foto disponibile")
         
         return ConversationHandler.END
     
     # Se nessun callback riconosciuto
     return ConversationHandler.END
 
+async def invia_ricevuta(message, registro):
+    """Invia la foto ricevuta: prima per file_id (niente disco né upload), poi dal file locale"""
+    caption = (f"📸 Ricevuta di {registro.cognome} {registro.nome}\n"
+               f"💰 {registro.importo} - {registro.pagamento}")
+    
+    if registro.foto_file_id:
+        try:
+            await message.reply_photo(photo=registro.foto_file_id, caption=caption)
+            return
+        except BadRequest as e:
+            logger.warning(f"file_id ricevuta non più valido ({e}), uso il file locale")
+    
+    foto = None
+    if registro.foto_ricevuta:
+        foto = await asyncio.to_thread(_leggi_file, os.path.join(PHOTOS_DIR, registro.foto_ricevuta))
+    if foto is not None:
+        await message.reply_photo(photo=foto, caption=caption)
+    else:
+        await message.reply_text("❌ File foto non trovato")
+
+def _leggi_file(path):
+    """Legge un file in un thread; None se non esiste"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def avviso_disponibilita(user_data):
+    """Avviso se l'unità scelta (o tutto il modello) risulta già fuori; solo per i noleggi di oggi"""
+    if user_data.get('data') != data_oggi():
+        return ""
+    tipo = user_data['tipo_noleggio']
+    modello = user_data.get('dettagli', '')
+    numero = user_data.get('numero')
+    attivi = bot_instance.noleggi_attivi()
+    
+    if numero:
+        occupanti = attivi.occupata(tipo, modello, numero)
+        if occupanti:
+            n = occupanti[0]
+            return (f"⚠️ ATTENZIONE: {tipo} {modello} N.{numero} risulta già fuori "
+                    f"({n.cognome} {n.nome}, rientro {attivi.rientro(n.id):%H:%M})\n\n")
+    else:
+        totale = unita_modello(tipo, modello)
+        fuori = len(attivi.per_modello().get((tipo, modello), ()))
+        if totale is not None and fuori >= totale:
+            return f"⚠️ ATTENZIONE: tutti i {tipo} {modello} risultano fuori ({fuori}/{totale})\n\n"
+    return ""
+
 async def show_tempo_buttons(query, context):
     """Mostra opzioni tempo - CON MEZZ'ORE"""
-    keyboard = [
-        [InlineKeyboardButton("⏱️ 1h", callback_data="tempo_1h")],
-        [InlineKeyboardButton("⏱️ 1,5h", callback_data="tempo_1,5h")],
-        [InlineKeyboardButton("⏱️ 2h", callback_data="tempo_2h")],
-        [InlineKeyboardButton("⏱️ 2,5h", callback_data="tempo_2,5h")],
-        [InlineKeyboardButton("⏱️ 3h", callback_data="tempo_3h")],
-        [InlineKeyboardButton("⏱️ 3,5h", callback_data="tempo_3,5h")],
-        [InlineKeyboardButton("⏱️ 4h", callback_data="tempo_4h")],
-        [InlineKeyboardButton("⏱️ 4,5h", callback_data="tempo_4,5h")],
-        [InlineKeyboardButton("⏱️ 5h", callback_data="tempo_5h")],
-        [InlineKeyboardButton("⏱️ 6h", callback_data="tempo_6h")],
-        [InlineKeyboardButton("⏱️ 8h", callback_data="tempo_8h")]
-    ]
-    
     dettagli = context.user_data.get('dettagli', 'Standard')
+    # Tipo, modello e numero sono noti: controllo doppie assegnazioni
+    avviso = avviso_disponibilita(context.user_data)
     
     try:
         await query.edit_message_text(
-            f"✅ {dettagli}\n\nTempo noleggio:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"{avviso}✅ {dettagli}\n\nTempo noleggio:",
+            reply_markup=TASTIERA_TEMPI
         )
     except Exception:
         await query.message.reply_text(
-            f"✅ {dettagli}\n\nTempo noleggio:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"{avviso}✅ {dettagli}\n\nTempo noleggio:",
+            reply_markup=TASTIERA_TEMPI
         )
     
     return TEMPO
 
 async def get_lettino_numero(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Riceve numero/lettera per lettini e numeri per phonebag/drybag"""
-    numero_text = update.message.text.upper()
-    tipo = context.user_data['tipo_noleggio']
+    try:
+        context.user_data['numero'] = valida_numero(
+            context.user_data['tipo_noleggio'], context.user_data.get('associato'), update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}:")
+        return LETTINO_NUMERO
     
-    # Validazione semplificata
-    if tipo == 'LETTINO':
-        associato = context.user_data['associato']
-        if associato == 'SÌ':
-            if not (len(numero_text) == 1 and 'A' <= numero_text <= 'Z'):
-                await update.message.reply_text("❌ Inserisci lettera A-Z:")
-                return LETTINO_NUMERO
+    # Simula callback per tempo
+    from types import SimpleNamespace
+    fake_query = SimpleNamespace()
+    fake_query.edit_message_text = lambda text, reply_markup=None: update.message.reply_text(text, reply_markup=reply_markup)
+    fake_query.message = update.message
+    
+    return await show_tempo_buttons(fake_query, context)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Gestisce foto ricevuta: il download va in background, la conversazione prosegue subito"""
+    if not context.user_data.get('attende_foto', False):
+        return FOTO_RICEVUTA
+    
+    photo = update.message.photo[-1]
+    # file_id per rimandare la foto senza rileggerla dal disco né ricaricarla
+    context.user_data['foto_file_id'] = photo.file_id
+    context.user_data['foto_file_unique_id'] = photo.file_unique_id
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    nome = context.user_data.get('nome', 'unknown')
+    cognome = context.user_data.get('cognome', 'unknown')
+    filename = f"{timestamp}_{cognome}_{nome}_ricevuta.jpg"
+    
+    # Il noleggio punta già al file, che arriverà appena il download termina
+    context.user_data['foto_ricevuta'] = filename
+    await coda_download.accoda(context.bot, photo.file_id, filename)
+    
+    await update.message.reply_text("✅ Foto ricevuta!\n\nAggiungi NOTE? (o 'skip'):")
+    return NOTE
+
+async def get_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Riceve note e passa al salvataggio con pulsanti"""
+    note_text = update.message.text.strip()
+    
+    if note_text.lower() == 'skip':
+        context.user_data['note'] = None
+    else:
+        context.user_data['note'] = note_text
+    
+    # Simula un callback query per usare la versione con pulsanti
+    from types import SimpleNamespace
+    fake_query = SimpleNamespace()
+    fake_query.edit_message_text = lambda text, reply_markup=None: update.message.reply_text(text, reply_markup=reply_markup)
+    fake_query.message = update.message
+    
+    return await salva_registrazione_callback(fake_query, context)
+
+async def handle_text_in_foto_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Gestisce testo ricevuto durante stato foto (per note dirette)"""
+    note_text = update.message.text.strip()
+    
+    if note_text.lower() == 'skip':
+        context.user_data['note'] = None
+        context.user_data['foto_ricevuta'] = None
+    else:
+        context.user_data['note'] = note_text
+        context.user_data['foto_ricevuta'] = None
+    
+    return await salva_registrazione(update, context)
+
+@profilato()
+async def salva_registrazione_callback(query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Salva registrazione quando viene da callback (senza note)"""
+    try:
+        registrazione = crea_registrazione(context.user_data)
+        
+        await bot_instance.aggiungi_noleggio(registrazione)
+        promemoria_rientri.aggiungi(registrazione)
+        
+        # Salva i dati cliente per eventuali noleggi aggiuntivi
+        if 'cliente_base' not in context.user_data:
+            context.user_data['cliente_base'] = {
+                'data': context.user_data['data'],
+                'cognome': context.user_data['cognome'],
+                'nome': context.user_data['nome'],
+                'documento': context.user_data['documento'],
+                'numero_documento': context.user_data['numero_documento'],
+                'telefono': context.user_data['telefono'],
+                'associato': context.user_data['associato']
+            }
+        
+        messaggio = f"""
+✅ **NOLEGGIO REGISTRATO!**
+
+👤 {registrazione.cognome} {registrazione.nome}
+🏄‍♂️ {registrazione.tipo_noleggio} {registrazione.dettagli}
+🔢 N. {registrazione.numero}
+⏱️ {registrazione.tempo}
+💰 {registrazione.importo}
+        """
+        
+        # Pulsanti per aggiungere altro o finire
+        await query.edit_message_text(messaggio + "\n\n🤔 Vuole noleggiare altro?", reply_markup=TASTIERA_ALTRO_FINITO)
+        
+        return TIPO_NOLEGGIO  # Resta nello stato per gestire altri noleggi
+        
+    except Exception as e:
+        logger.error(f"Errore salvataggio: {e}")
+        await query.edit_message_text("❌ Errore salvataggio")
+        context.user_data.clear()
+        return ConversationHandler.END
+
+async def salva_registrazione(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Salva registrazione completa - FINISCE conversazione"""
+    try:
+        registrazione = crea_registrazione(context.user_data)
+        
+        await bot_instance.aggiungi_noleggio(registrazione)
+        promemoria_rientri.aggiungi(registrazione)
+        
+        messaggio = f"""
+✅ **REGISTRAZIONE COMPLETATA!**
+
+👤 {registrazione.cognome} {registrazione.nome}
+🏄‍♂️ {registrazione.tipo_noleggio} {registrazione.dettagli}
+🔢 N. {registrazione.numero}
+⏱️ {registrazione.tempo}
+💰 {registrazione.importo}
+
+💡 Usa /nuovo per registrare un altro cliente
+💡 Usa /mostra_noleggi per vedere tutti i clienti di oggi
+        """
+        
+        await update.message.reply_text(messaggio)
+        context.user_data.clear()
+        return ConversationHandler.END
+        
+    except Exception as e:
+        logger.error(f"Errore salvataggio: {e}")
+        await update.message.reply_text("❌ Errore salvataggio")
+        context.user_data.clear()
+        return ConversationHandler.END
+
+CLIENTI_PER_PAGINA = int(os.getenv('CLIENTI_PER_PAGINA', '20'))
+LETTERE_PER_RIGA = 7
+
+def data_compatta(data):
+    """'26/07/2025' -> '250726' (per i callback_data)"""
+    return datetime.strptime(data, '%d/%m/%Y').strftime('%y%m%d')
+
+def pagina_clienti(data, pagina):
+    """Testo e tastiera di una pagina di /mostra_noleggi: costruisce solo i pulsanti della pagina"""
+    giorno = bot_instance.giorno(data)
+    ordinati, _, iniziali = giorno.clienti_ordinati()
+    pagine = max(1, -(-len(ordinati) // CLIENTI_PER_PAGINA))
+    pagina = min(max(pagina, 0), pagine - 1)
+    inizio = pagina * CLIENTI_PER_PAGINA
+    
+    titolo = "NOLEGGI DI OGGI" if data == data_oggi() else "NOLEGGI DEL"
+    
+    def costruisci():
+        # Crea pulsanti inline per ogni cliente della pagina
+        keyboard = []
+        
+        for nome_cliente, noleggi_cliente in ordinati[inizio:inizio + CLIENTI_PER_PAGINA]:
+            # Crea stringa con tutti i noleggi del cliente
+            noleggi_str = "".join(TIPO_ICONE.get(n.tipo_noleggio, "📦") for n in noleggi_cliente)
+            ha_foto = any(n.foto_ricevuta or n.foto_file_id for n in noleggi_cliente)
+        
+            # Aggiungi icona foto se almeno un noleggio ha foto
+            foto_icon = " 📸" if ha_foto else ""
+        
+            button_text = f"{noleggi_str} {nome_cliente} ({len(noleggi_cliente)}){foto_icon}"
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"cliente_{noleggi_cliente[0].id}")])
+        
+        if pagine > 1:
+            compatta = data_compatta(data)
+            navigazione = []
+            if pagina > 0:
+                navigazione.append(InlineKeyboardButton("⬅️", callback_data=f"mn_{compatta}_{pagina - 1}"))
+            navigazione.append(InlineKeyboardButton(f"{pagina + 1}/{pagine}", callback_data=f"mn_{compatta}_{pagina}"))
+            if pagina < pagine - 1:
+                navigazione.append(InlineKeyboardButton("➡️", callback_data=f"mn_{compatta}_{pagina + 1}"))
+            keyboard.append(navigazione)
+        
+            lettere = [InlineKeyboardButton(l, callback_data=f"mnl_{compatta}_{l}") for l in iniziali]
+            for i in range(0, len(lettere), LETTERE_PER_RIGA):
+                keyboard.append(lettere[i:i + LETTERE_PER_RIGA])
+        
+        testo = (
+            f"📅 **{titolo} ({data})**\n"
+            f"👥 Clienti: {len(ordinati)} | 🏄‍♂️ Noleggi: {len(giorno.noleggi)}\n\n"
+            f"📸 = con foto ricevuta\n"
+            f"(n) = numero noleggi\n"
+            f"Clicca su un cliente per i dettagli:"
+        )
+        return testo, InlineKeyboardMarkup(keyboard)
+    
+    # Stessa pagina e nessun nuovo noleggio nel giorno: testo e tastiera già pronti
+    return giorno.renderizzato(('pagina', pagina, titolo), giorno.versione, costruisci)
+
+async def mostra_noleggi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mostra SOLO i noleggi di oggi raggruppati per cliente, a pagine"""
+    oggi = data_oggi()
+    
+    if not (await bot_instance.carica_giorno(oggi)).noleggi:
+        await update.message.reply_text(f"📅 **Nessun noleggio per oggi ({oggi})**")
+        return
+    
+    testo, reply_markup = pagina_clienti(oggi, 0)
+    await update.message.reply_text(testo, reply_markup=reply_markup)
+
+async def cambia_pagina_noleggi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Callback mn_<AAMMGG>_<pagina> e mnl_<AAMMGG>_<lettera> di /mostra_noleggi"""
+    query = update.callback_query
+    await query.answer()
+    
+    tipo, compatta, valore = query.data.split('_', 2)
+    data = data_da_id(compatta)
+    giorno = await bot_instance.carica_giorno(data)
+    
+    if tipo == 'mnl':
+        # Salta alla pagina del primo cliente con questa iniziale
+        _, chiavi, _ = giorno.clienti_ordinati()
+        pagina = bisect.bisect_left(chiavi, valore.casefold()) // CLIENTI_PER_PAGINA
+    else:
+        pagina = int(valore)
+    
+    testo, reply_markup = pagina_clienti(data, pagina)
+    try:
+        await query.edit_message_text(testo, reply_markup=reply_markup)
+    except BadRequest as e:
+        # "Message is not modified": stessa pagina già visualizzata
+        if 'not modified' not in str(e).lower():
+            raise
+
+USO_EXPORT = (
+    "Uso: /export [dal] [al] [tipo=SUP] [pag=CARD] [cliente=rossi] [sede=pineta] [formato=csv|jsonl] [gz]\n"
+    "Date in formato DD/MM/YYYY; con una sola data esporta quel giorno."
+)
+
+def parse_export_args(args):
+    """Converte gli argomenti di /export in filtri; ValueError se non validi"""
+    opzioni = {'dal': None, 'al': None, 'tipo': None, 'pag': None, 'cliente': None, 'sede': None,
+               'formato': 'csv', 'gz': False}
+    date = []
+    for arg in args:
+        chiave, sep, valore = arg.partition('=')
+        if not sep:
+            if arg.lower() == 'gz':
+                opzioni['gz'] = True
+            else:
+                date.append(datetime.strptime(arg, '%d/%m/%Y').strftime('%Y-%m-%d'))
+        elif chiave.lower() in ('tipo', 'pag'):
+            opzioni[chiave.lower()] = valore.upper()
+        elif chiave.lower() in ('cliente', 'sede'):
+            opzioni[chiave.lower()] = valore.casefold()
+        elif chiave.lower() == 'formato' and valore.lower() in ('csv', 'jsonl'):
+            opzioni['formato'] = valore.lower()
         else:
-            try:
-                num = int(numero_text)
-                if not (0 <= num <= 99):
-                    raise ValueError
-            except ValueError:
-                await update.message.reply_text("❌ Inserisci numero 0-99:")
-                return LETTINO_NUMERO
+            raise ValueError(arg)
+    
+    if len(date) > 2:
+        raise ValueError("troppe date")
+    if date:
+        opzioni['dal'] = date[0]
+        opzioni['al'] = date[-1]
+    return opzioni
+
+def righe_export(opzioni):
+    """Generatore dei noleggi da esportare, filtrati senza materializzare la lista"""
+    for registro in bot_instance.storage.iter_noleggi(opzioni['dal'], opzioni['al']):
+        if opzioni['tipo'] and registro.tipo_noleggio != opzioni['tipo']:
+            continue
+        if opzioni['pag'] and registro.pagamento != opzioni['pag']:
+            continue
+        if opzioni['cliente'] and opzioni['cliente'] not in chiave_cliente(registro).casefold():
+            continue
+        if opzioni['sede'] and opzioni['sede'] != (registro.sede or '').casefold():
+            continue
+        yield registro
+
+@profilato('export_csv')
+def scrivi_export(opzioni):
+    """Serializza le righe in un buffer in memoria (eventualmente gzip).
+    
+    Restituisce (contenuto, numero_righe). Eseguito in un thread.
+    """
+    buffer = io.BytesIO()
+    binario = gzip.GzipFile(fileobj=buffer, mode='wb') if opzioni['gz'] else buffer
+    testo = io.TextIOWrapper(binario, encoding='utf-8', newline='')
+    righe = 0
+    
+    if opzioni['formato'] == 'jsonl':
+        for registro in righe_export(opzioni):
+            testo.write(json.dumps(registro.a_dict(), ensure_ascii=False) + '\n')
+            righe += 1
+    else:
+        writer = csv.writer(testo)
+        writer.writerow(INTESTAZIONI_CSV)
+        for registro in righe_export(opzioni):
+            riga = registro.a_dict()
+            writer.writerow([riga.get(campo, '') for campo in CAMPI_EXPORT])
+            righe += 1
+    
+    testo.flush()
+    testo.detach()
+    if opzioni['gz']:
+        binario.close()
+    return buffer.getvalue(), righe
+
+async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Export filtrabile per date, tipo, pagamento e cliente (CSV o JSONL)"""
+    try:
+        opzioni = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(f"❌ Argomenti non validi\n\n{USO_EXPORT}")
+        return
+    
+    try:
+        contenuto, righe = await asyncio.to_thread(scrivi_export, opzioni)
+        
+        if not righe:
+            await update.message.reply_text("📝 Nessun dato da esportare")
+            return
+        
+        periodo = ""
+        if opzioni['dal']:
+            periodo = f"_{opzioni['dal']}" if opzioni['dal'] == opzioni['al'] else f"_{opzioni['dal']}_{opzioni['al']}"
+        filename = f"noleggi{periodo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{opzioni['formato']}"
+        if opzioni['gz']:
+            filename += '.gz'
+        
+        await update.message.reply_document(
+            document=contenuto,
+            filename=filename,
+            caption=f"📊 {righe} registrazioni"
+        )
+        
+    except Exception as e:
+        logger.error(f"Errore export: {e}")
+        await update.message.reply_text("❌ Errore export")
+
+# Import dello storico (fogli di calcolo, vecchie copie di noleggi.json): in
+# streaming, validato con le regole della conversazione, a lotti
+IMPORT_LOTTO = int(os.getenv('IMPORT_LOTTO', '20000'))
+IMPORT_MAX_BYTE = 20 * 1024 * 1024  # limite di download dei file della Bot API
+IMPORT_ERRORI_MOSTRATI = 10
+
+_RE_SEPARATORI_JSON = re.compile(r'[\s,]*')
+
+def _oggetti_json(testo, buffer='', blocco=1 << 16):
+    """Elementi di un array JSON letti a blocchi, senza caricare tutto il documento"""
+    decoder = json.JSONDecoder()
+    buffer = (buffer + testo.read(blocco)).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("il documento JSON deve essere un array di noleggi")
+    pos = 1
+    while True:
+        pos = _RE_SEPARATORI_JSON.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            oggetto, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Elemento spezzato tra due blocchi (o documento davvero rotto)
+            altro = testo.read(blocco)
+            if not altro:
+                raise ValueError("documento JSON non valido o incompleto")
+            buffer, pos = buffer[pos:] + altro, 0
+            continue
+        yield oggetto
+
+def righe_documento(binario):
+    """(posizione, riga) per ogni noleggio di un CSV, di un array JSON o di un JSONL, anche .gz"""
+    if not hasattr(binario, 'peek'):
+        binario = io.BufferedReader(binario)
+    if binario.peek(2)[:2] == b'\x1f\x8b':
+        binario = gzip.GzipFile(fileobj=binario, mode='rb')
+    # utf-8-sig: i CSV salvati da Excel iniziano con il BOM
+    testo = io.TextIOWrapper(binario, encoding='utf-8-sig', newline='')
+    primo = testo.read(1)
+    while primo.isspace():
+        primo = testo.read(1)
+    
+    if primo == '[':
+        for i, oggetto in enumerate(_oggetti_json(testo, primo), 1):
+            yield f"elemento {i}", oggetto
+    elif primo == '{':
+        for i, riga in enumerate(itertools.chain([primo + testo.readline()], testo), 1):
+            if riga.strip():
+                try:
+                    yield f"riga {i}", json.loads(riga)
+                except json.JSONDecodeError:
+                    yield f"riga {i}", None
+    elif primo:
+        intestazione = primo + testo.readline()
+        # Excel in italiano separa con il punto e virgola
+        separatore = ';' if intestazione.count(';') > intestazione.count(',') else ','
+        lettore = csv.DictReader(itertools.chain([intestazione], testo), delimiter=separatore)
+        for riga in lettore:
+            yield f"riga {lettore.line_num}", riga
+
+@functools.lru_cache(maxsize=256)
+def _campo_importato(chiave):
+    """'Numero Documento' / 'Numero_Documento' -> 'numero_documento'"""
+    return str(chiave).strip().lower().replace(' ', '_')
+
+def noleggio_da_riga(riga):
+    """Noleggio da una riga importata (campi di CAMPI_EXPORT o intestazioni CSV dell'export)"""
+    if not isinstance(riga, dict):
+        raise ValueError("riga non leggibile")
+    d = {}
+    for chiave, valore in riga.items():
+        if chiave is None or valore is None:
+            continue  # colonne in più di DictReader, campi null
+        valore = valore.strip() if isinstance(valore, str) else str(valore)
+        if valore:
+            d[_campo_importato(chiave)] = valore
+    
+    for campo in ('cognome', 'nome'):
+        if campo not in d:
+            raise ValueError(f"{campo} mancante")
+    d['associato'] = str(Associato.SI) if d.get('associato', '').upper() in ('SÌ', 'SI', 'S', '1') else str(Associato.NO)
+    for campo in ('documento', 'tipo_noleggio', 'pagamento'):
+        if campo in d:
+            d[campo] = d[campo].upper()
+    
+    controlli = (
+        ('data', lambda: valida_data(d.get('data', ''))),
+        ('numero_documento', lambda: valida_numero_documento(d.get('numero_documento', ''))),
+        ('numero', lambda: valida_numero(d.get('tipo_noleggio'), d['associato'], d.get('numero', ''))),
+        ('importo', lambda: valida_importo(d.get('importo', '').replace('EUR', '').replace('€', ''))),
+    )
+    for campo, controllo in controlli:
+        try:
+            d[campo] = controllo()
+        except ValueError as e:
+            raise ValueError(f"{campo}: {e}") from None
+    
+    if 'timestamp' not in d:
+        d['timestamp'] = datetime.strptime(d['data'], '%d/%m/%Y').isoformat()
+    if 'id' in d and not _RE_ID_NOLEGGIO.match(d['id']):
+        del d['id']  # es. numeri di riga di un foglio: l'ID viene derivato dal contenuto
+    return Noleggio.da_dict(d)
+
+def impronta_noleggio(noleggio):
+    """Hash di 8 byte dei campi che identificano un noleggio (non ID e timestamp, che cambiano tra dispositivi)"""
+    chiave = '\x1f'.join((
+        giorno_iso(noleggio.data), noleggio.cognome.casefold(), noleggio.nome.casefold(),
+        documento_normalizzato(noleggio.numero_documento), solo_cifre(noleggio.telefono),
+        str(noleggio.tipo_noleggio), noleggio.dettagli, noleggio.numero, noleggio.tempo, noleggio.importo,
+    ))
+    return hashlib.blake2b(chiave.encode(), digest_size=8).digest()
+
+def importa_storico(binario, lotto=IMPORT_LOTTO):
+    """Importa un documento scartando le righe non valide e i noleggi già presenti.
+    
+    Le righe buone vanno su disco a lotti di 'lotto' con un solo flush
+    ciascuno; non partono promemoria di rientro. Eseguito in un thread.
+    """
+    inizio = time.perf_counter()
+    esito = {'letti': 0, 'importati': 0, 'duplicati': 0, 'scartati': 0, 'errori': [], 'interrotto': None}
+    
+    # Indice hash dello storico: per ID e per impronta del contenuto
+    ids, impronte = set(), set()
+    for noleggio in bot_instance.storage.iter_noleggi():
+        ids.add(noleggio.id)
+        impronte.add(impronta_noleggio(noleggio))
+    
+    with bot_instance.storage.in_blocco():
+        blocco = []
+        try:
+            for posizione, riga in righe_documento(binario):
+                esito['letti'] += 1
+                try:
+                    noleggio = noleggio_da_riga(riga)
+                except ValueError as e:
+                    esito['scartati'] += 1
+                    if len(esito['errori']) < IMPORT_ERRORI_MOSTRATI:
+                        esito['errori'].append(f"{posizione} — {e}")
+                    continue
+                impronta = impronta_noleggio(noleggio)
+                if noleggio.id in ids or impronta in impronte:
+                    esito['duplicati'] += 1
+                    continue
+                ids.add(noleggio.id)
+                impronte.add(impronta)
+                blocco.append(noleggio)
+                if len(blocco) >= lotto:
+                    bot_instance.aggiungi_storico(blocco)
+                    esito['importati'] += len(blocco)
+                    blocco = []
+        except (ValueError, UnicodeDecodeError, csv.Error, OSError) as e:
+            # Documento rotto a metà: i lotti già scritti restano, si salva anche l'ultimo
+            esito['interrotto'] = str(e)
+        if blocco:
+            bot_instance.aggiungi_storico(blocco)
+            esito['importati'] += len(blocco)
+    
+    esito['secondi'] = time.perf_counter() - inizio
+    metriche.conta('noleggi_importati', esito['importati'])
+    logger.info(f"Import: {esito['importati']} importati, {esito['duplicati']} duplicati, "
+                f"{esito['scartati']} scartati in {esito['secondi']:.1f}s")
+    return esito
+
+def riepilogo_import(esito, nome):
+    righe = [
+        f"📥 **IMPORT {nome}**",
+        f"✅ Importati: {esito['importati']}",
+        f"♻️ Già presenti: {esito['duplicati']}",
+        f"❌ Scartati: {esito['scartati']}",
+        f"⏱️ {esito['secondi']:.1f}s",
+    ]
+    if esito['errori']:
+        righe.append("\nPrimi errori:")
+        righe += [f"• {errore}" for errore in esito['errori']]
+    if esito['interrotto']:
+        righe.append(f"\n⚠️ Documento interrotto: {esito['interrotto']}")
+    return "\n".join(righe)
+
+async def importa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Prepara l'import: il prossimo documento inviato viene importato (solo admin)"""
+    if not e_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori")
+        return
+    context.user_data['importa'] = True
+    await update.message.reply_text(
+        "📥 Invia il file da importare: CSV (anche con ; come da Excel), JSON come noleggi.json o JSONL, "
+        "eventualmente .gz, max 20 MB.\nColonne come nell'export (Data, Cognome, Nome, ...)."
+    )
+
+async def importa_documento(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Documento inviato dopo /importa (o con didascalia /importa)"""
+    if not (context.user_data.pop('importa', False) or (update.message.caption or '').startswith('/importa')):
+        return
+    if not e_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori")
+        return
+    
+    documento = update.message.document
+    if documento.file_size and documento.file_size > IMPORT_MAX_BYTE:
+        await update.message.reply_text("❌ File oltre 20 MB: comprimilo in .gz o usa `python main.py importa`")
+        return
+    
+    try:
+        messaggio = await update.message.reply_text("⏳ Import in corso...")
+        file = await documento.get_file()
+        contenuto = await file.download_as_bytearray()
+        esito = await asyncio.to_thread(importa_storico, io.BytesIO(contenuto))
+        await messaggio.edit_text(riepilogo_import(esito, documento.file_name or ''))
+    except Exception as e:
+        logger.error(f"Errore import: {e}")
+        await update.message.reply_text("❌ Errore import")
+
+def importa_da_riga_di_comando(percorsi):
+    """python main.py importa FILE... (a bot fermo: scrive direttamente nello storico)"""
+    if not percorsi:
+        print("Uso: python main.py importa FILE [FILE...]  (CSV, JSON, JSONL, anche .gz)")
+        return
+    try:
+        for percorso in percorsi:
+            with open(percorso, 'rb') as f:
+                print(riepilogo_import(importa_storico(f), os.path.basename(percorso)))
+    finally:
+        bot_instance.chiudi()
+
+async def cassa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Riepilogo di cassa del giorno (o della data indicata)"""
+    data = context.args[0] if context.args else data_oggi()
+    try:
+        datetime.strptime(data, '%d/%m/%Y')
+    except ValueError:
+        await update.message.reply_text("❌ Formato errato. Uso: /cassa [DD/MM/YYYY]")
+        return
+    
+    totali = (await bot_instance.carica_giorno(data)).cassa
+    if not totali.conteggio:
+        await update.message.reply_text(f"💶 Nessun noleggio per il {data}")
+        return
+    
+    righe = [
+        f"💶 **CASSA {data}**",
+        f"🧾 Noleggi: {totali.conteggio} | Totale: {formatta_euro(totali.totale_cent)}",
+    ]
+    for titolo, gruppo in (("💳 Per pagamento:", totali.per_pagamento),
+                           ("🏄‍♂️ Per tipo:", totali.per_tipo),
+                           ("🏅 Associato:", totali.per_associato)):
+        righe.append(f"\n{titolo}")
+        for chiave, (numero, cent) in sorted(gruppo.items()):
+            righe.append(f"• {chiave}: {numero} — {formatta_euro(cent)}")
+    if totali.senza_importo:
+        righe.append(f"\n⚠️ {totali.senza_importo} noleggi senza importo leggibile")
+    
+    await update.message.reply_text("\n".join(righe))
+
+async def foto_stato(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stato dei download delle foto ricevute; '/foto_stato riprova' rimette in coda i falliti"""
+    if context.args and context.args[0].lower() == 'riprova':
+        rimessi = await coda_download.riprova_falliti(context.bot)
+        await update.message.reply_text(f"🔁 {rimessi} download rimessi in coda")
+        return
+    
+    righe = ["📸 **DOWNLOAD FOTO**", f"⏳ In corso: {len(coda_download.in_corso)}",
+             f"❌ Falliti: {len(coda_download.falliti)}"]
+    for filename, (_, errore) in coda_download.falliti.items():
+        righe.append(f"• {filename}\n   {errore}")
+    if coda_download.falliti:
+        righe.append("\n💡 /foto_stato riprova per ritentare")
+    await update.message.reply_text("\n".join(righe))
+
+# Risultati delle ultime ricerche, per sfogliarne le pagine senza ripeterle
+RICERCHE_RECENTI_MAX = 200
+ricerche_recenti = {}
+
+def pagina_ricerca(chiave, pagina):
+    testo_ricerca, ids = ricerche_recenti[chiave]
+    pagine = max(1, -(-len(ids) // CERCA_PER_PAGINA))
+    pagina = min(max(pagina, 0), pagine - 1)
+    inizio = pagina * CERCA_PER_PAGINA
+    
+    keyboard = []
+    for id_ in ids[inizio:inizio + CERCA_PER_PAGINA]:
+        n = bot_instance.trova(id_)
+        if n is None:
+            continue
+        keyboard.append([InlineKeyboardButton(
+            f"📅 {n.data} {TIPO_ICONE.get(n.tipo_noleggio, '📦')} {n.cognome} {n.nome} N.{n.numero}",
+            callback_data=f"cliente_{n.id}"
+        )])
+    if pagine > 1:
+        navigazione = []
+        if pagina > 0:
+            navigazione.append(InlineKeyboardButton("⬅️", callback_data=f"cr_{chiave}_{pagina - 1}"))
+        navigazione.append(InlineKeyboardButton(f"{pagina + 1}/{pagine}", callback_data=f"cr_{chiave}_{pagina}"))
+        if pagina < pagine - 1:
+            navigazione.append(InlineKeyboardButton("➡️", callback_data=f"cr_{chiave}_{pagina + 1}"))
+        keyboard.append(navigazione)
     
-    context.user_data['numero'] = numero_text
+    testo = (f"🔎 **{len(ids)} noleggi per \"{testo_ricerca}\"**\n\n"
+             f"Clicca su un noleggio per i dettagli del cliente:")
+    return testo, InlineKeyboardMarkup(keyboard)
+
+async def cerca(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/cerca <termini>: cognome, telefono, documento, numero tavola, note... su tutto lo storico"""
+    testo_ricerca = " ".join(context.args)
+    if not token_ricerca(testo_ricerca):
+        await update.message.reply_text("Uso: /cerca <termini>\nEs: /cerca ross 333 — cerca in cognome, nome, telefono, documento, numero e note")
+        return
     
-    # Simula callback per tempo
-    from types import SimpleNamespace
-    fake_query = SimpleNamespace()
-    fake_query.edit_message_text = lambda text, reply_markup=None: update.message.reply_text(text, reply_markup=reply_markup)
-    fake_query.message = update.message
+    ids = await bot_instance.cerca(testo_ricerca)
+    if not ids:
+        await update.message.reply_text(f"🔎 Nessun noleggio per \"{testo_ricerca}\"")
+        return
     
-    return await show_tempo_buttons(fake_query, context)
+    chiave = secrets.token_hex(4)
+    ricerche_recenti[chiave] = (testo_ricerca, ids)
+    while len(ricerche_recenti) > RICERCHE_RECENTI_MAX:
+        del ricerche_recenti[next(iter(ricerche_recenti))]
+    
+    # I risultati possono stare in giorni non in memoria: letti in un thread
+    testo, reply_markup = await asyncio.to_thread(pagina_ricerca, chiave, 0)
+    await update.message.reply_text(testo, reply_markup=reply_markup)
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Gestisce foto ricevuta"""
-    if not context.user_data.get('attende_foto', False):
-        return FOTO_RICEVUTA
+async def cambia_pagina_ricerca(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pulsanti ⬅️/➡️ dei risultati di /cerca (cr_<ricerca>_<pagina>)"""
+    query = update.callback_query
+    await query.answer()
+    _, chiave, pagina = query.data.split("_")
+    if chiave not in ricerche_recenti:
+        await query.edit_message_text("⌛ Ricerca scaduta, ripeti /cerca")
+        return
     
+    testo, reply_markup = await asyncio.to_thread(pagina_ricerca, chiave, int(pagina))
     try:
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        nome = context.user_data.get('nome', 'unknown')
-        cognome = context.user_data.get('cognome', 'unknown')
-        filename = f"{timestamp}_{cognome}_{nome}_ricevuta.jpg"
-        filepath = os.path.join(PHOTOS_DIR, filename)
-        
-        await file.download_to_drive(filepath)
-        context.user_data['foto_ricevuta'] = filename
-        
-        await update.message.reply_text("✅ Foto salvata!\n\nAggiungi NOTE? (o 'skip'):")
-        return NOTE
-        
-    except Exception as e:
-        logger.error(f"Errore foto: {e}")
-        await update.message.reply_text("⚠️ Errore foto\n\nAggiungi NOTE? (o 'skip'):")
-        context.user_data['foto_ricevuta'] = None
-        return NOTE
+        await query.edit_message_text(testo, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
 
-async def get_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Riceve note e passa al salvataggio con pulsanti"""
-    note_text = update.message.text.strip()
+async def disponibili(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Unità libere e fuori adesso, per tipo e modello, con i rientri previsti"""
+    attivi = bot_instance.noleggi_attivi()
+    per_modello = attivi.per_modello()
+    righe = [f"🟢 **DISPONIBILITÀ ORE {datetime.now():%H:%M}**"]
     
-    if note_text.lower() == 'skip':
-        context.user_data['note'] = None
-    else:
-        context.user_data['note'] = note_text
+    # Tipi/modelli dell'inventario più quelli fuori ma non configurati
+    tipi = {tipo: dict(modelli) for tipo, modelli in INVENTARIO.items()}
+    for tipo, modello in per_modello:
+        tipi.setdefault(tipo, {}).setdefault(modello, None)
     
-    # Simula un callback query per usare la versione con pulsanti
-    from types import SimpleNamespace
-    fake_query = SimpleNamespace()
-    fake_query.edit_message_text = lambda text, reply_markup=None: update.message.reply_text(text, reply_markup=reply_markup)
-    fake_query.message = update.message
+    for tipo, modelli in tipi.items():
+        righe.append(f"\n{TIPO_ICONE.get(tipo, '📦')} **{tipo}**")
+        for modello, unita in modelli.items():
+            fuori = sorted(per_modello.get((tipo, modello), {}).values(), key=lambda n: attivi.rientro(n.id))
+            totale = unita_modello(tipo, modello)
+            stato = f"{max(totale - len(fuori), 0)}/{totale} liberi" if totale is not None else f"{len(fuori)} fuori"
+            righe.append(f"• {modello or tipo}: {stato}")
+            if fuori:
+                righe.append("   ⏳ " + ", ".join(
+                    f"N.{n.numero}→{attivi.rientro(n.id):%H:%M}" if n.numero else f"→{attivi.rientro(n.id):%H:%M}"
+                    for n in fuori
+                ))
+            if isinstance(unita, list):
+                occupate = {numero_unita(n.numero) for n in fuori}
+                liberi = [str(u) for u in unita if numero_unita(u) not in occupate]
+                if liberi:
+                    righe.append("   ✅ " + ", ".join(liberi))
     
-    return await salva_registrazione_callback(fake_query, context)
+    await update.message.reply_text("\n".join(righe))
 
-async def handle_text_in_foto_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Gestisce testo ricevuto durante stato foto (per note dirette)"""
-    note_text = update.message.text.strip()
-    
-    if note_text.lower() == 'skip':
-        context.user_data['note'] = None
-        context.user_data['foto_ricevuta'] = None
-    else:
-        context.user_data['note'] = note_text
-        context.user_data['foto_ricevuta'] = None
+async def segna_rientrato(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pulsante "Rientrato" dei promemoria (rientrato_<id>)"""
+    query = update.callback_query
+    id_ = query.data.replace("rientrato_", "")
+    nuovo = await promemoria_rientri.segna_rientrato(id_)
+    await query.answer("✅ Segnato come rientrato" if nuovo else "Già segnato come rientrato")
     
-    return await salva_registrazione(update, context)
+    # Toglie il pulsante dal messaggio, che può elencare altri noleggi
+    markup = query.message.reply_markup if query.message else None
+    if markup is not None:
+        righe = [riga for riga in markup.inline_keyboard
+                 if not any(p.callback_data == query.data for p in riga)]
+        try:
+            await query.edit_message_reply_markup(InlineKeyboardMarkup(righe) if righe else None)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
 
-async def salva_registrazione_callback(query, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Salva registrazione quando viene da callback (senza note)"""
-    try:
-        registrazione = {
-            'data': context.user_data['data'],
-            'cognome': context.user_data['cognome'],
-            'nome': context.user_data['nome'],
-            'documento': context.user_data['documento'],
-            'numero_documento': context.user_data['numero_documento'],
-            'telefono': context.user_data['telefono'],
-            'associato': context.user_data['associato'],
-            'tipo_noleggio': context.user_data['tipo_noleggio'],
-            'dettagli': context.user_data.get('dettagli', ''),
-            'numero': context.user_data.get('numero', ''),
-            'tempo': context.user_data['tempo'],
-            'pagamento': context.user_data['pagamento'],
-            'importo': context.user_data.get('importo', ''),
-            'foto_ricevuta': context.user_data.get('foto_ricevuta'),
-            'note': context.user_data.get('note'),
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        bot_instance.noleggi.append(registrazione)
-        bot_instance.save_data()
-        
-        # Salva i dati cliente per eventuali noleggi aggiuntivi
-        if 'cliente_base' not in context.user_data:
-            context.user_data['cliente_base'] = {
-                'data': context.user_data['data'],
-                'cognome': context.user_data['cognome'],
-                'nome': context.user_data['nome'],
-                'documento': context.user_data['documento'],
-                'numero_documento': context.user_data['numero_documento'],
-                'telefono': context.user_data['telefono'],
-                'associato': context.user_data['associato']
-            }
-        
-        messaggio = f"""
-✅ **NOLEGGIO REGISTRATO!**
+# Utenti Telegram (ID numerici separati da virgola) abilitati ai comandi di amministrazione
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
 
-👤 {registrazione['cognome']} {registrazione['nome']}
-🏄‍♂️ {registrazione['tipo_noleggio']} {registrazione['dettagli']}
-🔢 N. {registrazione['numero']}
-⏱️ {registrazione['tempo']}
-💰 {registrazione['importo']}
-        """
-        
-        # Pulsanti per aggiungere altro o finire
-        keyboard = [
-            [InlineKeyboardButton("➕ Aggiungi altro noleggio", callback_data="altro_noleggio")],
-            [InlineKeyboardButton("✅ Finito", callback_data="finito")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(messaggio + "\n\n🤔 Vuole noleggiare altro?", reply_markup=reply_markup)
-        
-        return TIPO_NOLEGGIO  # Resta nello stato per gestire altri noleggi
-        
-    except Exception as e:
-        logger.error(f"Errore salvataggio: {e}")
-        await query.edit_message_text("❌ Errore salvataggio")
-        context.user_data.clear()
-        return ConversationHandler.END
+def e_admin(update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
 
-async def salva_registrazione(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Salva registrazione completa - FINISCE conversazione"""
-    try:
-        registrazione = {
-            'data': context.user_data['data'],
-            'cognome': context.user_data['cognome'],
-            'nome': context.user_data['nome'],
-            'documento': context.user_data['documento'],
-            'numero_documento': context.user_data['numero_documento'],
-            'telefono': context.user_data['telefono'],
-            'associato': context.user_data['associato'],
-            'tipo_noleggio': context.user_data['tipo_noleggio'],
-            'dettagli': context.user_data.get('dettagli', ''),
-            'numero': context.user_data.get('numero', ''),
-            'tempo': context.user_data['tempo'],
-            'pagamento': context.user_data['pagamento'],
-            'importo': context.user_data.get('importo', ''),
-            'foto_ricevuta': context.user_data.get('foto_ricevuta'),
-            'note': context.user_data.get('note'),
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        bot_instance.noleggi.append(registrazione)
-        bot_instance.save_data()
-        
-        messaggio = f"""
-✅ **REGISTRAZIONE COMPLETATA!**
+def file_dati():
+    """File dello storico presenti su disco"""
+    partizioni = [os.path.join(PARTIZIONI_DIR, f) for f in os.listdir(PARTIZIONI_DIR)] \
+        if os.path.isdir(PARTIZIONI_DIR) else []
+    return [f for f in [DATA_FILE, JOURNAL_FILE, DB_FILE, DB_FILE + '-wal'] + partizioni if os.path.exists(f)]
 
-👤 {registrazione['cognome']} {registrazione['nome']}
-🏄‍♂️ {registrazione['tipo_noleggio']} {registrazione['dettagli']}
-🔢 N. {registrazione['numero']}
-⏱️ {registrazione['tempo']}
-💰 {registrazione['importo']}
+def indicatori():
+    """Valori istantanei per /stats e Prometheus"""
+    return {
+        'noleggi_totali': bot_instance.storage.conta(),
+        'file_dati_byte': sum(os.path.getsize(f) for f in file_dati()),
+        'mesi_in_memoria': len(getattr(bot_instance.storage, 'in_memoria', list)()),
+        'download_foto_in_corso': len(coda_download.in_corso),
+        'download_foto_falliti_attuali': len(coda_download.falliti),
+        'avvio_timestamp': int(metriche.avvio),
+    }
 
-💡 Usa /nuovo per registrare un altro cliente
-💡 Usa /mostra_noleggi per vedere tutti i clienti di oggi
-        """
-        
-        await update.message.reply_text(messaggio)
-        context.user_data.clear()
-        return ConversationHandler.END
-        
-    except Exception as e:
-        logger.error(f"Errore salvataggio: {e}")
-        await update.message.reply_text("❌ Errore salvataggio")
-        context.user_data.clear()
-        return ConversationHandler.END
+def _durata(ms):
+    return f"{ms:.0f}ms" if ms < 1000 else f"{ms / 1000:.1f}s"
 
-async def mostra_noleggi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Mostra SOLO i noleggi di oggi raggruppati per cliente"""
-    noleggi_oggi = bot_instance.get_noleggi_oggi()
-    
-    if not noleggi_oggi:
-        oggi = datetime.now().strftime('%d/%m/%Y')
-        await update.message.reply_text(f"📅 **Nessun noleggio per oggi ({oggi})**")
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Latenze degli handler e della Bot API, flush e dimensione dello storico (solo admin)"""
+    if not e_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori")
         return
     
-    # Raggruppa per cliente
-    clienti_noleggi = defaultdict(list)
-    for noleggio in noleggi_oggi:
-        nome_completo = f"{noleggio.get('cognome', '')} {noleggio.get('nome', '')}"
-        clienti_noleggi[nome_completo].append(noleggio)
+    valori = indicatori()
+    attivo = int(time.time() - metriche.avvio)
+    righe = [
+        f"📊 **STATISTICHE** (attivo da {attivo // 3600}h {attivo % 3600 // 60}m)",
+        f"🗄️ Noleggi: {valori['noleggi_totali']} | file: {valori['file_dati_byte'] / 1048576:.1f} MB ({STORAGE_BACKEND})",
+    ]
+    if isinstance(bot_instance.storage, PartitionedStorage):
+        mesi = bot_instance.storage.in_memoria()
+        scaricati = sum(v for _, v in metriche.contatori_di('partizioni_scaricate'))
+        righe.append(f"🗂️ Mesi in memoria: {len(mesi)} ({', '.join(mesi[-6:])}), {scaricati} scaricati dall'LRU")
+    if SEDE or bot_instance.storage.condiviso:
+        sincronizzati = sum(v for _, v in metriche.contatori_di('noleggi_sincronizzati'))
+        righe.append(f"📍 Sede: {SEDE or '-'} | noleggi da altri processi: {sincronizzati}")
     
-    # Crea pulsanti inline per ogni cliente
-    keyboard = []
-    cliente_index = 0
+    noleggi_scritti = sum(v for _, v in metriche.contatori_di('flush_noleggi'))
+    for etichette, h in sorted(metriche.istogrammi_di('flush_ms'), key=lambda x: x[0]['tipo']):
+        extra = f", {noleggi_scritti / h.numero:.1f} noleggi/flush" if etichette['tipo'] == 'noleggi' else ""
+        righe.append(f"💾 Flush {etichette['tipo']}: {h.numero}× media {_durata(h.media)} max {_durata(h.massimo)}{extra}")
     
-    for nome_cliente, noleggi_cliente in clienti_noleggi.items():
-        # Crea stringa con tutti i noleggi del cliente
-        noleggi_str = ""
-        ha_foto = False
-        
-        for noleggio in noleggi_cliente:
-            tipo_icon = {"SUP": "🏄‍♂️", "KAYAK": "🚣‍♂️", "LETTINO": "🏖️", "PHONEBAG": "📱", "DRYBAG": "🎒"}.get(noleggio['tipo_noleggio'], "📦")
-            noleggi_str += f"{tipo_icon}"
-            if noleggio.get('foto_ricevuta'):
-                ha_foto = True
-        
-        # Aggiungi icona foto se almeno un noleggio ha foto
-        foto_icon = " 📸" if ha_foto else ""
-        
-        button_text = f"{noleggi_str} {nome_cliente} ({len(noleggi_cliente)}){foto_icon}"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"cliente_{cliente_index}")])
-        cliente_index += 1
+    errori_handler = defaultdict(int)
+    for etichette, valore in metriche.contatori_di('handler_errori'):
+        errori_handler[(etichette['handler'], etichette['stato'])] += valore
+    handler = sorted(metriche.istogrammi_di('handler_ms'), key=lambda x: x[1].quantile(0.95), reverse=True)
+    if handler:
+        righe.append("\n⏱️ **Handler (p95 più alti):**")
+        for etichette, h in handler[:12]:
+            stato = f" [{etichette['stato']}]" if etichette['stato'] != '-' else ""
+            errori = errori_handler.get((etichette['handler'], etichette['stato']))
+            righe.append(f"• {etichette['handler']}{stato}: {h.numero}× media {_durata(h.media)} "
+                         f"p95 ≤{_durata(h.quantile(0.95))}" + (f" ❌{errori}" if errori else ""))
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    errori_api = defaultdict(int)
+    for etichette, valore in metriche.contatori_di('botapi_errori'):
+        errori_api[etichette['metodo']] += valore
+    chiamate = sorted(metriche.istogrammi_di('botapi_ms'), key=lambda x: x[1].numero, reverse=True)
+    if chiamate:
+        righe.append("\n📡 **Bot API:**")
+        for etichette, h in chiamate[:10]:
+            errori = errori_api.get(etichette['metodo'])
+            righe.append(f"• {etichette['metodo']}: {h.numero}× media {_durata(h.media)} "
+                         f"p95 ≤{_durata(h.quantile(0.95))}" + (f" ❌{errori}" if errori else ""))
     
-    oggi = datetime.now().strftime('%d/%m/%Y')
-    totale_clienti = len(clienti_noleggi)
-    totale_noleggi = len(noleggi_oggi)
+    ripetuti = sum(v for _, v in metriche.contatori_di('download_tentativi_ripetuti'))
+    falliti = sum(v for _, v in metriche.contatori_di('download_falliti'))
+    righe.append(f"\n📸 Download foto: {valori['download_foto_in_corso']} in corso, "
+                 f"{ripetuti} tentativi ripetuti, {falliti} abbandonati")
     
-    await update.message.reply_text(
-        f"📅 **NOLEGGI DI OGGI ({oggi})**\n"
-        f"👥 Clienti: {totale_clienti} | 🏄‍♂️ Noleggi: {totale_noleggi}\n\n"
-        f"📸 = con foto ricevuta\n"
-        f"(n) = numero noleggi\n"
-        f"Clicca su un cliente per i dettagli:",
-        reply_markup=reply_markup
-    )
+    await update.message.reply_text("\n".join(righe))
 
-async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Export CSV semplificato"""
-    if not bot_instance.noleggi:
-        await update.message.reply_text("📝 Nessun dato da esportare")
+USO_PROFILO = (
+    "Uso: /profilo [secondi] [handler,...] | /profilo stato | /profilo stop\n"
+    f"Default: {PROFILO_SECONDI}s su {PROFILO_HANDLER}"
+)
+
+async def profilo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Apre una finestra di profilazione (cProfile + tracemalloc) e invia il rapporto alla chiusura (solo admin)"""
+    if not e_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori")
         return
     
-    try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        csv_filename = f"noleggi_{timestamp}.csv"
-        
-        with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['Data', 'Cognome', 'Nome', 'Telefono', 'Tipo_Noleggio', 'Tempo', 'Importo']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            writer.writeheader()
-            for registro in bot_instance.noleggi:
-                writer.writerow({
-                    'Data': registro['data'],
-                    'Cognome': registro.get('cognome', ''),
-                    'Nome': registro.get('nome', ''),
-                    'Telefono': registro['telefono'],
-                    'Tipo_Noleggio': registro['tipo_noleggio'],
-                    'Tempo': registro['tempo'],
-                    'Importo': registro.get('importo', '')
-                })
-        
-        with open(csv_filename, 'rb') as f:
-            await update.message.reply_document(
-                document=f,
-                filename=csv_filename,
-                caption=f"📊 {len(bot_instance.noleggi)} registrazioni"
-            )
-        
-        os.remove(csv_filename)
-        
-    except Exception as e:
-        logger.error(f"Errore export: {e}")
-        await update.message.reply_text("❌ Errore export")
+    args = [a.lower() for a in context.args or []]
+    if args[:1] in (['stop'], ['ferma']):
+        if not profilatore.attivo:
+            await update.message.reply_text("ℹ️ Nessuna profilazione in corso")
+            return
+        await update.message.reply_text("⏳ Chiusura della profilazione, preparo il rapporto...")
+        await profilatore.concludi(context.bot)
+        return
+    if args[:1] == ['stato'] or (profilatore.attivo and not args):
+        if not profilatore.attivo:
+            await update.message.reply_text(f"ℹ️ Nessuna profilazione in corso\n\n{USO_PROFILO}")
+            return
+        await update.message.reply_text(
+            f"🔬 Profilazione in corso su {', '.join(sorted(profilatore.handler))}\n"
+            f"⏱️ Mancano {max(profilatore.scadenza - time.time(), 0):.0f}s — /profilo stop per chiudere ora"
+        )
+        return
+    if profilatore.attivo:
+        await update.message.reply_text("⚠️ Profilazione già in corso (/profilo stato, /profilo stop)")
+        return
+    
+    secondi, nomi = PROFILO_SECONDI, PROFILO_HANDLER
+    for arg in context.args or []:
+        if arg.isdigit():
+            secondi = int(arg)
+        else:
+            nomi = arg
+    handler = {n for n in nomi.replace(' ', '').split(',') if n}
+    sconosciuti = handler - profilatore.noti
+    if secondi <= 0 or not handler or sconosciuti:
+        errore = f"Handler sconosciuti: {', '.join(sorted(sconosciuti))}\n" if sconosciuti else ""
+        await update.message.reply_text(
+            f"❌ {errore}{USO_PROFILO}\n\nDisponibili: {', '.join(sorted(profilatore.noti))}")
+        return
+    
+    profilatore.avvia(context.application, handler, secondi, [update.effective_chat.id])
+    memoria = " + tracemalloc (processo più lento durante la finestra)" if PROFILO_MEMORIA else ""
+    await update.message.reply_text(
+        f"🔬 Profilazione avviata per {secondi}s su {', '.join(sorted(handler))}{memoria}\n"
+        f"📁 Rapporto in {PROFILO_DIR}/ e qui in chat alla chiusura"
+    )
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancella operazione"""
@@ -816,7 +3522,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 /nuovo - Nuova registrazione noleggio
 /mostra_noleggi - Clienti di oggi (raggruppati)
-/export - Esporta tutti i dati CSV
+/export - Esporta i dati (CSV/JSONL, filtri per date, tipo, pagamento, cliente, sede)
+/importa - Importa storico da CSV/JSON/JSONL (solo admin)
+/cassa [data] - Totali di cassa del giorno
+/disponibili - Attrezzatura libera e fuori adesso, con rientri
+/stats - Tempi di risposta e statistiche (solo admin)
+/profilo [secondi] - Profilazione degli handler (solo admin)
+/cerca <termini> - Cerca in tutto lo storico (cognome, telefono, documento, numero, note)
+/foto_stato - Download foto ricevute in corso/falliti
 /help - Questa guida
 /cancel - Annulla operazione
 
@@ -825,6 +3538,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 • Stesso cliente = dati già compilati
 • Esempio: SUP + 2 PHONEBAG + LETTINO
 
+**🔁 CLIENTI ABITUALI:**
+• Dopo la data premi "Cliente abituale"
+• Scrivi l'inizio del telefono o del documento
+• Scegli il cliente: si passa subito al tipo noleggio
+
 **📅 VISTA GIORNALIERA:**
 • `/mostra_noleggi` raggruppa per cliente
 • Mostra tutti i noleggi per persona
@@ -837,42 +3555,347 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     """
     await update.message.reply_text(help_text)
 
-def main():
-    """Avvia il bot"""
-    TOKEN = os.getenv('BOT_TOKEN')
+async def sincronizza_processi(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: noleggi e rientri scritti dagli altri processi sullo stesso archivio"""
+    try:
+        await bot_instance.sincronizza()
+        await promemoria_rientri.sincronizza()
+    except Exception as e:
+        logger.error(f"Sincronizzazione con gli altri processi fallita: {e}")
+
+async def recupera_foto(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job all'avvio: dopo l'indicizzazione, foto dei noleggi rimaste senza file su disco"""
+    await bot_instance.indici_pronti()
+    await coda_download.recupera(context.bot, bot_instance.foto_mancanti)
+    bot_instance.foto_mancanti = []
+
+async def post_init(application: Application) -> None:
+    """Indicizza lo storico in background, riprende promemoria di rientro e foto mancanti, avvia metriche e profilazione"""
+    # Thread a parte: post_init gira prima che l'Application sia avviata
+    threading.Thread(target=bot_instance._carica_indici, name='carica-indici', daemon=True).start()
+    promemoria_rientri.avvia(application)
+    if application.job_queue is not None:
+        application.job_queue.run_once(recupera_foto, 0, name='recupera_foto')
+    if bot_instance.storage.condiviso and application.job_queue is not None:
+        # Archivio condiviso con altri processi (altre sedi): indici e rientri aggiornati a intervalli
+        application.job_queue.run_repeating(sincronizza_processi, SINCRONIZZA_SECONDI, name='sincronizza')
+    if server_metriche is not None:
+        await server_metriche.avvia()
+    if PROFILO_ALL_AVVIO:
+        # Rapporto in PROFILO_DIR e in privato agli admin
+        profilatore.avvia(application, PROFILO_HANDLER.replace(' ', '').split(','), PROFILO_SECONDI, ADMIN_IDS)
+
+async def post_shutdown(application: Application) -> None:
+    """Svuota download e scritture in sospeso prima di uscire"""
+    if profilatore.attivo:
+        await profilatore.concludi(application.bot)
+    if server_metriche is not None:
+        await server_metriche.ferma()
+    await coda_download.ferma()
+    bot_instance.chiudi()
+
+# Persistenza delle conversazioni in corso (sopravvivono a riavvii e redeploy)
+# Una per sede: ogni processo ha il suo bot e le sue conversazioni in corso
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', f"conversazioni_{re.sub(r'[^0-9a-z]+', '_', SEDE.lower())}.db"
+                             if SEDE else 'conversazioni.db')
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+
+class PersistenzaIncrementale(BasePersistence):
+    """Salva user_data e stati della conversazione in SQLite, solo per le chat modificate.
     
-    if not TOKEN:
-        print("❌ Token mancante!")
-        return
+    L'Application chiama update_* ogni PERSISTENCE_INTERVAL secondi e solo per
+    utenti/conversazioni cambiati; qui le modifiche di un giro vengono raccolte
+    e scritte in un'unica transazione, fuori dall'event loop.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stato (
+            tipo TEXT NOT NULL,
+            chiave TEXT NOT NULL,
+            valore TEXT NOT NULL,
+            PRIMARY KEY (tipo, chiave)
+        )
+    """
+    
+    def __init__(self, filepath=PERSISTENCE_FILE, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._in_sospeso = {}  # (tipo, chiave) -> valore JSON, None = da cancellare
+        self._flush_task = None
+    
+    def _leggi(self, tipo):
+        with self._lock:
+            return self.conn.execute("SELECT chiave, valore FROM stato WHERE tipo = ?", (tipo,)).fetchall()
+    
+    def _scrivi(self, lotto):
+        inizio = time.perf_counter()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO stato (tipo, chiave, valore) VALUES (?, ?, ?)",
+                [(tipo, chiave, valore) for (tipo, chiave), valore in lotto.items() if valore is not None]
+            )
+            self.conn.executemany(
+                "DELETE FROM stato WHERE tipo = ? AND chiave = ?",
+                [chiave for chiave, valore in lotto.items() if valore is None]
+            )
+        metriche.osserva('flush_ms', (time.perf_counter() - inizio) * 1000, tipo='conversazioni')
+    
+    def _metti_in_coda(self, tipo, chiave, valore):
+        self._in_sospeso[(tipo, chiave)] = valore
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_lotto())
+    
+    async def _flush_lotto(self):
+        # Lascia arrivare tutte le update_* dello stesso giro, poi scrive una volta sola
+        await asyncio.sleep(0)
+        lotto, self._in_sospeso = self._in_sospeso, {}
+        if lotto:
+            await asyncio.to_thread(self._scrivi, lotto)
+    
+    async def get_user_data(self):
+        return {int(chiave): json.loads(valore) for chiave, valore in self._leggi('user')}
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name):
+        return {tuple(json.loads(chiave)): json.loads(valore) for chiave, valore in self._leggi(f'conv:{name}')}
+    
+    async def update_conversation(self, name, key, new_state):
+        valore = None if new_state is None else json.dumps(new_state)
+        self._metti_in_coda(f'conv:{name}', json.dumps(list(key)), valore)
+    
+    async def update_user_data(self, user_id, data):
+        self._metti_in_coda('user', str(user_id), json.dumps(data, ensure_ascii=False) if data else None)
+    
+    async def drop_user_data(self, user_id):
+        self._metti_in_coda('user', str(user_id), None)
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        lotto, self._in_sospeso = self._in_sospeso, {}
+        if lotto:
+            self._scrivi(lotto)
+        with self._lock:
+            self.conn.close()
+
+# Callback delle viste (dettaglio cliente, foto, pagine): gestiti dagli handler
+# globali anche a conversazione aperta, senza interrompere la registrazione
+PATTERN_REGISTRAZIONE = r'^(?!cliente_|foto_[0-9a-f]{14}$|mnl?_|cr_|rientrato_)'
+
+# Update gestiti in parallelo (chat diverse); 1 = sequenziale come prima
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+
+class ProcessoreOrdinatoPerChat(BaseUpdateProcessor):
+    """Gestisce update di chat diverse in parallelo, quelli della stessa chat in ordine.
+    
+    Ogni chat (o utente, se l'update non ha chat) ha un asyncio.Lock: i lock
+    asyncio sono FIFO, quindi gli update della stessa chat vengono eseguiti
+    nell'ordine di arrivo e la conversazione non vede mai passi invertiti.
+    
+    Il limite di update in esecuzione è un semaforo proprio, preso solo dopo
+    il lock della chat: chi aspetta il turno della propria chat non occupa
+    posti, così una raffica dalla stessa chat non blocca le altre. A PTB si
+    passa un limite che non scatta mai (il suo semaforo avvolge anche l'attesa).
+    """
+    
+    LIMITE_PTB = 1_000_000
+    
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError("MAX_CONCURRENT_UPDATES deve essere almeno 1")
+        super().__init__(self.LIMITE_PTB)
+        self._posti = asyncio.Semaphore(max_concurrent_updates)
+        self._lock_chat = {}
+        self._in_attesa = defaultdict(int)
+    
+    @staticmethod
+    def _chiave(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        chiave = self._chiave(update)
+        if chiave is None:
+            async with self._posti:
+                await coroutine
+            return
+        
+        lock = self._lock_chat.setdefault(chiave, asyncio.Lock())
+        self._in_attesa[chiave] += 1
+        try:
+            async with lock, self._posti:
+                await coroutine
+        finally:
+            self._in_attesa[chiave] -= 1
+            if not self._in_attesa[chiave]:
+                # Nessun altro update in coda per questa chat: libera il lock
+                del self._in_attesa[chiave]
+                del self._lock_chat[chiave]
+    
+    async def initialize(self):
+        pass
     
-    application = Application.builder().token(TOKEN).build()
+    async def shutdown(self):
+        pass
+
+class RichiestaMisurata(BaseRequest):
+    """Trasporto della Bot API che misura ogni chiamata (durata ed errori per metodo)"""
+    
+    def __init__(self, interna):
+        self._interna = interna
+    
+    @property
+    def read_timeout(self):
+        return self._interna.read_timeout
+    
+    async def initialize(self):
+        await self._interna.initialize()
+    
+    async def shutdown(self):
+        await self._interna.shutdown()
+    
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        metodo = 'download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        inizio = time.perf_counter()
+        try:
+            codice, corpo = await self._interna.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        except Exception as e:
+            metriche.conta('botapi_errori', metodo=metodo, errore=type(e).__name__)
+            raise
+        finally:
+            metriche.osserva('botapi_ms', (time.perf_counter() - inizio) * 1000, metodo=metodo)
+        if codice >= 400:
+            metriche.conta('botapi_errori', metodo=metodo, errore=f"HTTP {codice}")
+        return codice, corpo
+
+def strumenta(callback, stato):
+    """Avvolge un callback per misurarne durata ed eccezioni, per handler e stato della conversazione"""
+    nome = callback.__name__
+    profilatore.noti.add(nome)
+    
+    @functools.wraps(callback)
+    async def misurato(update, context):
+        inizio = time.perf_counter()
+        profilo = profilatore.entra(nome)
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            metriche.conta('handler_errori', handler=nome, stato=stato, errore=type(e).__name__)
+            raise
+        finally:
+            profilatore.esci(profilo)
+            metriche.osserva('handler_ms', (time.perf_counter() - inizio) * 1000, handler=nome, stato=stato)
+    
+    return misurato
+
+def strumenta_handlers(application):
+    """Misura tutti gli handler registrati, compresi quelli di ogni stato della conversazione"""
+    for gruppo in application.handlers.values():
+        for handler in gruppo:
+            if isinstance(handler, ConversationHandler):
+                gruppi = [('ingresso', handler.entry_points), ('fallback', handler.fallbacks)]
+                gruppi += [(NOMI_STATI.get(stato, str(stato)), interni) for stato, interni in handler.states.items()]
+                for stato, interni in gruppi:
+                    for interno in interni:
+                        interno.callback = strumenta(interno.callback, stato)
+            else:
+                handler.callback = strumenta(handler.callback, '-')
+
+def crea_application(token, request=None, webhook=False):
+    """Costruisce l'Application con tutti gli handler registrati"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ProcessoreOrdinatoPerChat(MAX_CONCURRENT_UPDATES))
+        .persistence(PersistenzaIncrementale())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Tutte le chiamate alla Bot API (escluso il long polling di getUpdates) passano dalle metriche
+    builder = builder.request(RichiestaMisurata(request or HTTPXRequest(connection_pool_size=256)))
+    if webhook:
+        # In modalità webhook gli update arrivano da ServerWebhook, non dall'Updater
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Conversation handler principale
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("nuovo", start)],
         states={
             DATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_data)],
-            COGNOME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_cognome)],
+            COGNOME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_cognome),
+                CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)
+            ],
+            RICERCA_CLIENTE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, cerca_cliente_abituale),
+                CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)
+            ],
             NOME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_nome)],
-            DOCUMENTO: [CallbackQueryHandler(handle_callback)],
+            DOCUMENTO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
             NUMERO_DOCUMENTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_numero_documento)],
             TELEFONO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_telefono)],
-            ASSOCIATO: [CallbackQueryHandler(handle_callback)],
-            TIPO_NOLEGGIO: [CallbackQueryHandler(handle_callback)],
-            DETTAGLI_SUP: [CallbackQueryHandler(handle_callback)],
-            DETTAGLI_LETTINO: [CallbackQueryHandler(handle_callback)],
+            ASSOCIATO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
+            TIPO_NOLEGGIO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
+            DETTAGLI_SUP: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
+            DETTAGLI_LETTINO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
             LETTINO_NUMERO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_lettino_numero)],
-            TEMPO: [CallbackQueryHandler(handle_callback)],
-            PAGAMENTO: [CallbackQueryHandler(handle_callback)],
+            TEMPO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
+            PAGAMENTO: [CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE)],
             IMPORTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_importo)],
             FOTO_RICEVUTA: [
-                CallbackQueryHandler(handle_callback),
+                CallbackQueryHandler(handle_callback, pattern=PATTERN_REGISTRAZIONE),
                 MessageHandler(filters.PHOTO, handle_photo),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_in_foto_state)
             ],
             NOTE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_note)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="registrazione",
+        persistent=True,
     )
     
     # Aggiungi handlers
@@ -880,15 +3903,220 @@ def main():
     application.add_handler(CommandHandler(["start", "help"], help_command))
     application.add_handler(CommandHandler("mostra_noleggi", mostra_noleggi))
     application.add_handler(CommandHandler("export", export_csv))
+    application.add_handler(CommandHandler("importa", importa))
+    application.add_handler(MessageHandler(filters.Document.ALL, importa_documento))
+    application.add_handler(CommandHandler("cassa", cassa))
+    application.add_handler(CommandHandler("foto_stato", foto_stato))
+    application.add_handler(CommandHandler("cerca", cerca))
+    application.add_handler(CommandHandler("disponibili", disponibili))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profilo", profilo))
     
     # Handler per i callback di mostra_noleggi (fuori dalla conversazione) - PATTERN SPECIFICO
-    application.add_handler(CallbackQueryHandler(handle_callback, pattern="^cliente_[0-9]+$"))
-    application.add_handler(CallbackQueryHandler(handle_callback, pattern="^foto_[0-9]+$"))
+    application.add_handler(CallbackQueryHandler(handle_callback, pattern="^cliente_[0-9a-f]{14}$"))
+    application.add_handler(CallbackQueryHandler(handle_callback, pattern="^foto_[0-9a-f]{14}$"))
+    application.add_handler(CallbackQueryHandler(cambia_pagina_noleggi, pattern="^mnl?_[0-9]{6}_"))
+    application.add_handler(CallbackQueryHandler(cambia_pagina_ricerca, pattern="^cr_[0-9a-f]{8}_[0-9]+$"))
+    application.add_handler(CallbackQueryHandler(segna_rientrato, pattern="^rientrato_[0-9a-f]{14}$"))
+    
+    strumenta_handlers(application)
+    
+    return application
+
+# Modalità di avvio: 'polling' (default) oppure 'webhook'
+RUN_MODE = os.getenv('RUN_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')           # URL pubblico, es. https://noleggiosup.herokuapp.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))       # PORT è quella assegnata dalla piattaforma (Procfile)
+# Senza WEBHOOK_SECRET se ne genera uno, valido solo se è il bot a registrare il webhook (WEBHOOK_URL)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+class ServerWebhook:
+    """Listener HTTP minimale (solo stdlib) che passa gli Update all'Application.
+    
+    Risponde subito 200 a Telegram e mette l'update nella update_queue: la
+    gestione avviene poi come in polling.
+    """
+    
+    RISPOSTE = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large'}
+    
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._server = None
+    
+    async def avvia(self):
+        self._server = await asyncio.start_server(self._connessione, self.listen, self.port)
+        # Con port=0 il sistema sceglie una porta libera
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook in ascolto su {self.listen}:{self.port}{self.path}")
+    
+    async def ferma(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _connessione(self, reader, writer):
+        try:
+            try:
+                stato = await self._richiesta(reader)
+            except (asyncio.IncompleteReadError, ValueError, TypeError, KeyError,
+                    AttributeError, UnicodeDecodeError) as e:
+                # Anche un JSON valido che non è un Update (es. [] o "x")
+                logger.warning(f"Webhook: richiesta non valida ({e!r})")
+                stato = 400
+            writer.write(
+                f"HTTP/1.1 {stato} {self.RISPOSTE[stato]}\r\n"
+                f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode()
+            )
+            await writer.drain()
+        except ConnectionError as e:
+            logger.warning(f"Webhook: connessione interrotta ({e})")
+        finally:
+            writer.close()
+    
+    async def _richiesta(self, reader):
+        metodo, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        intestazioni = {}
+        while True:
+            riga = await reader.readline()
+            if riga in (b'\r\n', b'\n', b''):
+                break
+            nome, _, valore = riga.decode('latin-1').partition(':')
+            intestazioni[nome.strip().lower()] = valore.strip()
+        
+        if path != self.path:
+            return 404
+        if metodo != 'POST':
+            return 405
+        if self.secret and intestazioni.get('x-telegram-bot-api-secret-token') != self.secret:
+            return 403
+        lunghezza = int(intestazioni.get('content-length', '0'))
+        if lunghezza > WEBHOOK_MAX_BODY:
+            return 413
+        
+        corpo = await reader.readexactly(lunghezza)
+        dati = json.loads(corpo)
+        if not isinstance(dati, dict):
+            return 400
+        update = Update.de_json(dati, self.application.bot)
+        await self.application.update_queue.put(update)
+        return 200
+
+# Endpoint Prometheus opzionale, solo in locale salvo METRICS_HOST diverso
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+class ServerMetriche:
+    """GET /metrics in formato testo Prometheus"""
+    
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+    
+    async def avvia(self):
+        self._server = await asyncio.start_server(self._connessione, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Metriche Prometheus su http://{self.host}:{self.port}/metrics")
+    
+    async def ferma(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _connessione(self, reader, writer):
+        try:
+            richiesta = (await reader.readline()).decode('latin-1').split(' ')
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(richiesta) >= 2 and richiesta[0] == 'GET' and richiesta[1].split('?')[0] == '/metrics':
+                corpo = metriche.prometheus(indicatori()).encode()
+                testata = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                corpo = b''
+                testata = "HTTP/1.1 404 Not Found\r\n"
+            writer.write(f"{testata}Content-Length: {len(corpo)}\r\nConnection: close\r\n\r\n".encode() + corpo)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError) as e:
+            logger.warning(f"Metriche: richiesta non valida ({e})")
+        finally:
+            writer.close()
+
+server_metriche = ServerMetriche() if METRICS_PORT else None
+
+async def esegui_webhook(application):
+    """Ciclo di vita in modalità webhook (equivalente di run_polling)"""
+    fermati = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for segnale in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(segnale, fermati.set)
+        except NotImplementedError:
+            pass
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    
+    server = ServerWebhook(application)
+    await server.avvia()
+    
+    if WEBHOOK_URL:
+        # drop_pending_updates=False: gli update arrivati durante il riavvio
+        # restano in coda su Telegram e vengono consegnati adesso
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+    
+    await application.start()
+    try:
+        await fermati.wait()
+    finally:
+        await server.ferma()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def main():
+    """Avvia il bot"""
+    if sys.argv[1:2] == ['importa']:
+        importa_da_riga_di_comando(sys.argv[2:])
+        return
+    
+    TOKEN = os.getenv('BOT_TOKEN')
+    
+    if not TOKEN:
+        print("❌ Token mancante!")
+        return
+    
+    application = crea_application(TOKEN, webhook=(RUN_MODE == 'webhook'))
     
     print("🏄‍♂️ Bot SUP v.2.5 avviato!")
     print("📅 /mostra_noleggi - Vedi clienti di oggi")
     print("📸 Foto ricevute visualizzabili nei dettagli clienti")
-    application.run_polling(drop_pending_updates=True)
+    if RUN_MODE == 'webhook':
+        if not WEBHOOK_URL and not os.getenv('WEBHOOK_SECRET'):
+            # Il webhook registrato altrove non conosce il secret generato: ogni POST avrebbe 403
+            print("❌ WEBHOOK_SECRET mancante! (obbligatorio se il webhook non lo registra il bot con WEBHOOK_URL)")
+            return
+        print(f"🌐 Modalità webhook sulla porta {WEBHOOK_PORT}")
+        asyncio.run(esegui_webhook(application))
+    else:
+        application.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()